@@ -0,0 +1,112 @@
+# Admission control for client connections. Past the global or per-IP limit a
+# connection waits in a bounded queue for a free slot, and past that it gets a
+# quick 503 instead of slowing down everyone who is already being served.
+
+import asyncio
+from collections import deque
+from .timer_wheel import get_timer_wheel
+
+MAX_CONNECTIONS = 1024
+MAX_CONNECTIONS_PER_IP = 64
+ACCEPT_QUEUE = 256
+# a queued connection that doesn't get a slot within this many seconds is shed
+QUEUE_TIMEOUT = 5
+# how long a shed connection is read (and discarded) after the 503, so closing it
+# with a request still unread doesn't reset the connection before the client sees the reply
+SHED_LINGER = 1
+
+SHED_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Retry-After: 1\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+)
+
+
+class AdmissionController:
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_per_ip=MAX_CONNECTIONS_PER_IP,
+                 max_queue=ACCEPT_QUEUE, queue_timeout=QUEUE_TIMEOUT):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._per_ip = {}      # ip -> admitted + queued connections
+        self._queue = deque()  # futures of connections waiting for a slot, oldest first
+
+    async def admit(self, ip):
+        # None once the connection holds a slot, otherwise why it was shed
+        if self._per_ip.get(ip, 0) >= self.max_per_ip:
+            return "per_ip_limit"
+
+        if self.active < self.max_connections and not self._queue:
+            self.active += 1
+            self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+            return None
+        if len(self._queue) >= self.max_queue:
+            return "queue_full"
+
+        # counted against the IP while queued too, so one client can't fill the queue
+        self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.append(fut)
+        deadline = get_timer_wheel().deadline(self.queue_timeout)
+        try:
+            await deadline.run(fut)
+            return None
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                # the slot was handed to us just as we gave up, pass it on
+                self.release(ip)
+            else:
+                fut.cancel()
+                try:
+                    self._queue.remove(fut)
+                except ValueError:
+                    # release() already popped it, it skips futures that are done
+                    pass
+                self._forget(ip)
+            if isinstance(e, asyncio.TimeoutError):
+                return "queue_timeout"
+            raise
+
+    def release(self, ip):
+        self._forget(ip)
+        # the slot goes straight to the oldest waiter, active stays the same
+        while self._queue:
+            fut = self._queue.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    def _forget(self, ip):
+        count = self._per_ip.get(ip, 0) - 1
+        if count > 0:
+            self._per_ip[ip] = count
+        else:
+            self._per_ip.pop(ip, None)
+
+    def get_stats(self):
+        return {
+            "active": self.active,
+            "queued": len(self._queue),
+            "client_ips": len(self._per_ip),
+        }
+
+
+async def shed(reader, writer):
+    try:
+        writer.write(SHED_RESPONSE)
+        await writer.drain()
+        writer.write_eof()
+        loop = asyncio.get_running_loop()
+        stop_at = loop.time() + SHED_LINGER
+        deadline = get_timer_wheel().deadline(SHED_LINGER)
+        while loop.time() < stop_at:
+            if not await deadline.run(reader.read(64 * 1024), stop_at - loop.time()):
+                break
+    except Exception:
+        pass
@@ -0,0 +1,65 @@
+# Background refreshes for stale-while-revalidate. A client asking for an entry that
+# has just gone stale gets the stale copy right away, and the entry is fetched (or
+# revalidated) again here, off the request path. At most one refresh runs per cache
+# key, and a global cap keeps a burst of expiring entries from flooding the origins.
+
+import asyncio
+
+MAX_REFRESHES = 16
+
+
+class BackgroundRefresher:
+
+    def __init__(self, max_refreshes=MAX_REFRESHES):
+        self.max_refreshes = max_refreshes
+        self._running = {}  # cache key -> task
+
+        # Stats
+        self.started = 0
+        self.skipped = 0  # turned away at the cap, a later request will try again
+        self.failed = 0
+
+    def schedule(self, key, refresh):
+        # refresh is called with no arguments and returns the coroutine doing the work
+        if key in self._running:
+            return False
+        if len(self._running) >= self.max_refreshes:
+            self.skipped += 1
+            return False
+        self.started += 1
+        self._running[key] = asyncio.ensure_future(self._run(key, refresh()))
+        return True
+
+    async def _run(self, key, coro):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.failed += 1
+        finally:
+            self._running.pop(key, None)
+
+    async def close(self):
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_stats(self):
+        return {
+            "running": len(self._running),
+            "started": self.started,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
+
+
+_refresher = None
+
+
+def get_refresher():
+    global _refresher
+    if _refresher is None:
+        _refresher = BackgroundRefresher()
+    return _refresher
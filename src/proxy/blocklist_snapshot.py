@@ -0,0 +1,156 @@
+# Compiled form of the text blocklist. Validating a million-line list takes seconds,
+# so it is done once and the result written to a binary snapshot next to the text
+# file: the entries sorted and deduplicated in one blob, plus an open-addressing hash
+# table over them. Loading is an mmap, lookups probe the table in place, and forked
+# workers share the pages. The header records the source file's size and mtime, a
+# snapshot that doesn't match them is rebuilt.
+
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+
+MAGIC = b"PXBL0002"
+# magic, source mtime (ns), source size, exact entries, suffix entries, url rules, table slots
+HEADER = struct.Struct("<8sQQIIII")
+# key hash (0 means empty), offset of the entry in the blob
+SLOT = struct.Struct("<QI")
+# entries are stored with a kind byte in front and a newline after
+EXACT = b"="
+SUFFIX = b"*"
+# sorts after the other two, so the url rules are the tail of the blob
+KEYWORD = b"~"
+LOAD_FACTOR = 0.6
+# keys are sorted in runs of this many and merged, see write_snapshot
+SORT_RUN = 16384
+
+
+def snapshot_path(config_file):
+    return config_file + ".bin"
+
+
+def _hash(key):
+    # has to agree across processes and runs, so not hash(). never 0, that marks empty
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") | 1
+
+
+def source_stamp(config_file):
+    # taken before the text is read, an edit made while it is being parsed then
+    # still counts as a change
+    st = os.stat(config_file)
+    return st.st_mtime_ns, st.st_size
+
+
+def write_snapshot(config_file, stamp, exact, suffixes, keywords):
+    # exact and suffixes are sets of canonical hostnames, suffixes without the "*.",
+    # keywords the url rules without the "~"
+    keys = ([EXACT + name.encode("ascii") for name in exact]
+            + [SUFFIX + name.encode("ascii") for name in suffixes]
+            + [KEYWORD + rule.encode("ascii") for rule in keywords])
+    # hot reloads build this on a thread. one sorted() over a million keys would hold the
+    # GIL, and with it the event loop, for half a second, short runs and a merge don't
+    runs = [sorted(keys[i:i + SORT_RUN]) for i in range(0, len(keys), SORT_RUN)]
+    slots = 8
+    while slots * LOAD_FACTOR < len(keys):
+        slots *= 2
+    table = bytearray(slots * SLOT.size)
+    blob = bytearray()
+    mask = slots - 1
+    for key in heapq.merge(*runs):
+        h = _hash(key)
+        i = h & mask
+        while SLOT.unpack_from(table, i * SLOT.size)[0]:
+            i = (i + 1) & mask
+        SLOT.pack_into(table, i * SLOT.size, h, len(blob))
+        blob += key + b"\n"
+
+    mtime, size = stamp
+    path = snapshot_path(config_file)
+    # written aside and renamed, so workers starting at the same time never see half a file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, mtime, size, len(exact), len(suffixes), len(keywords), slots))
+        f.write(table)
+        f.write(blob)
+    os.replace(tmp, path)
+    return path
+
+
+class Snapshot:
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.source_mtime, self.source_size, self.exact_count,
+         self.suffix_count, self.keyword_count, self.slots) = HEADER.unpack_from(self._map, 0)
+        self._mask = self.slots - 1
+        self._blob = HEADER.size + self.slots * SLOT.size
+        if magic != MAGIC or len(self._map) < self._blob:
+            self._map.close()
+            raise ValueError(f"{path} is not a blocklist snapshot")
+        self.exact = SnapshotSet(self, EXACT, self.exact_count)
+        self.suffixes = SnapshotSet(self, SUFFIX, self.suffix_count)
+
+    def close(self):
+        self._map.close()
+
+    def keywords(self):
+        # the url rules, to be compiled into a matcher. they are the last entries in the blob
+        if not self.keyword_count:
+            return []
+        mapped = self._map
+        start = self._blob if mapped[self._blob:self._blob + 1] == KEYWORD else mapped.find(b"\n" + KEYWORD, self._blob) + 1
+        return [line[1:] for line in mapped[start:].decode("ascii").split("\n") if line]
+
+    def matches(self, config_file):
+        return (self.source_mtime, self.source_size) == source_stamp(config_file)
+
+    def lookup(self, key):
+        mapped = self._map
+        h = _hash(key)
+        i = h & self._mask
+        while True:
+            slot_hash, offset = SLOT.unpack_from(mapped, HEADER.size + i * SLOT.size)
+            if not slot_hash:
+                return False
+            if slot_hash == h:
+                start = self._blob + offset
+                end = start + len(key)
+                if mapped[start:end] == key and mapped[end:end + 1] == b"\n":
+                    return True
+            i = (i + 1) & self._mask
+
+
+class SnapshotSet:
+    # read-only stand-in for the filter's sets, only "in" and len()
+
+    def __init__(self, snapshot, kind, count):
+        self._snapshot = snapshot
+        self._kind = kind
+        self._count = count
+
+    def __contains__(self, name):
+        try:
+            key = self._kind + name.encode("ascii")
+        except UnicodeEncodeError:
+            return False
+        return self._snapshot.lookup(key)
+
+    def __len__(self):
+        return self._count
+
+
+def open_snapshot(config_file):
+    # the snapshot for config_file if there is one and it is current, else None
+    path = snapshot_path(config_file)
+    if not os.path.exists(path):
+        return None
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError, struct.error):
+        return None
+    if not snapshot.matches(config_file):
+        snapshot.close()
+        return None
+    return snapshot
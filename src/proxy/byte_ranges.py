@@ -0,0 +1,114 @@
+# Range requests answered from a cached full response (RFC 7233). The parts are
+# memoryview slices of the stored body, so a seek into a large cached video costs
+# no copy of the object and no trip to the origin.
+
+import os
+from .http_parser import (find_head_end, parse_response_head, build_response_head, header_value,
+                          remove_header, body_framing, decode_chunked)
+from .http_cache import parse_http_date
+from .cache_compression import prepare_stored_body
+
+# a request asking for more pieces than this just gets the whole response
+MAX_RANGES = 16
+
+
+def parse_ranges(value, length):
+    # [(first, last), ...] inclusive, [] when none of them is satisfiable, or None when the
+    # header can't be used and the full response should go out instead
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    specs = [part.strip() for part in spec.split(",") if part.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for part in specs:
+        first, dash, last = part.partition("-")
+        if not dash:
+            return None
+        try:
+            if not first.strip():
+                suffix = int(last)
+                if suffix > 0 and length > 0:
+                    ranges.append((max(0, length - suffix), length - 1))
+                continue
+            start = int(first)
+            end = int(last) if last.strip() else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if start < length:
+            ranges.append((start, length - 1 if end is None else min(end, length - 1)))
+    return ranges
+
+
+def if_range_matches(value, headers):
+    # an entity tag has to match strongly, a date has to be exactly the Last-Modified
+    value = value.strip()
+    if value.startswith('"') or value.startswith("W/"):
+        etag = header_value(headers, "ETag")
+        return etag is not None and not value.startswith("W/") and etag.strip() == value
+    last_modified = parse_http_date(header_value(headers, "Last-Modified"))
+    return last_modified is not None and parse_http_date(value) == last_modified
+
+
+def prepare_range_response(response_bytes, request_headers, keep_alive, age=None):
+    # (status, head, body pieces) for a Range request, or None when the full response
+    # should be sent instead
+    range_header = header_value(request_headers, "Range")
+    if range_header is None:
+        return None
+    head_end = find_head_end(response_bytes)
+    version, status, reason, headers = parse_response_head(bytes(memoryview(response_bytes)[:head_end]))
+    if status != 200:
+        return None
+    if_range = header_value(request_headers, "If-Range")
+    if if_range is not None and not if_range_matches(if_range, headers):
+        return None
+
+    # ranges count bytes of the plain body, whatever way it is stored
+    body = prepare_stored_body(headers, memoryview(response_bytes)[head_end + 4:], False)
+    if body_framing(headers, response=True)[1]:
+        body = decode_chunked(bytes(body))
+        remove_header(headers, "Transfer-Encoding")
+    body = memoryview(body)
+    length = len(body)
+
+    ranges = parse_ranges(range_header, length)
+    if ranges is None:
+        return None
+    remove_header(headers, "Content-Length")
+    remove_header(headers, "Content-Range")
+    if age is not None:
+        remove_header(headers, "Age")
+        headers["Age"] = str(age)
+
+    if not ranges:
+        for name in ("Content-Type", "Content-Encoding"):
+            remove_header(headers, name)
+        headers["Content-Range"] = f"bytes */{length}"
+        headers["Content-Length"] = "0"
+        return 416, build_response_head(version, 416, "Range Not Satisfiable", headers, keep_alive), []
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+        headers["Content-Length"] = str(end - start + 1)
+        return 206, build_response_head(version, 206, "Partial Content", headers, keep_alive), [body[start:end + 1]]
+
+    boundary = os.urandom(12).hex()
+    content_type = header_value(headers, "Content-Type")
+    remove_header(headers, "Content-Type")
+    pieces = []
+    for start, end in ranges:
+        part_head = f"\r\n--{boundary}\r\n"
+        if content_type is not None:
+            part_head += f"Content-Type: {content_type}\r\n"
+        part_head += f"Content-Range: bytes {start}-{end}/{length}\r\n\r\n"
+        pieces.append(part_head.encode("latin-1"))
+        pieces.append(body[start:end + 1])
+    pieces.append(f"\r\n--{boundary}--\r\n".encode("latin-1"))
+    headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    headers["Content-Length"] = str(sum(len(piece) for piece in pieces))
+    return 206, build_response_head(version, 206, "Partial Content", headers, keep_alive), pieces
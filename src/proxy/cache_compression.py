@@ -0,0 +1,121 @@
+# Optional gzip storage for cached responses. Text-like bodies are compressed once when
+# they are stored, so the cache's byte budget counts the compressed size. Clients that
+# accept gzip get the stored bytes as they are, anyone else gets them inflated on the way out.
+
+import zlib
+from .http_parser import (HTTPParseError, find_head_end, parse_response_head, build_response_head,
+                          header_value, remove_header, body_framing, decode_chunked)
+
+COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/javascript", "application/x-javascript",
+    "application/xml", "application/xhtml+xml", "application/rss+xml", "application/atom+xml",
+    "application/manifest+json", "image/svg+xml",
+)
+# smaller bodies aren't worth the cpu, the saving is a few hundred bytes at best
+MIN_COMPRESS_BYTES = 1024
+# the compressed copy is only kept if it is at least this much smaller
+MIN_SAVING = 0.1
+# bodies bigger than this are gzipped and inflated on a worker thread, a few MB of zlib
+# on the event loop would hold up every other connection
+OFFLOAD_BYTES = 64 * 1024
+# marks a body we compressed ourselves and carries its original length, never sent to clients
+STORED_GZIP_HEADER = "X-Proxy-Stored-Gzip"
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def is_compressible(headers):
+    if header_value(headers, "Content-Encoding", "identity").strip().lower() != "identity":
+        return False
+    content_type = header_value(headers, "Content-Type", "").split(";", 1)[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress_response(response_bytes, level):
+    # the response to store, gzipped if that is worth it, otherwise untouched
+    head_end = find_head_end(response_bytes)
+    if head_end == -1:
+        return response_bytes
+    try:
+        version, status, reason, headers = parse_response_head(response_bytes[:head_end])
+        if not is_compressible(headers):
+            return response_bytes
+        body = response_bytes[head_end + 4:]
+        if body_framing(headers, response=True)[1]:
+            body = decode_chunked(body)
+    except HTTPParseError:
+        return response_bytes
+    if len(body) < MIN_COMPRESS_BYTES:
+        return response_bytes
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    compressed = compressor.compress(body) + compressor.flush()
+    if len(compressed) > len(body) * (1 - MIN_SAVING):
+        return response_bytes
+
+    remove_header(headers, "Transfer-Encoding")
+    remove_header(headers, "Content-Length")
+    headers["Content-Encoding"] = "gzip"
+    headers["Content-Length"] = str(len(compressed))
+    headers[STORED_GZIP_HEADER] = str(len(body))
+    return build_response_head(version, status, reason, headers, True) + compressed
+
+
+def stored_gzip_length(headers):
+    # the plain body length of a response we stored gzipped, or None
+    try:
+        return int(header_value(headers, STORED_GZIP_HEADER))
+    except (TypeError, ValueError):
+        return None
+
+
+def inflate_response(response_bytes):
+    # a response we stored gzipped, back as it was before, as (response bytes, headers)
+    head_end = find_head_end(response_bytes)
+    view = memoryview(response_bytes)
+    version, status, reason, headers = parse_response_head(bytes(view[:head_end]))
+    original_length = header_value(headers, STORED_GZIP_HEADER)
+    for name in (STORED_GZIP_HEADER, "Content-Encoding", "Content-Length"):
+        remove_header(headers, name)
+    headers["Content-Length"] = original_length
+    body = zlib.decompress(bytes(view[head_end + 4:]), GZIP_WBITS)
+    return build_response_head(version, status, reason, headers, True) + body, headers
+
+
+def accepts_gzip(request_headers):
+    for coding in header_value(request_headers, "Accept-Encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ("gzip", "x-gzip", "*"):
+            key, _, value = params.strip().partition("=")
+            if key.strip().lower() != "q":
+                return True
+            try:
+                return float(value) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def prepare_stored_body(headers, body, accept_gzip):
+    # undoes our storage encoding for this client. headers are changed in place
+    original_length = header_value(headers, STORED_GZIP_HEADER)
+    if original_length is None:
+        return body
+    remove_header(headers, STORED_GZIP_HEADER)
+    vary = header_value(headers, "Vary")
+    if vary is None:
+        headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        remove_header(headers, "Vary")
+        headers["Vary"] = vary + ", Accept-Encoding"
+
+    if accept_gzip:
+        # not the bytes the origin's strong validator was for any more
+        etag = header_value(headers, "ETag")
+        if etag is not None and not etag.startswith("W/"):
+            remove_header(headers, "ETag")
+            headers["ETag"] = "W/" + etag
+        return body
+    remove_header(headers, "Content-Encoding")
+    remove_header(headers, "Content-Length")
+    headers["Content-Length"] = original_length
+    return zlib.decompress(bytes(body), GZIP_WBITS)
@@ -0,0 +1,222 @@
+# Collapsed forwarding for cache misses. While one request (the leader) fetches a
+# cacheable URL, identical requests attach to that fetch as followers and stream the
+# same bytes, so a popular object expiring costs the origin one request, not N.
+
+import asyncio
+from .http_parser import build_response_head, header_value
+from .timer_wheel import get_timer_wheel
+
+# how long a follower waits for the leader's response head, and then for each next piece.
+# running out before the head arrives means fetching on its own instead
+FOLLOW_TIMEOUT = 45
+# past the cache's size limit nothing waits for followers, the leader keeps reading. a
+# follower that gets this many bytes behind the leader is cut off, so one slow
+# client can't make the proxy hold a whole big download in memory
+MAX_FOLLOWER_LAG = 16 * 1024 * 1024
+
+
+class Flight:
+    # one leader fetch in progress. body bytes are kept until it ends so a late
+    # follower still starts from the first byte. once the response outgrows what the
+    # cache keeps, late followers are turned away and the bytes every attached follower
+    # has written are let go, so the ones already streaming still get all of it, unless
+    # they fall more than MAX_FOLLOWER_LAG behind
+    def __init__(self, key, request_headers=None):
+        self.key = key
+        self.request_headers = request_headers or {}
+        self.head = None  # (version, status, reason, headers, framed) once the leader has it
+        self.chunks = []
+        self.base = 0  # how many chunks have been let go from the front of chunks
+        self.held = 0  # bytes in chunks
+        self.done = False
+        self.failed = False  # leader gave up, or the response turned out not to be shareable
+        self.unbuffered = False  # too big to keep, no new followers
+        self._cursors = {}  # follower token -> index of the next chunk it needs
+        self._cut_off = set()  # tokens of followers dropped for lagging
+        self._waiters = []
+
+    @property
+    def followers(self):
+        return len(self._cursors)
+
+    def attach(self):
+        token = object()
+        self._cursors[token] = 0
+        return token
+
+    def detach(self, token):
+        self._cursors.pop(token, None)
+        self._trim()
+
+    def advance(self, token, pos):
+        if token in self._cursors:
+            self._cursors[token] = pos
+            self._trim()
+
+    def cut_off(self, token):
+        return token in self._cut_off
+
+    def start(self, version, status, reason, headers, framed, shareable):
+        if not shareable:
+            self.abandon()
+            return
+        self.head = (version, status, reason, headers, framed)
+        self._wake()
+
+    def feed(self, data):
+        if not self.failed:
+            self.chunks.append(data)
+            self.held += len(data)
+            self._trim()
+            self._wake()
+
+    def stop_buffering(self):
+        self.unbuffered = True
+        self._trim()
+
+    def _trim(self):
+        if not self.unbuffered:
+            return
+        while True:
+            low = min(self._cursors.values(), default=self.base + len(self.chunks))
+            gone = self.chunks[:low - self.base]
+            del self.chunks[:low - self.base]
+            self.held -= sum(len(data) for data in gone)
+            self.base = low
+            if self.held <= MAX_FOLLOWER_LAG or not self._cursors:
+                return
+            slowest = min(self._cursors, key=self._cursors.get)
+            del self._cursors[slowest]
+            self._cut_off.add(slowest)
+
+    def finish(self):
+        if self.head is None:
+            # ended without a shareable response, e.g. a 304 to the leader's revalidation
+            self.abandon()
+            return
+        self.done = True
+        self._wake()
+
+    def matches(self, request_headers):
+        # a response with Vary only fits followers that sent the same values for those headers
+        vary = header_value(self.head[3], "Vary", "")
+        for name in (n.strip() for n in vary.split(",")):
+            if name and header_value(request_headers, name) != header_value(self.request_headers, name):
+                return False
+        return True
+
+    def abandon(self):
+        self.failed = True
+        self.chunks = []
+        self.held = 0
+        self._wake()
+
+    def changed(self):
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        return fut
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+
+
+class RequestCollapser:
+
+    def __init__(self, follow_timeout=FOLLOW_TIMEOUT):
+        self._flights = {}  # cache key -> Flight
+        self.follow_timeout = follow_timeout
+
+        # Stats
+        self.collapsed = 0
+        self.fallbacks = 0
+        self.cut_off = 0  # followers dropped for falling too far behind
+
+    def join(self, key):
+        # (flight, token) or None
+        flight = self._flights.get(key)
+        if flight is None or flight.failed or flight.unbuffered:
+            return None
+        return flight, flight.attach()
+
+    def lead(self, key, request_headers=None):
+        # None when someone else is already fetching this key
+        flight = self._flights.get(key)
+        if flight is not None and not flight.failed and not flight.unbuffered:
+            return None
+        flight = Flight(key, request_headers)
+        self._flights[key] = flight
+        return flight
+
+    def end(self, flight, ok):
+        if ok:
+            flight.finish()
+        else:
+            flight.abandon()
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    async def follow(self, joined, writer, keep_alive, request_headers=None):
+        # returns None when the follower has to fetch for itself (nothing was written
+        # yet then), otherwise (status, bytes_sent, keep_alive)
+        flight, token = joined
+        deadline = get_timer_wheel().deadline(self.follow_timeout)
+        try:
+            try:
+                while flight.head is None and not flight.failed:
+                    await deadline.run(flight.changed())
+            except asyncio.TimeoutError:
+                self.fallbacks += 1
+                return None
+            if flight.failed or not flight.matches(request_headers or {}):
+                self.fallbacks += 1
+                return None
+
+            self.collapsed += 1
+            version, status, reason, headers, framed = flight.head
+            keep_alive = keep_alive and framed
+            head = build_response_head(version, status, reason, headers, keep_alive)
+            writer.write(head)
+            sent = len(head)
+            pos = 0
+            while True:
+                if flight.failed:
+                    # the client already has part of the response, all we can do is cut it off
+                    raise ConnectionResetError("Collapsed fetch failed mid-response")
+                if flight.cut_off(token):
+                    self.cut_off += 1
+                    raise ConnectionResetError("Fell too far behind the collapsed fetch")
+                end = flight.base + len(flight.chunks)
+                while pos < end:
+                    data = flight.chunks[pos - flight.base]
+                    pos += 1
+                    writer.write(data)
+                    sent += len(data)
+                await writer.drain()
+                flight.advance(token, pos)
+                if flight.done and pos == flight.base + len(flight.chunks):
+                    return status, sent, keep_alive
+                if not flight.failed and pos == flight.base + len(flight.chunks):
+                    await deadline.run(flight.changed())
+        finally:
+            flight.detach(token)
+
+    def get_stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "collapsed": self.collapsed,
+            "fallbacks": self.fallbacks,
+            "cut_off": self.cut_off,
+        }
+
+
+_collapser = None
+
+
+def get_collapser():
+    global _collapser
+    if _collapser is None:
+        _collapser = RequestCollapser()
+    return _collapser
@@ -0,0 +1,172 @@
+import asyncio
+import time
+from collections import deque
+from .dns_resolver import open_connection
+from .timer_wheel import get_timer_wheel
+from .proxy_logger import get_metrics
+
+# idle upstream connections kept around for reuse
+MAX_IDLE_PER_HOST = 8
+MAX_IDLE_TOTAL = 256
+IDLE_TIMEOUT = 30
+
+
+class PooledConnection:
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+        self.idle_since = None
+        self._watcher = None
+        self._idle_deadline = None
+
+    def watch(self, pool):
+        self.idle_since = time.monotonic()
+        self._watcher = asyncio.ensure_future(self._watch_idle(pool))
+        # the idle timeout lives on the timer wheel, expiry drops the connection from the pool
+        self._idle_deadline = get_timer_wheel().register(pool.idle_timeout, lambda: pool._discard(self))
+
+    async def _watch_idle(self, pool):
+        # an idle HTTP/1.1 connection must stay silent, so any byte or EOF from the
+        # origin means the socket can't be handed out again
+        try:
+            await self.reader.read(1)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        pool._discard(self)
+
+    def is_healthy(self):
+        return not (self.writer.is_closing() or self.reader.at_eof()
+                    or self.reader.exception() is not None)
+
+    async def checkout(self):
+        # health check, the watcher only finishes on its own when the socket went bad.
+        # it has to be fully stopped before anyone else reads from the stream
+        self._stop_idle_deadline()
+        watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            if watcher.done():
+                return False
+            watcher.cancel()
+            await asyncio.wait({watcher})
+            if not watcher.cancelled():
+                return False
+        return self.is_healthy()
+
+    def _stop_idle_deadline(self):
+        if self._idle_deadline is not None:
+            self._idle_deadline.cancel()
+            self._idle_deadline = None
+
+    def close(self):
+        self._stop_idle_deadline()
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+
+    def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST, max_idle_total=MAX_IDLE_TOTAL,
+                 idle_timeout=IDLE_TIMEOUT):
+        self._idle = {}  # (host, port) -> deque of idle connections, newest on the right
+        self._idle_count = 0
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle_total = max_idle_total
+        self.idle_timeout = idle_timeout
+
+    def _key(self, host, port):
+        return (host.lower(), port)
+
+    async def acquire(self, host, port, timeout, fresh=False):
+        key = self._key(host, port)
+        metrics = get_metrics()
+
+        conns = None if fresh else self._idle.get(key)
+        while conns:
+            # newest first, the origin is least likely to have timed it out
+            conn = conns.pop()
+            self._idle_count -= 1
+            if not conns:
+                del self._idle[key]
+            if await conn.checkout():
+                conn.reused = True
+                metrics.record_pool_checkout(hit=True)
+                return conn
+            conn.close()
+
+        metrics.record_pool_checkout(hit=False)
+        reader, writer = await asyncio.wait_for(
+            open_connection(host, port),
+            timeout=timeout
+        )
+        return PooledConnection(key, reader, writer)
+
+    def release(self, conn, reusable):
+        if not reusable or not conn.is_healthy():
+            conn.close()
+            return
+
+        conns = self._idle.setdefault(conn.key, deque())
+        if len(conns) >= self.max_idle_per_host:
+            self._idle_count -= 1
+            conns.popleft().close()
+        if self._idle_count >= self.max_idle_total:
+            self._evict_oldest()
+
+        conn.reused = False
+        conns.append(conn)
+        self._idle_count += 1
+        conn.watch(self)
+
+    def _evict_oldest(self):
+        oldest_key = min(self._idle, key=lambda k: self._idle[k][0].idle_since, default=None)
+        if oldest_key is None:
+            return
+        conns = self._idle[oldest_key]
+        conns.popleft().close()
+        self._idle_count -= 1
+        if not conns:
+            del self._idle[oldest_key]
+
+    def _discard(self, conn):
+        conns = self._idle.get(conn.key)
+        if conns is None or conn not in conns:
+            return
+        conns.remove(conn)
+        self._idle_count -= 1
+        if not conns:
+            del self._idle[conn.key]
+        conn._watcher = None
+        conn.close()
+
+    def close_all(self):
+        for conns in self._idle.values():
+            for conn in conns:
+                conn.close()
+        self._idle.clear()
+        self._idle_count = 0
+
+    def get_stats(self):
+        return {
+            "idle_connections": self._idle_count,
+            "idle_hosts": len(self._idle),
+        }
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool()
+    return _pool
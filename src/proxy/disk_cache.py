@@ -0,0 +1,290 @@
+# On-disk second tier for the response cache. Objects are appended to fixed-size
+# segment files and found through an in-memory index that is rebuilt by scanning the
+# segments at startup, so the cache survives a restart. Hits are memoryviews into an
+# mmap of the segment, the object itself never gets copied onto the Python heap.
+# Space is reclaimed a whole segment at a time, oldest first. Demotions from RAM are
+# written by a background thread, so a multi-MB eviction never waits on the disk in
+# the event loop; until written they are served from the bytes waiting in the queue.
+
+import mmap
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict, deque
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+MAX_DISK_BYTES = 1024 * 1024 * 1024
+# demotions waiting for the writer thread, more than this and new ones are dropped
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+# magic, key length, data length, stored-at timestamp
+RECORD_HEADER = struct.Struct("<4sHId")
+RECORD_MAGIC = b"PXC1"
+SEGMENT_NAME = re.compile(r"^seg-(\d{8})\.dat$")
+
+
+class DiskEntry:
+    __slots__ = ("segment", "offset", "length", "timestamp", "hits")
+
+    def __init__(self, segment, offset, length, timestamp):
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.timestamp = timestamp
+        self.hits = 0
+
+
+class Segment:
+
+    def __init__(self, directory, segment_id):
+        self.id = segment_id
+        self.path = os.path.join(directory, f"seg-{segment_id:08d}.dat")
+        self.size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.keys = set()  # keys written here, some may have been overwritten since
+        self._map = None
+
+    def view(self, offset, length):
+        end = offset + length
+        if self._map is None or end > len(self._map):
+            # the newest segment keeps growing, map it again to see the new records
+            self._remap()
+        return memoryview(self._map)[offset:end]
+
+    def _remap(self):
+        old = self._map
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _close_map(old)
+
+    def close(self):
+        _close_map(self._map)
+        self._map = None
+
+
+def _close_map(mapped):
+    if mapped is None:
+        return
+    try:
+        mapped.close()
+    except BufferError:
+        # a hit is still being sent from it, the map goes away with the last view
+        pass
+
+
+class DiskCache:
+
+    def __init__(self, directory, max_bytes=MAX_DISK_BYTES, segment_size=SEGMENT_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.total_bytes = 0
+        self._index = {}                 # key -> DiskEntry
+        self._segments = OrderedDict()   # segment id -> Segment, oldest first
+        self._writer = None              # append handle on the newest segment
+        # the index and segment list are shared with the writer thread, the file writes
+        # themselves happen outside this lock
+        self._lock = threading.Lock()
+        self._pending = {}               # key -> (DiskEntry, bytes) queued for writing
+        self._pending_bytes = 0
+        self._queue = deque()
+        self._ready = threading.Condition()
+        self._closed = False
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+
+        self._load()
+        self._thread = threading.Thread(target=self._run, name="disk-cache-writer", daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        ids = sorted(int(m.group(1)) for m in map(SEGMENT_NAME.match, os.listdir(self.directory)) if m)
+        for segment_id in ids:
+            segment = Segment(self.directory, segment_id)
+            self._segments[segment_id] = segment
+            self._scan(segment)
+            self.total_bytes += segment.size
+
+    def _scan(self, segment):
+        if not segment.size:
+            return
+        with open(segment.path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = 0
+            while pos + RECORD_HEADER.size <= len(data):
+                magic, key_len, data_len, timestamp = RECORD_HEADER.unpack_from(data, pos)
+                key_start = pos + RECORD_HEADER.size
+                end = key_start + key_len + data_len
+                if magic != RECORD_MAGIC or end > len(data):
+                    break
+                key = data[key_start:key_start + key_len].decode("utf-8")
+                self._index[key] = DiskEntry(segment, key_start + key_len, data_len, timestamp)
+                segment.keys.add(key)
+                pos = end
+        finally:
+            data.close()
+
+        if pos < segment.size:
+            # a record cut short by a crash, drop the tail so appends line up again
+            with open(segment.path, "r+b") as f:
+                f.truncate(pos)
+            segment.size = pos
+
+    def get(self, key):
+        # (entry, memoryview of the stored bytes), or None
+        with self._lock:
+            pending = self._pending.get(key)
+            entry = pending[0] if pending is not None else self._index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry.hits += 1
+            self.hits += 1
+            if pending is not None:
+                return entry, memoryview(pending[1])
+            return entry, entry.segment.view(entry.offset, entry.length)
+
+    def put_later(self, key, data, timestamp):
+        # queues the write for the writer thread, for callers on the event loop
+        with self._ready:
+            if self._closed:
+                return self.put(key, data, timestamp)
+            old = self._pending.get(key)
+            size = len(data) - (len(old[1]) if old is not None else 0)
+            if self._pending_bytes + size > MAX_PENDING_BYTES:
+                # the disk can't keep up, losing a cached copy beats stalling
+                self.dropped += 1
+                return False
+            with self._lock:
+                self._pending[key] = (DiskEntry(None, 0, len(data), timestamp), data)
+            self._pending_bytes += size
+            if old is None:
+                self._queue.append(key)
+                self._ready.notify()
+            return True
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._queue and not self._closed:
+                    self._ready.wait()
+                if not self._queue:
+                    return
+                key = self._queue.popleft()
+                pending = self._pending.get(key)
+            if pending is not None:
+                self.put(key, pending[1], pending[0].timestamp, pending[0])
+
+    def put(self, key, data, timestamp, pending=None):
+        # writes on the calling thread, pending is the queued entry being written out
+        key_bytes = key.encode("utf-8")
+        record_size = RECORD_HEADER.size + len(key_bytes) + len(data)
+        if record_size > self.segment_size or len(key_bytes) > 0xFFFF:
+            self._written(key, pending, None)
+            return False
+
+        with self._lock:
+            segment = self._segments[next(reversed(self._segments))] if self._segments else None
+            if segment is None or self._writer is None or segment.size + record_size > self.segment_size:
+                segment = self._roll()
+        offset = segment.size + RECORD_HEADER.size + len(key_bytes)
+        self._writer.write(RECORD_HEADER.pack(RECORD_MAGIC, len(key_bytes), len(data), timestamp))
+        self._writer.write(key_bytes)
+        self._writer.write(data)
+        self._writer.flush()
+
+        entry = DiskEntry(segment, offset, len(data), timestamp)
+        with self._lock:
+            segment.size += record_size
+            segment.keys.add(key)
+            self.total_bytes += record_size
+            if pending is None or self._pending.get(key, (None,))[0] is pending:
+                if pending is not None:
+                    entry.hits = pending.hits
+                self._index[key] = entry
+            while self.total_bytes > self.max_bytes and len(self._segments) > 1:
+                self._drop_oldest()
+        self._written(key, pending, data)
+        return True
+
+    def _written(self, key, pending, data):
+        # the queued copy is on disk now, or was never going to be
+        if pending is None:
+            return
+        with self._ready:
+            with self._lock:
+                current = self._pending.get(key)
+                if current is not None and current[0] is not pending:
+                    # replaced while it was being written, the newer copy goes next
+                    self._queue.append(key)
+                    return
+                if current is not None:
+                    del self._pending[key]
+            if current is not None:
+                self._pending_bytes -= len(current[1])
+
+    def delete(self, key):
+        with self._ready:
+            with self._lock:
+                self._index.pop(key, None)
+                pending = self._pending.pop(key, None)
+            if pending is not None:
+                self._pending_bytes -= len(pending[1])
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._index or key in self._pending
+
+    def keys(self):
+        with self._lock:
+            return list(self._index) + [key for key in self._pending if key not in self._index]
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+        segment_id = next(reversed(self._segments)) + 1 if self._segments else 1
+        segment = Segment(self.directory, segment_id)
+        self._segments[segment_id] = segment
+        self._writer = open(segment.path, "ab")
+        return segment
+
+    def _drop_oldest(self):
+        _, segment = self._segments.popitem(last=False)
+        for key in segment.keys:
+            entry = self._index.get(key)
+            if entry is not None and entry.segment is segment:
+                del self._index[key]
+        segment.close()
+        try:
+            os.unlink(segment.path)
+        except OSError:
+            pass
+        self.total_bytes -= segment.size
+
+    def close(self):
+        # the queued demotions are written out first
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+        self._thread.join()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for segment in self._segments.values():
+            segment.close()
+
+    def get_stats(self):
+        return {
+            "entries": len(self._index),
+            "size_bytes": self.total_bytes,
+            "segments": len(self._segments),
+            "hits": self.hits,
+            "misses": self.misses,
+            "pending": len(self._pending),
+            "dropped": self.dropped,
+        }
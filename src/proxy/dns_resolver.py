@@ -0,0 +1,192 @@
+import asyncio
+import ipaddress
+import socket
+
+# getaddrinfo gives no TTLs, so answers are kept for a fixed time
+POSITIVE_TTL = 60
+NEGATIVE_TTL = 10
+MAX_ENTRIES = 4096
+# RFC 8305 "Connection Attempt Delay" between racing addresses
+HAPPY_EYEBALLS_DELAY = 0.25
+
+
+class DNSCache:
+
+    def __init__(self, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES):
+        self._cache = {}     # host -> (expires_at, addresses or the lookup error)
+        self._inflight = {}  # host -> task, so a burst for one name does one lookup
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        # Stats
+        self.hits = 0
+        self.misses = 0  # lookups actually sent to the resolver
+        self.coalesced = 0  # callers that waited on someone else's lookup
+
+    async def resolve(self, host):
+        # returns [(family, ip, scope_id)] ordered for connecting, per RFC 8305 section 4
+        literal = _ip_literal(host)
+        if literal is not None:
+            return [literal]
+
+        key = host.lower()
+        loop = asyncio.get_running_loop()
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > loop.time():
+            self.hits += 1
+            if isinstance(entry[1], Exception):
+                # a fresh copy, re-raising the stored one would keep growing its traceback
+                raise type(entry[1])(*entry[1].args)
+            return entry[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._lookup(key))
+            self._inflight[key] = task
+        else:
+            self.coalesced += 1
+        # shielded so one impatient caller can't cancel the lookup for everyone else
+        return await asyncio.shield(task)
+
+    async def _lookup(self, key):
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await loop.getaddrinfo(key, None, type=socket.SOCK_STREAM)
+        except OSError as e:
+            self._store(key, e, self.negative_ttl)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        addresses = _interleave(infos)
+        if not addresses:
+            error = socket.gaierror(socket.EAI_NONAME, f"No addresses for {key}")
+            self._store(key, error, self.negative_ttl)
+            raise error
+        self._store(key, addresses, self.positive_ttl)
+        return addresses
+
+    def _store(self, key, value, ttl):
+        if len(self._cache) >= self.max_entries:
+            now = asyncio.get_running_loop().time()
+            for k in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+                del self._cache[k]
+            while len(self._cache) >= self.max_entries:
+                del self._cache[next(iter(self._cache))]
+        self._cache[key] = (asyncio.get_running_loop().time() + ttl, value)
+
+    def clear(self):
+        self._cache.clear()
+
+    def get_stats(self):
+        return {
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+def _ip_literal(host):
+    try:
+        ip = ipaddress.ip_address(host.strip("[]"))
+    except ValueError:
+        return None
+    family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+    return (family, str(ip), 0)
+
+
+def _interleave(infos):
+    # alternate families starting with whatever the resolver put first
+    by_family = {}
+    for family, _, _, _, sockaddr in infos:
+        if family not in (socket.AF_INET, socket.AF_INET6):
+            continue
+        scope_id = sockaddr[3] if family == socket.AF_INET6 else 0
+        address = (family, sockaddr[0], scope_id)
+        addresses = by_family.setdefault(family, [])
+        if address not in addresses:
+            addresses.append(address)
+
+    ordered = []
+    queues = list(by_family.values())
+    while any(queues):
+        for queue in queues:
+            if queue:
+                ordered.append(queue.pop(0))
+    return ordered
+
+
+async def _connect_socket(family, ip, scope_id, port):
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        sockaddr = (ip, port, 0, scope_id) if family == socket.AF_INET6 else (ip, port)
+        await loop.sock_connect(sock, sockaddr)
+        return sock
+    except BaseException:
+        sock.close()
+        raise
+
+
+async def _collect(pending, errors, timeout):
+    # first successful socket among the finished attempts, any extra winners are closed
+    done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    winner = None
+    for task in done:
+        pending.discard(task)
+        if task.exception() is not None:
+            errors.append(task.exception())
+        elif winner is None:
+            winner = task.result()
+        else:
+            task.result().close()
+    return winner
+
+
+def _close_late_winner(task):
+    # an attempt that connected after we stopped waiting for it
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+
+async def happy_eyeballs_connect(addresses, port, delay=HAPPY_EYEBALLS_DELAY):
+    # RFC 8305: start the next address every `delay` seconds (or as soon as one fails)
+    # and keep the first connection that completes
+    pending = set()
+    errors = []
+    try:
+        for family, ip, scope_id in addresses:
+            pending.add(asyncio.ensure_future(_connect_socket(family, ip, scope_id, port)))
+            sock = await _collect(pending, errors, delay)
+            if sock is not None:
+                return sock
+        while pending:
+            sock = await _collect(pending, errors, None)
+            if sock is not None:
+                return sock
+    finally:
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(_close_late_winner)
+    if len(errors) == 1:
+        raise errors[0]
+    raise OSError(f"All connection attempts failed: {', '.join(str(e) for e in errors)}")
+
+
+async def open_connection(host, port):
+    sock = await happy_eyeballs_connect(await get_resolver().resolve(host), port)
+    return await asyncio.open_connection(sock=sock)
+
+
+_resolver = None
+
+
+def get_resolver():
+    global _resolver
+    if _resolver is None:
+        _resolver = DNSCache()
+    return _resolver
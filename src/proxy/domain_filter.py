@@ -1,6 +1,11 @@
 import os
+import re
+import time
+import asyncio
 import logging
 from pathlib import Path
+from .blocklist_snapshot import open_snapshot, write_snapshot, source_stamp
+from .url_rules import KeywordMatcher
 
 logging.basicConfig(
     level=logging.INFO,
@@ -11,42 +16,166 @@ logger = logging.getLogger(__name__)
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 DEFAULT_CONFIG = PROJECT_ROOT / "config" / "blocked_domains.txt"
 
+MAX_HOSTNAME_LENGTH = 253
+HOSTNAME_RE = re.compile(r'^[a-z0-9]([a-z0-9\-\.]*[a-z0-9])?$|^[a-z0-9]$')
+MAX_KEYWORD_LENGTH = 1024
+# seconds between stat() calls on the blocklist file
+RELOAD_POLL = 5
+
+
+class BlocklistIndex:
+    # one complete generation of the blocklist. a reload builds a new one off to the side
+    # and swaps the filter's reference, lookups never see a half-built or empty filter
+    __slots__ = ("exact", "suffixes", "rules", "snapshot", "stamp")
+
+    def __init__(self, exact, suffixes, rules=None, snapshot=None, stamp=None):
+        self.exact = exact
+        # "*.ads.example" is stored as "ads.example", a lookup tries the host and each
+        # parent domain in turn, so it costs one set probe per label however long the list
+        self.suffixes = suffixes
+        # "~keyword" rules, searched for in host + path all at once
+        self.rules = rules if rules is not None else KeywordMatcher([])
+        self.snapshot = snapshot
+        self.stamp = stamp  # (mtime, size) of the text it was built from
+
 
 class DomainFilter:
     def __init__(self, config_file=None):
         self.config_file = config_file or str(DEFAULT_CONFIG)
-        self.blocked_exact = set()  
-        self.blocked_suffixes = [] 
+        self.index = BlocklistIndex(set(), set())
+        self._watcher = None
+
+        # Stats
+        self.generation = 0
+        self.reload_failures = 0
+        self.last_reload_seconds = 0.0
         self.load_config()
 
-    def load_config(self):
-        self.blocked_exact.clear()
-        self.blocked_suffixes.clear()
+    @property
+    def blocked_exact(self):
+        return self.index.exact
 
+    @property
+    def blocked_suffixes(self):
+        return self.index.suffixes
+
+    def load_config(self):
+        started = time.monotonic()
         if not os.path.exists(self.config_file):
             logger.warning(f"Config file '{self.config_file}' not found. No domains blocked.")
+            self._publish(BlocklistIndex(set(), set()), started)
             return
+        self._publish(self._build_index(), started)
+
+    def _build_index(self):
+        # runs on a worker thread during hot reloads, so it only reads self.config_file.
+        # the compiled snapshot when it is current, otherwise the text is parsed once and
+        # compiled. both sets are then read straight from the mmap'd snapshot
+        snapshot = open_snapshot(self.config_file)
+        source = "snapshot"
+        if snapshot is not None:
+            stamp = (snapshot.source_mtime, snapshot.source_size)
+        else:
+            source = self.config_file
+            stamp = source_stamp(self.config_file)
+            exact, suffixes, keywords = self._parse_config()
+            try:
+                write_snapshot(self.config_file, stamp, exact, suffixes, keywords)
+                snapshot = open_snapshot(self.config_file)
+            except OSError as e:
+                logger.warning(f"Couldn't write the blocklist snapshot, keeping it in memory: {e}")
+        if snapshot is not None:
+            exact, suffixes, keywords = snapshot.exact, snapshot.suffixes, snapshot.keywords()
+        rules = KeywordMatcher(keywords)
+
+        logger.info(f"Loaded {len(exact)} exact blocks, {len(suffixes)} suffix blocks and {len(rules)} url rules from {source}")
+        return BlocklistIndex(exact, suffixes, rules, snapshot, stamp)
+
+    def _publish(self, index, started):
+        # one reference swap, a lookup uses whichever generation it picked up first
+        self.index = index
+        self.generation += 1
+        self.last_reload_seconds = time.monotonic() - started
+        logger.info(f"Blocklist generation {self.generation} active, built in {self.last_reload_seconds:.3f}s")
+
+    def start_watching(self, interval=RELOAD_POLL):
+        # polls the file's mtime and size, a change is rebuilt on a thread and swapped in
+        if self._watcher is None:
+            self._watcher = asyncio.ensure_future(self._watch(interval))
 
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    async def _watch(self, interval):
+        loop = asyncio.get_running_loop()
+        pending = None
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                stamp = source_stamp(self.config_file)
+            except OSError:
+                # gone or halfway through being replaced, keep blocking with what we have
+                continue
+            if stamp == self.index.stamp:
+                pending = None
+                continue
+            if stamp != pending:
+                # only rebuild once the file has stopped changing for a poll, so a list
+                # being written out in place isn't loaded half done
+                pending = stamp
+                continue
+            pending = None
+            started = time.monotonic()
+            try:
+                index = await loop.run_in_executor(None, self._build_index)
+            except Exception as e:
+                self.reload_failures += 1
+                logger.warning(f"Blocklist reload failed, keeping generation {self.generation}: {e}")
+                continue
+            self._publish(index, started)
+
+    def _parse_config(self):
+        exact = set()
+        suffixes = set()
+        keywords = set()
         with open(self.config_file, 'r') as f:
             for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('~'):
+                    keyword = self._canonicalize_keyword(line[1:])
+                    if keyword:
+                        keywords.add(keyword)
+                    continue
                 entry = self._canonicalize(line) #canonicalization to remove whitespaces, case sensitivity and stuff
-                
-                if not entry or entry.startswith('#'):
+                if not entry:
                     continue
 
+                # no log line per entry, public blocklists run to a million lines
                 if entry.startswith('*.'):
-                    suffix = entry[2:] 
-                    self.blocked_suffixes.append(suffix)
-                    logger.info(f"Loaded suffix block: *.{suffix}")
+                    suffixes.add(entry[2:])
                 else:
-                    self.blocked_exact.add(entry)
-                    logger.info(f"Loaded exact block: {entry}")
+                    exact.add(entry)
+        return exact, suffixes, keywords
 
-        logger.info(f"Loaded {len(self.blocked_exact)} exact blocks and {len(self.blocked_suffixes)} suffix blocks")
+    def _canonicalize_keyword(self, keyword):
+        # any printable ascii without spaces, matched case-insensitively
+        keyword = keyword.strip().lower()
+        if not keyword or len(keyword) > MAX_KEYWORD_LENGTH or not all(33 <= ord(c) < 127 for c in keyword):
+            logger.warning(f"Rejected url rule: {repr(keyword)[:50]}")
+            return ""
+        return keyword
 
     def _canonicalize(self, hostname):
         if hostname is None:
             return ""
+        # fast path, hosts from requests and most list entries are clean already
+        bare = hostname[2:] if hostname.startswith('*.') else hostname
+        if len(hostname) <= MAX_HOSTNAME_LENGTH and HOSTNAME_RE.match(bare):
+            return hostname
         entry = hostname.strip().lower()
         
         if not entry:
@@ -57,15 +186,13 @@ class DomainFilter:
             logger.warning(f"Rejected config entry with invalid characters: {repr(hostname)[:50]}")
             return ""
 
-        MAX_HOSTNAME_LENGTH = 253
         if len(sanitized) > MAX_HOSTNAME_LENGTH:
             logger.warning(f"Rejected config entry exceeding max length: {sanitized[:50]}...")
             return ""
 
         check_part = sanitized[2:] if sanitized.startswith('*.') else sanitized
 
-        import re
-        if not re.match(r'^[a-z0-9]([a-z0-9\-\.]*[a-z0-9])?$|^[a-z0-9]$', check_part):
+        if not HOSTNAME_RE.match(check_part):
             parts = check_part.split('.')
             is_ip = len(parts) == 4 and all(p.isdigit() and 0 <= int(p) <= 255 for p in parts)
             if not is_ip:
@@ -74,32 +201,65 @@ class DomainFilter:
         
         return sanitized
 
-    def is_blocked(self, host):
+    def is_blocked(self, host, path=None):
+        # path is left out for CONNECT, url rules then only see the host
         if not host:
             return False
 
+        if ":" in host:
+            host = host.split(":", 1)[0]
         canonical_host = self._canonicalize(host)
+        if not canonical_host:
+            return False
 
-        if ":" in canonical_host:
-            canonical_host = canonical_host.split(":", 1)[0]
-
-        if canonical_host in self.blocked_exact:
+        index = self.index
+        if canonical_host in index.exact:
             logger.warning(f"BLOCKED (exact match): {canonical_host}")
             return True
 
-        for suffix in self.blocked_suffixes:
-            if canonical_host == suffix or canonical_host.endswith('.' + suffix):
-                logger.warning(f"BLOCKED (suffix match *.{suffix}): {canonical_host}")
+        suffix = self._match_suffix(canonical_host, index.suffixes)
+        if suffix is not None:
+            logger.warning(f"BLOCKED (suffix match *.{suffix}): {canonical_host}")
+            return True
+
+        if index.rules:
+            url = canonical_host + path.lower() if path else canonical_host
+            rule = index.rules.search(url)
+            if rule is not None:
+                logger.warning(f"BLOCKED (url rule ~{rule}): {url[:200]}")
                 return True
 
         return False
 
+    def _match_suffix(self, host, suffixes):
+        # the host itself, then each parent domain: a.b.example -> b.example -> example
+        start = 0
+        while True:
+            candidate = host[start:] if start else host
+            if candidate in suffixes:
+                return candidate
+            start = host.find('.', start) + 1
+            if not start:
+                return None
+
     def reload(self): 
         logger.info("Reloading domain filter configuration...")
         self.load_config()
-    # this is for editing blocked domains.txt file during runtime and not restarting the proxy
+    # this is for editing blocked domains.txt file during runtime and not restarting the proxy.
+    # it builds on the calling thread, the running proxy picks up edits through start_watching()
+
+    def get_stats(self):
+        index = self.index
+        return {
+            "generation": self.generation,
+            "exact": len(index.exact),
+            "suffixes": len(index.suffixes),
+            "rules": len(index.rules),
+            "last_reload_seconds": self.last_reload_seconds,
+            "reload_failures": self.reload_failures,
+        }
 
-def generate_blocked_response(headers=None):
+def generate_blocked_response(headers=None, keep_alive=False):
     user_agent = ""
     if headers:
         user_agent = headers.get("User-Agent", "").lower()
@@ -124,7 +284,7 @@ def generate_blocked_response(headers=None):
         b"HTTP/1.1 403 Forbidden\r\n"
         b"Content-Type: " + content_type + b"\r\n"
         b"Content-Length: " + str(len(body)).encode() + b"\r\n"
-        b"Connection: close\r\n"
+        b"Connection: " + (b"keep-alive" if keep_alive else b"close") + b"\r\n"
         b"\r\n"
     ) + body
 
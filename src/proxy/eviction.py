@@ -0,0 +1,194 @@
+# Eviction policies for LRUCache. A policy only tracks keys and sizes, the cache asks
+# it which keys to drop. Plain LRU is here for the simple case, W-TinyLFU keeps hot
+# objects through scans: new keys land in a small LRU window, and leaving it they have
+# to be requested more often than whatever they would push out of the main region,
+# counted by a small count-min sketch that halves itself now and then so old
+# popularity fades.
+
+from collections import OrderedDict
+from itertools import chain
+
+# share of the budget (entries and bytes) given to the window
+WINDOW_SHARE = 0.01
+# share of the main region for entries hit again after admission
+PROTECTED_SHARE = 0.8
+SKETCH_DEPTH = 4
+# counters saturate here, like the 4-bit ones in the paper
+MAX_COUNT = 15
+# multipliers picking each row's counter, odd 64-bit constants
+SKETCH_SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+MASK64 = (1 << 64) - 1
+HALVE = bytes(v >> 1 for v in range(256))
+
+
+class FrequencySketch:
+    # count-min sketch of how often keys were seen, one byte per counter
+
+    def __init__(self, expected_keys):
+        width = 1024
+        while width < expected_keys * 8:
+            width *= 2
+        self.width_bits = width.bit_length() - 1
+        self.width = width
+        self.table = bytearray(width * SKETCH_DEPTH)
+        # after this many increments every counter is halved
+        self.sample_size = width * 10
+        self.additions = 0
+
+    def _indexes(self, key):
+        h = hash(key) & MASK64
+        shift = 64 - self.width_bits
+        return [row * self.width + (((h ^ (h >> 31)) * seed & MASK64) >> shift)
+                for row, seed in enumerate(SKETCH_SEEDS)]
+
+    def frequency(self, key):
+        return min(self.table[i] for i in self._indexes(key))
+
+    def increment(self, key):
+        added = False
+        for i in self._indexes(key):
+            if self.table[i] < MAX_COUNT:
+                self.table[i] += 1
+                added = True
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self.table = bytearray(self.table.translate(HALVE))
+                self.additions //= 2
+
+
+class LRUPolicy:
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._order = OrderedDict()  # key -> size, least recently used first
+        self._bytes = 0
+
+    def on_insert(self, key, size):
+        # returns the keys the cache has to drop now
+        self._order[key] = size
+        self._bytes += size
+        evicted = []
+        while (len(self._order) > self.max_entries or self._bytes > self.max_bytes) and len(self._order) > 1:
+            victim, victim_size = self._order.popitem(last=False)
+            self._bytes -= victim_size
+            evicted.append(victim)
+        return evicted
+
+    def on_hit(self, key):
+        self._order.move_to_end(key)
+
+    def on_miss(self, key):
+        pass
+
+    def on_remove(self, key):
+        size = self._order.pop(key, None)
+        if size is not None:
+            self._bytes -= size
+
+
+class TinyLFUPolicy:
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.window_entries = max(1, int(max_entries * WINDOW_SHARE))
+        self.window_bytes = max(1, int(max_bytes * WINDOW_SHARE))
+        self.main_entries = max(1, max_entries - self.window_entries)
+        self.main_bytes = max(1, max_bytes - self.window_bytes)
+        self.protected_entries = max(1, int(self.main_entries * PROTECTED_SHARE))
+        self.protected_bytes = int(self.main_bytes * PROTECTED_SHARE)
+        self.sketch = FrequencySketch(max_entries)
+
+        # key -> size, least recently used first in each
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._sizes = {"window": 0, "probation": 0, "protected": 0}
+
+        # Stats
+        self.rejected = 0
+
+    def _segments(self):
+        return (("window", self._window), ("probation", self._probation), ("protected", self._protected))
+
+    def _add(self, name, segment, key, size):
+        segment[key] = size
+        self._sizes[name] += size
+
+    def _pop(self, name, segment, key):
+        size = segment.pop(key)
+        self._sizes[name] -= size
+        return size
+
+    def on_insert(self, key, size):
+        # not counted here, the lookup that missed before this insert already was
+        self._add("window", self._window, key, size)
+        evicted = []
+        # something too big for the window goes straight on to face the main region
+        while len(self._window) > self.window_entries or self._sizes["window"] > self.window_bytes:
+            candidate = next(iter(self._window))
+            candidate_size = self._pop("window", self._window, candidate)
+            if not self._admit(candidate, candidate_size, evicted):
+                self.rejected += 1
+                evicted.append(candidate)
+        return evicted
+
+    def _admit(self, candidate, size, evicted):
+        # the window's oldest key against the main region: it gets in only if it has been
+        # asked for more often than every key that has to leave to make room for it, so
+        # one big object can't push out lots of small popular ones
+        main_count = len(self._probation) + len(self._protected)
+        main_size = self._sizes["probation"] + self._sizes["protected"]
+        if size > self.main_bytes:
+            return False
+        victims = []
+        freed = 0
+        for victim in chain(self._probation, self._protected):
+            if main_count - len(victims) < self.main_entries and main_size - freed + size <= self.main_bytes:
+                break
+            victims.append(victim)
+            freed += self._probation[victim] if victim in self._probation else self._protected[victim]
+        if victims:
+            candidate_freq = self.sketch.frequency(candidate)
+            if any(self.sketch.frequency(victim) >= candidate_freq for victim in victims):
+                return False
+            for victim in victims:
+                self.on_remove(victim)
+                evicted.append(victim)
+        self._add("probation", self._probation, candidate, size)
+        return True
+
+    def on_hit(self, key):
+        self.sketch.increment(key)
+        if key in self._window:
+            self._window.move_to_end(key)
+        elif key in self._protected:
+            self._protected.move_to_end(key)
+        elif key in self._probation:
+            # asked for again after admission, into the protected segment. what it
+            # pushes out of there goes back to probation instead of being dropped
+            size = self._pop("probation", self._probation, key)
+            self._add("protected", self._protected, key, size)
+            while ((len(self._protected) > self.protected_entries
+                    or self._sizes["protected"] > self.protected_bytes) and len(self._protected) > 1):
+                demoted = next(iter(self._protected))
+                self._add("probation", self._probation, demoted, self._pop("protected", self._protected, demoted))
+
+    def on_miss(self, key):
+        # every request counts, also the ones for keys that aren't cached (yet). a key
+        # asked for often but turned away each time builds up the count to get in
+        self.sketch.increment(key)
+
+    def on_remove(self, key):
+        for name, segment in self._segments():
+            if key in segment:
+                self._pop(name, segment, key)
+                return
+
+
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "tinylfu": TinyLFUPolicy,
+}
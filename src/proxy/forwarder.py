@@ -1,61 +1,253 @@
 import asyncio
-from .http_parser import async_parse_http_request, HTTPRequest
+from .http_parser import (async_parse_http_request, HTTPRequest, HTTPParseError, StreamBuffer,
+                          HeaderLimits, READ_SIZE, encode_chunk, LAST_CHUNK, read_chunked_raw,
+                          header_value, body_framing, wants_keep_alive, strip_hop_by_hop,
+                          parse_response_head, response_has_body, build_response_head,
+                          find_head_end, remove_header)
 from .domain_filter import get_filter, generate_blocked_response
-from .http_cache import get_cache
+from .http_cache import get_cache, has_conditionals, CONDITIONAL_HEADERS
+from .background_refresh import get_refresher
+from .cache_compression import (accepts_gzip, prepare_stored_body, compress_response, inflate_response,
+                                stored_gzip_length, OFFLOAD_BYTES)
+from .byte_ranges import prepare_range_response
+from .connection_pool import get_pool
+from .collapsed_forwarding import get_collapser
+from .origin_scheduler import get_origin_scheduler
+from .splice_tunnel import TunnelStats, can_splice, splice_tunnel
+from .dns_resolver import open_connection
+from .timer_wheel import get_timer_wheel
 from .proxy_logger import get_logger, get_metrics
 
 # Socket timeout in seconds
 SOCKET_TIMEOUT = 45
+# how long an idle client keep-alive connection is held open between requests
+KEEPALIVE_TIMEOUT = 15
+MAX_KEEPALIVE_REQUESTS = 100
+# origins get the full socket timeout to start answering, and a bit more header room than clients
+RESPONSE_LIMITS = HeaderLimits(max_header_count=200, header_timeout=SOCKET_TIMEOUT)
+# a CONNECT tunnel with no bytes in either direction for this long gets closed
+TUNNEL_IDLE_TIMEOUT = 300
+TUNNEL_READ_SIZE = 64 * 1024
 
 
-def build_request_bytes(req):
+def build_request_bytes(req, extra_headers=None):
     request_line = f"{req.method} {req.path} {req.version}\r\n"
     headers = b""
 
-    for key, value in req.headers.items():
+    # the client's Connection/Proxy-* headers were meant for us, not the origin
+    for key, value in strip_hop_by_hop(req.headers).items():
+        headers += f"{key}: {value}\r\n".encode()
+    for key, value in (extra_headers or {}).items():
         headers += f"{key}: {value}\r\n".encode()
 
+    headers += b"Connection: keep-alive\r\n"
     headers += b"\r\n"
     return request_line.encode() + headers + req.body
 
 
-async def relay_and_capture(reader, writer):
-    response_bytes = b""
+def prepare_cached_response(response_bytes, method, keep_alive, age=None, accept_gzip=False):
+    # cached bytes carry the origin's connection headers, swap in our own for this client.
+    # they may be an mmap view from the disk tier, only the head gets copied
+    head_end = find_head_end(response_bytes)
+    head = bytes(memoryview(response_bytes)[:head_end])
+    version, status, reason, headers = parse_response_head(head)
+    if age is not None:
+        remove_header(headers, "Age")
+        headers["Age"] = str(age)
+    body = prepare_stored_body(headers, memoryview(response_bytes)[head_end + 4:], accept_gzip)
+    framed = (header_value(headers, "Content-Length") is not None
+              or "chunked" in header_value(headers, "Transfer-Encoding", "").lower())
+    if response_has_body(method, status) and not framed:
+        keep_alive = False
+    return build_response_head(version, status, reason, headers, keep_alive), body, keep_alive
+
+
+class RequestBodyError(HTTPParseError):
+    # the client's body broke its own framing, that is a 400 for the client and not the
+    # origin's fault
+    pass
+
+
+async def send_request_body(req, server_writer):
+    # streams the client body upstream as it arrives instead of buffering it first. each
+    # chunk is decoded, and so checked, before it is re-encoded, bad framing never goes out
     try:
+        async for chunk in req.iter_body(timeout=SOCKET_TIMEOUT):
+            server_writer.write(encode_chunk(chunk) if req.chunked else chunk)
+            await server_writer.drain()
+        if req.chunked:
+            server_writer.write(LAST_CHUNK)
+            await server_writer.drain()
+    except HTTPParseError as e:
+        server_writer.close()
+        raise RequestBodyError(str(e)) from e
+    except Exception:
+        # the origin would wait forever for the rest of the body, cut it off so the relay ends
+        server_writer.close()
+        raise
+
+
+class RelayResult:
+
+    def __init__(self):
+        self.status = 0
+        self.response_bytes = None  # only set when the response was captured for the cache
+        self.bytes_sent = 0
+        self.head_sent = False
+        self.complete = False  # the response ended exactly where its framing said
+        self.origin_keep_alive = False
+        self.client_keep_alive = False
+        self.revalidating = None  # stale cache entry the request asks the origin about
+        self.not_modified = None  # the 304's headers when the origin said it's still good
+        self.stale_if_error = None  # stale cache entry to serve if the origin fails
+        self.origin_failed = False  # the origin answered with a 5xx that wasn't passed on
+
+
+class DiscardWriter:
+    # stands in for the client when nobody is waiting for the response, like a background refresh
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+
+async def relay_and_capture(server, writer, req, keep_alive, result, flight=None):
+    # relays one response, reading only as far as its framing goes so the upstream
+    # connection can be reused and nothing waits on the origin to close.
+    # with a flight, collapsed followers get the body bytes as well
+    method = req.method
+    captured = None
+    captured_size = 0
+    client_error = None
+
+    async def send(data):
+        nonlocal captured, captured_size, client_error
+        if flight is not None and result.head_sent:
+            flight.feed(data)
+        if client_error is None:
+            try:
+                writer.write(data)
+                await writer.drain()
+                result.bytes_sent += len(data)
+            except ConnectionError as e:
+                # our client left, but followers still need the rest of the response
+                if flight is None or not flight.followers or flight.failed:
+                    raise
+                client_error = e
+        if captured is not None:
+            # chunks are kept by reference and joined once at the end, and dropped
+            # as soon as the response grows past what the cache would accept
+            captured_size += len(data)
+            if captured_size > cache.max_object_bytes:
+                captured = None
+                if flight is not None:
+                    # followers already streaming keep getting it, new ones fetch for themselves
+                    flight.stop_buffering()
+            else:
+                captured.append(data)
+
+    while True:
+        head = await server.read_headers(RESPONSE_LIMITS)
+        if not head:
+            raise ConnectionResetError("Origin closed the connection before responding")
+        version, status, reason, headers = parse_response_head(head)
+        if status == 101:
+            raise HTTPParseError("Protocol upgrade not supported", 502, "Bad Gateway")
+        if status < 200:
+            # interim responses like 100 Continue go straight through, the final one follows
+            writer.write(head + b"\r\n\r\n")
+            await writer.drain()
+            continue
+        break
+
+    if status == 304 and result.revalidating is not None:
+        # the answer to our own conditional request, the client gets the cached copy instead
+        result.status = status
+        result.not_modified = headers
+        result.origin_keep_alive = wants_keep_alive(version, headers)
+        result.client_keep_alive = keep_alive
+        result.complete = True
+        return None
+
+    if status >= 500 and result.stale_if_error is not None:
+        # the origin is failing, the client gets the stale copy instead. the body is never
+        # read, so the connection can't go back to the pool
+        result.status = status
+        result.origin_failed = True
+        result.client_keep_alive = keep_alive
+        return None
+
+    has_body = response_has_body(method, status)
+    content_length, chunked = body_framing(headers, response=True)
+    framed = not has_body or chunked or content_length is not None
+
+    result.status = status
+    result.origin_keep_alive = framed and wants_keep_alive(version, headers)
+    result.client_keep_alive = keep_alive and framed
+
+    # the headers decide whether the body is worth keeping before any of it is read
+    cache = get_cache()
+    if cache.should_capture(method, req.headers, status, headers):
+        if content_length is None or content_length <= cache.max_object_bytes:
+            captured = []
+    if flight is not None:
+        # only what the cache would keep is shared, anything else followers fetch themselves
+        flight.start(version, status, reason, headers, framed, captured is not None)
+
+    await send(build_response_head(version, status, reason, headers, result.client_keep_alive))
+    result.head_sent = True
+
+    if not has_body:
+        pass
+    elif chunked:
+        async for data in read_chunked_raw(server, SOCKET_TIMEOUT):
+            await send(data)
+    elif content_length is not None:
+        remaining = content_length
+        while remaining:
+            data = await server.read(min(remaining, READ_SIZE), SOCKET_TIMEOUT)
+            if not data:
+                raise ConnectionResetError("Origin closed the connection mid-response")
+            remaining -= len(data)
+            await send(data)
+    else:
         while True:
-            data = await asyncio.wait_for(reader.read(4096), timeout=SOCKET_TIMEOUT)
+            data = await server.read(READ_SIZE, SOCKET_TIMEOUT)
             if not data:
                 break
-            writer.write(data)
-            await writer.drain()
-            response_bytes += data
-    except asyncio.TimeoutError:
-        pass
-    return response_bytes
+            await send(data)
+
+    result.complete = True
+    if server.buf:
+        # bytes past the end of the response, the origin is out of sync with us
+        result.origin_keep_alive = False
+    if captured is not None:
+        result.response_bytes = b"".join(captured)
+    if client_error is not None:
+        raise client_error
+    return result.response_bytes
 
 
-async def pipe(reader, writer):
+async def pipe(reader, writer, stats, upstream):
+    # no timeout of its own, the tunnel's idle deadline cancels both directions at once
     try:
         while True:
-            try:
-                data = await asyncio.wait_for(reader.read(4096), timeout=5.0)
-                if not data:
-                    break
-                
-                writer.write(data)
-                await writer.drain()
-# error handling dhyan se karna hai
-            except asyncio.TimeoutError:
-                continue
-            except (ConnectionResetError, BrokenPipeError, ConnectionAbortedError):
+            data = await reader.read(TUNNEL_READ_SIZE)
+            if not data:
                 break
-    except asyncio.CancelledError:
-        raise
+            writer.write(data)
+            await writer.drain()
+            stats.add(len(data), upstream)
+# error handling dhyan se karna hai
+    except (ConnectionResetError, BrokenPipeError, ConnectionAbortedError):
+        pass
         
 # CONNECT is just a http request like GET 
 # basically we create a passage/tunnel b/w the client and the server for https request forwarding as https is obv protected
 # also in here no caching would be implemented as after CONNECT is established, the raw bytes which the proxy server receives are encrypted due to https and hence no caching possible 
-async def handle_connect(client_reader, client_writer, req, client_addr):
+async def handle_connect(client_reader, client_writer, req, client_addr, early_data=b""):
     logger = get_logger()
     metrics = get_metrics()
     domain_filter = get_filter()
@@ -74,7 +266,7 @@ async def handle_connect(client_reader, client_writer, req, client_addr):
 
     try:
         server_reader, server_writer = await asyncio.wait_for(
-            asyncio.open_connection(req.host, req.port),
+            open_connection(req.host, req.port),
             timeout=SOCKET_TIMEOUT
         )
     except Exception:
@@ -88,16 +280,33 @@ async def handle_connect(client_reader, client_writer, req, client_addr):
 
     client_writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
     await client_writer.drain()
+    # bytes the client sent right behind the CONNECT headers belong to the tunnel
+    if early_data:
+        server_writer.write(early_data)
+        await server_writer.drain()
     logger.log_request(client_addr, req.host, req.port, request_line, "ALLOWED", 200, 0)
     metrics.record_request(req.host)
 
-    try:
-        await asyncio.gather(
-            pipe(client_reader, server_writer),
-            pipe(server_reader, client_writer),
+    # the kernel-side splice path when the platform allows it, plain pipe() otherwise
+    stats = TunnelStats()
+    if can_splice(client_reader, client_writer, server_reader, server_writer):
+        tunnel = asyncio.ensure_future(splice_tunnel(client_writer, server_writer, stats))
+    else:
+        tunnel = asyncio.gather(
+            pipe(client_reader, server_writer, stats, True),
+            pipe(server_reader, client_writer, stats, False),
             return_exceptions=True
         )
+    # one deadline for both directions, traffic either way pushes it out
+    stats.deadline = get_timer_wheel().register(TUNNEL_IDLE_TIMEOUT, tunnel.cancel)
+    try:
+        await tunnel
+    except asyncio.CancelledError:
+        if not stats.deadline.expired:
+            raise
     finally:
+        stats.deadline.cancel()
+        metrics.record_tunnel(stats.bytes_up, stats.bytes_down, stats.spliced)
         try:
             server_writer.close()
             await server_writer.wait_closed()
@@ -112,113 +321,335 @@ async def handle_connect(client_reader, client_writer, req, client_addr):
 
 # handling http -> 2 ways either find the request in cache or else we can just forward it to the server, easier just need to get the await right
 
-async def handle_http(client_reader, client_writer, req, client_addr):
+# returns True when the client connection can carry another request
+
+async def handle_http(client_reader, client_writer, req, client_addr, keep_alive=False):
     logger = get_logger()
     metrics = get_metrics()
     cache = get_cache()
     request_line = f"{req.method} {req.target} {req.version}"
 
-    cached = cache.get(req.method, req.host, req.path, req.headers)
-    if cached:
-        client_writer.write(cached.response_bytes)
-        await client_writer.drain()
-        client_writer.close()
-        await client_writer.wait_closed()
-        logger.log_request(client_addr, req.host, req.port, request_line, "CACHED", 200, len(cached.response_bytes))
-        metrics.record_request(req.host)
-        return
+    cached = cache.get(req.method, req.host, req.path, req.headers, allow_stale=True)
+    if cached is not None and cached.is_fresh():
+        return await send_cached(client_writer, req, client_addr, cached, keep_alive)
+    if cached is not None and cached.within_grace(cached.stale_while_revalidate):
+        # just gone stale: this client gets it as is, and it's refreshed off the request path
+        key = cache.collapse_key(req.method, req.host, req.path, req.headers)
+        get_refresher().schedule(key, lambda: refresh_entry(req, client_addr, cached))
+        return await send_cached(client_writer, req, client_addr, cached, keep_alive, "STALE")
 
-    try:
-        server_reader, server_writer = await asyncio.wait_for(
-            asyncio.open_connection(req.host, req.port),
-            timeout=SOCKET_TIMEOUT
-        )
-    except Exception:
-        client_writer.write(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")
-        await client_writer.drain()
-        client_writer.close()
-        await client_writer.wait_closed()
-        logger.log_request(client_addr, req.host, req.port, request_line, "ALLOWED", 502, 0)
-        metrics.record_request(req.host)
-        return
+    # identical cacheable misses ride along on a fetch that is already running
+    collapser = get_collapser()
+    # a Range request's 206 can't be shared, so it never leads or follows a fetch
+    key = (None if req.has_body() or header_value(req.headers, "Range") is not None
+           else cache.collapse_key(req.method, req.host, req.path, req.headers))
+    flight = None
+    if key is not None:
+        joined = collapser.join(key)
+        if joined is not None:
+            try:
+                outcome = await collapser.follow(joined, client_writer, keep_alive, req.headers)
+            except Exception as e:
+                status = 504 if isinstance(e, asyncio.TimeoutError) else 502
+                logger.log_request(client_addr, req.host, req.port, request_line, "COLLAPSED", status, 0)
+                metrics.record_request(req.host)
+                return False
+            if outcome is not None:
+                status, bytes_sent, keep_alive = outcome
+                logger.log_request(client_addr, req.host, req.port, request_line, "COLLAPSED", status, bytes_sent)
+                metrics.record_request(req.host)
+                return keep_alive
+            # the leader may have just revalidated the entry instead of fetching a body
+            cached = cache.get(req.method, req.host, req.path, req.headers, allow_stale=True)
+            if cached is not None and cached.is_fresh():
+                return await send_cached(client_writer, req, client_addr, cached, keep_alive)
+        flight = collapser.lead(key, req.headers)
 
+    result = RelayResult()
+    # a stale copy with an ETag or Last-Modified is revalidated instead of re-downloaded,
+    # unless the client is asking conditionally itself
+    if cached is not None and not has_conditionals(req.headers):
+        result.revalidating = cached
+    if cached is not None and cached.within_grace(cached.stale_if_error):
+        result.stale_if_error = cached
     try:
-        request_bytes = build_request_bytes(req)
-        server_writer.write(request_bytes)
-        await server_writer.drain()
+        return await fetch_upstream(client_writer, req, client_addr, keep_alive, result, flight)
+    finally:
+        if flight is not None:
+            collapser.end(flight, result.complete)
 
-        response_bytes = await relay_and_capture(server_reader, client_writer)
 
-        cache.put(req.method, req.host, req.path, req.headers, response_bytes)
+def prepare_cached(entry, req, keep_alive, accept_gzip):
+    # (status, head, body pieces, keep_alive) for sending entry to this client
+    partial = prepare_range_response(entry.response_bytes, req.headers, keep_alive, entry.get_age())
+    if partial is not None:
+        # a Range request, cut out of the stored body
+        status, head, pieces = partial
+        return status, head, pieces, keep_alive
+    head, body, keep_alive = prepare_cached_response(
+        entry.response_bytes, req.method, keep_alive, entry.get_age(), accept_gzip)
+    return entry.status_code, head, [body], keep_alive
 
-        logger.log_request(client_addr, req.host, req.port, request_line, "ALLOWED", 200, len(response_bytes))
-        metrics.record_request(req.host)
+
+async def off_loop(size, func, *args):
+    # zlib work on more than OFFLOAD_BYTES goes to a worker thread, a few MB of it on the
+    # event loop would hold up every other connection
+    if size > OFFLOAD_BYTES:
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+    return func(*args)
+
+
+async def send_cached(client_writer, req, client_addr, entry, keep_alive, action="CACHED"):
+    keep_alive = keep_alive and req.body_complete
+    accept_gzip = accepts_gzip(req.headers)
+    plain_length = stored_gzip_length(entry.headers)
+    if plain_length is not None and header_value(req.headers, "Range") is not None:
+        # ranges count bytes of the plain body. a stored gzip is inflated once for them
+        # and kept plain from then on
+        response_bytes, headers = await off_loop(plain_length, inflate_response, entry.response_bytes)
+        entry = get_cache().keep_plain(req.method, req.host, req.path, req.headers, entry, response_bytes, headers)
+        plain_length = None
+    inflating = plain_length is not None and not accept_gzip
+    status, head, pieces, keep_alive = await off_loop(
+        plain_length if inflating else 0, prepare_cached, entry, req, keep_alive, accept_gzip)
+    client_writer.write(head)
+    for piece in pieces:
+        client_writer.write(piece)
+    await client_writer.drain()
+    get_logger().log_request(client_addr, req.host, req.port, f"{req.method} {req.target} {req.version}",
+                             action, status, len(head) + sum(len(piece) for piece in pieces))
+    get_metrics().record_request(req.host)
+    return keep_alive
+
+
+async def refresh_entry(req, client_addr, entry):
+    # fetches a stale entry again with nobody waiting on the response. the client's own
+    # conditional and Range headers stay out of it, the answer is for the cache and not
+    # for them, and a 206 couldn't be stored anyway
+    headers = dict(req.headers)
+    for name in CONDITIONAL_HEADERS + ("Range",):
+        remove_header(headers, name)
+    refresh = HTTPRequest(req.method, req.target, req.path, req.version, headers, b"", req.host, req.port)
+    result = RelayResult()
+    if entry.has_validators():
+        result.revalidating = entry
+    await fetch_upstream(DiscardWriter(), refresh, client_addr, False, result)
+
+
+async def fetch_upstream(client_writer, req, client_addr, keep_alive, result, flight=None):
+    # a slot for the origin first, so one slow or busy host can't take every upstream socket
+    scheduler = get_origin_scheduler()
+    try:
+        await scheduler.acquire(req.host, req.port)
     except asyncio.TimeoutError:
-        logger.log_request(client_addr, req.host, req.port, request_line, "ALLOWED", 504, 0)
-    except Exception:
-        pass
-    finally:
-        try:
-            server_writer.close()
-            await server_writer.wait_closed()
-        except Exception:
-            pass
+        if result.stale_if_error is not None:
+            return await send_cached(client_writer, req, client_addr, result.stale_if_error, keep_alive, "STALE")
         try:
-            client_writer.close()
-            await client_writer.wait_closed()
+            client_writer.write(b"HTTP/1.1 504 Gateway Timeout\r\n\r\n")
+            await client_writer.drain()
         except Exception:
             pass
+        get_logger().log_request(client_addr, req.host, req.port, f"{req.method} {req.target} {req.version}",
+                                 "ALLOWED", 504, 0)
+        get_metrics().record_request(req.host)
+        return False
+    try:
+        return await _forward_with_retry(client_writer, req, client_addr, keep_alive, result, flight)
+    finally:
+        scheduler.release(req.host, req.port)
 
 
-async def handle_client(reader, writer):
+async def _forward_with_retry(client_writer, req, client_addr, keep_alive, result, flight):
     logger = get_logger()
     metrics = get_metrics()
-    domain_filter = get_filter()
+    cache = get_cache()
+    request_line = f"{req.method} {req.target} {req.version}"
+
+    pool = get_pool()
+    for attempt in range(2):
+        try:
+            conn = await pool.acquire(req.host, req.port, SOCKET_TIMEOUT, fresh=attempt > 0)
+        except Exception:
+            if result.stale_if_error is not None:
+                return await send_cached(client_writer, req, client_addr, result.stale_if_error, keep_alive, "STALE")
+            client_writer.write(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")
+            await client_writer.drain()
+            logger.log_request(client_addr, req.host, req.port, request_line, "ALLOWED", 502, 0)
+            metrics.record_request(req.host)
+            return False
+
+        try:
+            await forward_request(conn, req, client_writer, keep_alive, result, flight)
+            break
+        except RequestBodyError as e:
+            pool.release(conn, False)
+            try:
+                client_writer.write(f"HTTP/1.1 {e.status} {e.reason}\r\n\r\n".encode())
+                await client_writer.drain()
+            except Exception:
+                pass
+            logger.log_request(client_addr, req.host, req.port, request_line, "ALLOWED", e.status, 0)
+            metrics.record_request(req.host)
+            return False
+        except Exception as e:
+            pool.release(conn, False)
+            # the origin may have dropped a pooled connection just as we picked it up,
+            # a request without a body is safe to replay once on a fresh one
+            if (conn.reused and not result.head_sent and not req.has_body()
+                    and not isinstance(e, asyncio.TimeoutError)):
+                continue
+            if result.stale_if_error is not None and not result.head_sent:
+                # stale-if-error: a stale copy beats an error page
+                return await send_cached(client_writer, req, client_addr, result.stale_if_error, keep_alive, "STALE")
+            status = 504 if isinstance(e, asyncio.TimeoutError) else 502
+            if not result.head_sent:
+                try:
+                    reason = "Gateway Timeout" if status == 504 else "Bad Gateway"
+                    client_writer.write(f"HTTP/1.1 {status} {reason}\r\n\r\n".encode())
+                    await client_writer.drain()
+                except Exception:
+                    pass
+            logger.log_request(client_addr, req.host, req.port, request_line, "ALLOWED", status, result.bytes_sent)
+            metrics.record_request(req.host)
+            return False
+
+    if result.origin_failed:
+        return await send_cached(client_writer, req, client_addr, result.stale_if_error, keep_alive, "STALE")
+
+    if result.not_modified is not None:
+        entry = cache.refresh(req.method, req.host, req.path, req.headers,
+                              result.revalidating, result.not_modified)
+        return await send_cached(client_writer, req, client_addr, entry, keep_alive, "REVALIDATED")
+
+    if result.response_bytes is not None:
+        response_bytes = result.response_bytes
+        if cache.compress_level:
+            response_bytes = await off_loop(len(response_bytes), compress_response,
+                                            response_bytes, cache.compress_level)
+        cache.put(req.method, req.host, req.path, req.headers, response_bytes, False)
 
+    logger.log_request(client_addr, req.host, req.port, request_line, "ALLOWED", result.status, result.bytes_sent)
+    metrics.record_request(req.host)
+    return result.client_keep_alive
+
+
+async def forward_request(conn, req, client_writer, keep_alive, result, flight=None):
+    server = StreamBuffer(conn.reader)
+    conditions = result.revalidating.conditional_headers() if result.revalidating is not None else None
+    conn.writer.write(build_request_bytes(req, conditions))
+    await conn.writer.drain()
+
+    # upload and response run side by side, so 100-continue and early error replies get through
+    relay = relay_and_capture(server, client_writer, req, keep_alive, result, flight)
+    upload_ok = True
+    if req.has_body():
+        upload_ok = await relay_beside_upload(relay, send_request_body(req, conn.writer), result)
+    else:
+        await relay
+
+    # an unfinished upload leaves body bytes on both sockets, neither can carry another request
+    result.client_keep_alive = result.client_keep_alive and req.body_complete
+    get_pool().release(conn, result.origin_keep_alive and upload_ok)
+
+
+async def relay_beside_upload(relay, upload, result):
+    # true when the whole request body went up
+    relay = asyncio.ensure_future(relay)
+    upload = asyncio.ensure_future(upload)
+    upload_ok = False
+    try:
+        await asyncio.wait((relay, upload), return_when=asyncio.FIRST_COMPLETED)
+        # a broken client body ends it with a 400, unless the origin already answers.
+        # the upstream socket was closed along with it, whatever the relay ran into
+        # after that is not the origin's doing
+        if (not result.head_sent and upload.done() and not upload.cancelled()
+                and isinstance(upload.exception(), RequestBodyError)):
+            raise upload.exception()
+        await relay
+    finally:
+        if not relay.done():
+            relay.cancel()
+        elif not relay.cancelled():
+            relay.exception()
+        if not upload.done():
+            upload.cancel()
+        elif not upload.cancelled():
+            upload_ok = upload.exception() is None
+    return upload_ok
+
+
+async def handle_client(reader, writer):
     client_addr = writer.get_extra_info('peername')
     if client_addr is None:
         client_addr = ('unknown', 0)
 
+    # one buffer for the whole connection, pipelined requests wait in it and are
+    # answered strictly in order since each one is finished before the next is parsed
+    buffer = StreamBuffer(reader)
+    served = 0
     try:
-        req = await asyncio.wait_for(
-            async_parse_http_request(reader),
-            timeout=SOCKET_TIMEOUT
-        )
+        while served < MAX_KEEPALIVE_REQUESTS:
+            if served and not await buffer.wait_for_data(KEEPALIVE_TIMEOUT):
+                break
+            served += 1
+            if not await handle_request(buffer, reader, writer, client_addr, served):
+                break
+    finally:
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def handle_request(buffer, reader, writer, client_addr, served):
+    logger = get_logger()
+    metrics = get_metrics()
+    domain_filter = get_filter()
+
+    try:
+        # only the headers are read here, and those are bounded by the header timeout
+        req = await async_parse_http_request(buffer)
     except asyncio.TimeoutError:
         try:
             writer.write(b"HTTP/1.1 408 Request Timeout\r\n\r\n")
             await writer.drain()
         except Exception:
             pass
-        writer.close()
-        await writer.wait_closed()
         logger.log_request(client_addr, "unknown", 0, "TIMEOUT", "ALLOWED", 408, 0)
-        return
+        return False
+    except HTTPParseError as e:
+        try:
+            writer.write(f"HTTP/1.1 {e.status} {e.reason}\r\n\r\n".encode())
+            await writer.drain()
+        except Exception:
+            pass
+        logger.log_request(client_addr, "unknown", 0, "INVALID REQUEST", "ALLOWED", e.status, 0)
+        return False
     except Exception:
         try:
             writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
             await writer.drain()
         except Exception:
             pass
-        writer.close()
-        await writer.wait_closed()
         logger.log_request(client_addr, "unknown", 0, "INVALID REQUEST", "ALLOWED", 400, 0)
-        return
+        return False
 
     request_line = f"{req.method} {req.target} {req.version}"
+    keep_alive = wants_keep_alive(req.version, req.headers) and served < MAX_KEEPALIVE_REQUESTS
 
-    if domain_filter.is_blocked(req.host):
-        response = generate_blocked_response(req.headers)
+    if domain_filter.is_blocked(req.host, req.path):
+        # an unread request body would be parsed as the next request, so close in that case
+        keep_alive = keep_alive and req.body_complete and req.method.upper() != "CONNECT"
+        response = generate_blocked_response(req.headers, keep_alive)
         writer.write(response)
         await writer.drain()
-        writer.close()
-        await writer.wait_closed()
         logger.log_request(client_addr, req.host, req.port, request_line, "BLOCKED", 403, len(response))
         metrics.record_request(req.host, blocked=True)
-        return
+        return keep_alive
 
     # simple if else for http and connect reqs
     if req.method.upper() == "CONNECT":
-        await handle_connect(reader, writer, req, client_addr)
-    else:
-        await handle_http(reader, writer, req, client_addr)
\ No newline at end of file
+        await handle_connect(reader, writer, req, client_addr, buffer.take_buffered())
+        return False
+    return await handle_http(reader, writer, req, client_addr, keep_alive)
@@ -1,41 +1,209 @@
+import heapq
+import itertools
 import time
 import threading
-from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from .disk_cache import DiskCache, MAX_DISK_BYTES
+from .cache_compression import compress_response
+from .eviction import EVICTION_POLICIES
+from .timer_wheel import get_timer_wheel
+from .http_parser import (find_head_end, header_value, remove_header, parse_response_head,
+                          HOP_BY_HOP_HEADERS)
+
+# a disk hit is served straight from the mmap, it only gets copied into RAM once it
+# has been hit this many times on disk
+PROMOTE_AFTER_HITS = 2
+# separates the parts of a variant key: the URL key, the header names the response
+# varied on, then each of the request's values for them. header values never contain it
+VARY_SEPARATOR = "\n"
+# a 304 never updates these on the stored response (RFC 7234 section 4.3.4)
+NOT_MODIFIED_SKIP = HOP_BY_HOP_HEADERS | {"content-length", "transfer-encoding"}
+# how long past its freshness an entry may still be served (RFC 5861) when the origin
+# doesn't say: while it is refreshed in the background, and when the origin is failing
+STALE_WHILE_REVALIDATE = 30
+STALE_IF_ERROR = 300
+# the sweeper looks for expired entries this often, taking at most a batch per lock hold
+SWEEP_INTERVAL = 1
+SWEEP_BATCH = 64
+CONDITIONAL_HEADERS = ("If-None-Match", "If-Modified-Since", "If-Match", "If-Unmodified-Since", "If-Range")
+
+
+def cache_directives(headers):
+    # Cache-Control as {directive: value or None}
+    directives = {}
+    for part in header_value(headers, "Cache-Control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip().strip('"') or None
+    return directives
+
+
+def parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers, default_ttl):
+    # RFC 7234 section 4.2.1, as a shared cache: s-maxage, then max-age, then Expires.
+    # without any of them the configured TTL stands in for a heuristic
+    directives = cache_directives(headers)
+    if "no-cache" in directives:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            lifetime = _seconds(directives[name])
+            if lifetime is not None:
+                return lifetime
+    if header_value(headers, "Expires") is not None:
+        expires = parse_http_date(header_value(headers, "Expires"))
+        date = parse_http_date(header_value(headers, "Date")) or time.time()
+        # an unparseable Expires means already expired
+        return max(0, expires - date) if expires is not None else 0
+    return default_ttl
+
+
+def stale_windows(headers):
+    # (stale-while-revalidate, stale-if-error) seconds. must-revalidate and friends
+    # forbid serving it stale at all
+    directives = cache_directives(headers)
+    if {"must-revalidate", "proxy-revalidate", "no-cache", "s-maxage"} & set(directives):
+        return 0, 0
+    windows = []
+    for name, default in (("stale-while-revalidate", STALE_WHILE_REVALIDATE), ("stale-if-error", STALE_IF_ERROR)):
+        seconds = _seconds(directives.get(name)) if name in directives else None
+        windows.append(default if seconds is None else seconds)
+    return tuple(windows)
+
+
+def has_conditionals(request_headers):
+    return any(header_value(request_headers, name) is not None for name in CONDITIONAL_HEADERS)
 
 
 class CacheEntry:
     
-    def __init__(self, response_bytes, headers, status_code):
+    def __init__(self, response_bytes, headers, status_code, default_ttl=300, stored_at=None):
         self.response_bytes = response_bytes
         self.headers = headers
         self.status_code = status_code
-        self.timestamp = time.time()
+        self.timestamp = time.time() if stored_at is None else stored_at
         self.content_length = len(response_bytes)
         self.hits = 0
+        self.on_disk = False  # the disk tier already has this exact version
+        self.freshness_lifetime = freshness_lifetime(headers, default_ttl)
+        # age when we got it: the origin's (or an upstream cache's) Age, or how far
+        # its Date lags behind us, whichever is larger (RFC 7234 section 4.2.3)
+        age = _seconds(header_value(headers, "Age")) or 0
+        date = parse_http_date(header_value(headers, "Date"))
+        if date is not None:
+            age = max(age, self.timestamp - date)
+        self.initial_age = age
+        self.stale_while_revalidate, self.stale_if_error = stale_windows(headers)
     
-    def is_fresh(self, max_age=300):
-        return (time.time() - self.timestamp) < max_age
+    def is_fresh(self):
+        return self.current_age() < self.freshness_lifetime
+
+    def within_grace(self, window):
+        # stale, but by less than window seconds
+        return self.current_age() < self.freshness_lifetime + window
+
+    def expires_at(self):
+        # when it's no use any more, not even stale. None when it can always be revalidated
+        if self.has_validators():
+            return None
+        grace = max(self.stale_while_revalidate, self.stale_if_error)
+        return self.timestamp - self.initial_age + self.freshness_lifetime + grace
+
+    def worth_keeping(self):
+        # a stale entry is still good for a revalidation or for being served in its grace windows
+        return (self.has_validators()
+                or self.within_grace(max(self.stale_while_revalidate, self.stale_if_error)))
+
+    def current_age(self):
+        return self.initial_age + (time.time() - self.timestamp)
     
     def get_age(self):
-        return int(time.time() - self.timestamp)
+        return int(self.current_age())
+
+    def has_validators(self):
+        return (header_value(self.headers, "ETag") is not None
+                or header_value(self.headers, "Last-Modified") is not None)
+
+    def conditional_headers(self):
+        # what to send upstream to ask whether this copy is still good
+        conditions = {}
+        etag = header_value(self.headers, "ETag")
+        if etag is not None:
+            conditions["If-None-Match"] = etag
+        last_modified = header_value(self.headers, "Last-Modified")
+        if last_modified is not None:
+            conditions["If-Modified-Since"] = last_modified
+        return conditions
 
 
 class LRUCache:
     
-    def __init__(self, max_entries=100, max_size_bytes=50*1024*1024, default_ttl=300):
-        self._cache = OrderedDict()  # OrderedDict provides LRU behavior
+    def __init__(self, max_entries=100, max_size_bytes=50*1024*1024, default_ttl=300,
+                 max_object_bytes=5*1024*1024, disk_dir=None, disk_max_bytes=MAX_DISK_BYTES,
+                 compress_level=0, eviction="tinylfu"):
+        self._cache = {}  # key -> CacheEntry, the eviction policy keeps the order
         self._lock = threading.RLock()
         self.max_entries = max_entries
         self.max_size_bytes = max_size_bytes
+        # anything bigger is never captured, one huge download would flush the whole cache
+        self.max_object_bytes = min(max_object_bytes, max_size_bytes)
         self.default_ttl = default_ttl
+        self.eviction = eviction
+        self.policy = EVICTION_POLICIES[eviction](max_entries, max_size_bytes)
+        # zlib level text-like bodies are stored gzipped at, 0 keeps them as they came
+        self.compress_level = compress_level
         self._current_size = 0
+        # optional second tier, entries leaving RAM are demoted to it
+        self.disk = DiskCache(disk_dir, disk_max_bytes) if disk_dir else None
+        # (expires at, seq, key, entry) for every entry in RAM that can expire. replaced
+        # and evicted entries are skipped when they come up instead of being searched for
+        self._expiry = []
+        self._expiry_seq = itertools.count()
+        self._sweeper = None
+        # URL key -> request header names its last response varied on
+        self._vary = {}
+        if self.disk is not None:
+            for key in self.disk.keys():
+                self._remember_vary(key)
         
         # Stats
         self.hits = 0
         self.misses = 0
+        self.revalidated = 0
+        self.expired = 0
     
     def _normalize_key(self, method, host, path):
         return f"{method.upper()}:{host.lower()}{path}"
+
+    def _variant_key(self, key, request_headers, vary=None):
+        # the URL key plus the values of the request headers the response varies on
+        names = self._vary.get(key) if vary is None else vary
+        if not names:
+            return key
+        values = VARY_SEPARATOR.join(header_value(request_headers, name, "").strip() for name in names)
+        return f"{key}{VARY_SEPARATOR}{','.join(names)}{VARY_SEPARATOR}{values}"
+
+    def _remember_vary(self, variant_key):
+        # rebuilds the vary map from the keys found on disk at startup. the names are kept
+        # as they are in the key, the values (cookies, anything) are never parsed
+        parts = variant_key.split(VARY_SEPARATOR, 2)
+        if len(parts) == 3:
+            self._vary[parts[0]] = parts[1].split(",")
     
     def _is_cacheable_request(self, method, headers):
         if method.upper() != "GET":
@@ -51,15 +219,31 @@ class LRUCache:
         return True
     
     def _is_cacheable_response(self, status_code, response_headers):
-        if status_code not in (200, 301, 302, 304):
+        # a 304 only means something to the client that asked conditionally, it's never stored
+        if status_code not in (200, 301, 302):
             return False
         
         cache_control = response_headers.get("Cache-Control", "").lower()
         if "no-store" in cache_control or "private" in cache_control:
             return False
+
+        if header_value(response_headers, "Vary", "").strip() == "*":
+            return False
         
         return True
     
+    def should_capture(self, method, request_headers, status_code, response_headers):
+        # lets the relay decide from the response headers alone whether to keep a copy
+        return (self._is_cacheable_request(method, request_headers)
+                and self._is_cacheable_response(status_code, response_headers))
+
+    def collapse_key(self, method, host, path, request_headers):
+        # requests that would share a cache entry can share one upstream fetch too
+        if not self._is_cacheable_request(method, request_headers):
+            return None
+        with self._lock:
+            return self._variant_key(self._normalize_key(method, host, path), request_headers)
+
     def _parse_response_headers(self, response_bytes):
         try:
             header_end = response_bytes.find(b"\r\n\r\n")
@@ -85,43 +269,118 @@ class LRUCache:
         except Exception:
             return None, {}, response_bytes
     
-    def _evict_if_needed(self):
-        while len(self._cache) >= self.max_entries:
-            oldest_key, oldest_entry = self._cache.popitem(last=False)
-            self._current_size -= oldest_entry.content_length
-        
-        while self._current_size > self.max_size_bytes and self._cache:
-            oldest_key, oldest_entry = self._cache.popitem(last=False)
-            self._current_size -= oldest_entry.content_length
+    def _insert(self, key, entry):
+        # the policy may turn the new entry away at once, then it only goes to the disk tier
+        self._cache[key] = entry
+        self._current_size += entry.content_length
+        expires_at = entry.expires_at()
+        if expires_at is not None:
+            heapq.heappush(self._expiry, (expires_at, next(self._expiry_seq), key, entry))
+        for victim in self.policy.on_insert(key, entry.content_length):
+            victim_entry = self._cache.pop(victim)
+            self._current_size -= victim_entry.content_length
+            self._demote(victim, victim_entry)
+
+    def _remove(self, key):
+        entry = self._cache.pop(key)
+        self._current_size -= entry.content_length
+        self.policy.on_remove(key)
+        return entry
+
+    def sweep(self, limit=SWEEP_BATCH):
+        # drops up to limit entries that have run out, returns how many heap items it went
+        # through so the caller knows whether there is more to do
+        now = time.time()
+        seen = 0
+        with self._lock:
+            while self._expiry and seen < limit and self._expiry[0][0] <= now:
+                _, _, key, entry = heapq.heappop(self._expiry)
+                seen += 1
+                if self._cache.get(key) is entry:
+                    self._remove(key)
+                    self.expired += 1
+            if len(self._expiry) > 2 * len(self._cache) + SWEEP_BATCH:
+                # mostly replaced or evicted entries by now, rebuild from what is live
+                self._expiry = [item for item in self._expiry if self._cache.get(item[2]) is item[3]]
+                heapq.heapify(self._expiry)
+        return seen
+
+    def start_sweeper(self):
+        # reclaims expired entries in the background, a batch per timer wheel tick
+        # while there is a backlog and once a second otherwise
+        def tick():
+            more = self.sweep() >= SWEEP_BATCH
+            self._sweeper.arm(0 if more else SWEEP_INTERVAL)
+
+        if self._sweeper is None:
+            self._sweeper = get_timer_wheel().register(SWEEP_INTERVAL, tick)
+
+    def _demote(self, key, entry):
+        if self.disk is not None and not entry.on_disk and (entry.is_fresh() or entry.worth_keeping()):
+            # written by the disk tier's own thread, not here under the lock
+            self.disk.put_later(key, entry.response_bytes, entry.timestamp)
+
+    def _get_from_disk(self, key):
+        found = self.disk.get(key)
+        if found is None:
+            return None
+        disk_entry, view = found
+        head_end = find_head_end(view)
+        status_code, response_headers, _ = self._parse_response_headers(bytes(view[:head_end + 4]))
+        entry = CacheEntry(view, response_headers, status_code, self.default_ttl, disk_entry.timestamp)
+        entry.on_disk = True
+        entry.hits = disk_entry.hits
+        if not entry.is_fresh():
+            if not entry.worth_keeping():
+                self.disk.delete(key)
+                return None
+        elif disk_entry.hits >= PROMOTE_AFTER_HITS and disk_entry.length <= self.max_object_bytes:
+            # popular enough to be worth a copy in RAM
+            entry.response_bytes = bytes(view)
+            self._insert(key, entry)
+        return entry
     
-    def get(self, method, host, path, request_headers):
+    def get(self, method, host, path, request_headers, allow_stale=False):
+        # with allow_stale, an expired entry that can be revalidated or is still in its
+        # grace windows comes back too (is_fresh() is false then)
         if not self._is_cacheable_request(method, request_headers):
             return None
         
-        key = self._normalize_key(method, host, path)
-        
         with self._lock:
+            key = self._variant_key(self._normalize_key(method, host, path), request_headers)
             if key not in self._cache:
-                self.misses += 1
-                return None
+                self.policy.on_miss(key)
+                entry = self._get_from_disk(key) if self.disk is not None else None
+                if entry is None or not entry.is_fresh():
+                    self.misses += 1
+                    return entry if allow_stale else None
+                self.hits += 1
+                return entry
             
             entry = self._cache[key]
             
-            if not entry.is_fresh(self.default_ttl):
-                del self._cache[key]
-                self._current_size -= entry.content_length
+            if not entry.is_fresh():
                 self.misses += 1
+                self.policy.on_miss(key)
+                if entry.worth_keeping():
+                    # kept, a 304 can make it fresh again without the body, or it may be served stale
+                    return entry if allow_stale else None
+                self._remove(key)
                 return None
             
-            self._cache.move_to_end(key)
+            self.policy.on_hit(key)
             entry.hits += 1
             self.hits += 1
             
             return entry
     
-    def put(self, method, host, path, request_headers, response_bytes):
+    def put(self, method, host, path, request_headers, response_bytes, compress=True):
+        # compress=False when the caller has already been through compress_response
         if not self._is_cacheable_request(method, request_headers):
             return False
+
+        if len(response_bytes) > self.max_object_bytes:
+            return False
         
         status_code, response_headers, _ = self._parse_response_headers(response_bytes)
         
@@ -130,26 +389,87 @@ class LRUCache:
         
         if not self._is_cacheable_response(status_code, response_headers):
             return False
-        
-        key = self._normalize_key(method, host, path)
+
+        if self.compress_level and compress:
+            stored = compress_response(response_bytes, self.compress_level)
+            if stored is not response_bytes:
+                # the entry's headers have to say how it is stored
+                response_bytes = stored
+                _, response_headers, _ = self._parse_response_headers(response_bytes)
         
         with self._lock:
-            if key in self._cache:
-                old_entry = self._cache.pop(key)
-                self._current_size -= old_entry.content_length
+            self._store(self._normalize_key(method, host, path), request_headers,
+                        response_bytes, response_headers, status_code)
+            return True
 
-            self._evict_if_needed()
+    def _store(self, key, request_headers, response_bytes, response_headers, status_code):
+        vary = [name.strip() for name in header_value(response_headers, "Vary", "").split(",") if name.strip()]
+        if vary:
+            self._vary[key] = vary
+        else:
+            self._vary.pop(key, None)
+        key = self._variant_key(key, request_headers, vary)
 
-            entry = CacheEntry(response_bytes, response_headers, status_code)
-            self._cache[key] = entry
-            self._current_size += entry.content_length
-            
-            return True
+        if key in self._cache:
+            self._remove(key)
+
+        entry = CacheEntry(response_bytes, response_headers, status_code, self.default_ttl)
+        self._insert(key, entry)
+        return entry
+
+    def keep_plain(self, method, host, path, request_headers, entry, response_bytes, headers):
+        # entry stored gzipped, as plain response_bytes. it is getting Range requests, which
+        # count bytes of the plain body, so the plain copy replaces it and later ranges are
+        # slices again instead of an inflate each. returns the plain entry either way
+        plain = CacheEntry(response_bytes, headers, entry.status_code, self.default_ttl, entry.timestamp)
+        plain.hits = entry.hits
+        with self._lock:
+            key = self._variant_key(self._normalize_key(method, host, path), request_headers)
+            if self._cache.get(key) is entry:
+                self._remove(key)
+                self._insert(key, plain)
+        return plain
+
+    def refresh(self, method, host, path, request_headers, entry, not_modified_headers):
+        # a 304 answered our revalidation: the stored body is still good, so its headers
+        # are updated from the 304 and its age starts over
+        response_bytes, headers, status = self._merge_not_modified(entry, not_modified_headers)
+        with self._lock:
+            self.revalidated += 1
+            return self._store(self._normalize_key(method, host, path), request_headers,
+                               response_bytes, headers, status)
+
+    def _merge_not_modified(self, entry, not_modified_headers):
+        head_end = find_head_end(entry.response_bytes)
+        view = memoryview(entry.response_bytes)
+        version, status, reason, headers = parse_response_head(bytes(view[:head_end]))
+        remove_header(headers, "Age")  # the old age no longer applies, the 304 may carry a new one
+        for name, value in not_modified_headers.items():
+            if name.lower() not in NOT_MODIFIED_SKIP:
+                remove_header(headers, name)
+                headers[name] = value
+        lines = [f"{version} {status} {reason}"] + [f"{k}: {v}" for k, v in headers.items()]
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        return head + bytes(view[head_end + 4:]), headers, status
     
     def clear(self):
         with self._lock:
             self._cache.clear()
+            self._expiry = []
+            self.policy = EVICTION_POLICIES[self.eviction](self.max_entries, self.max_size_bytes)
+            self._vary.clear()
             self._current_size = 0
+
+    def close(self):
+        # on shutdown whatever is still only in RAM goes to disk, so a restart starts warm
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        with self._lock:
+            if self.disk is None:
+                return
+            for key, entry in self._cache.items():
+                self._demote(key, entry)
+            self.disk.close()
     
     def get_stats(self):
         with self._lock:
@@ -160,15 +480,26 @@ class LRUCache:
                 "size_bytes": self._current_size,
                 "hits": self.hits,
                 "misses": self.misses,
-                "hit_rate": f"{hit_rate:.1f}%"
+                "hit_rate": f"{hit_rate:.1f}%",
+                "revalidated": self.revalidated,
+                "expired": self.expired,
+                "eviction": self.eviction,
+                "disk": self.disk.get_stats() if self.disk is not None else None
             }
 
 
+
 _cache = None
 
 
-def get_cache():
+def get_cache(shared_path=None, **kwargs):
+    # kwargs only matter on the first call, which creates the cache. with shared_path
+    # it's the one all worker processes share instead of a per-process LRU
     global _cache
     if _cache is None:
-        _cache = LRUCache()
+        if shared_path:
+            from .shared_cache import SharedCache
+            _cache = SharedCache(shared_path, **kwargs)
+        else:
+            _cache = LRUCache(**kwargs)
     return _cache
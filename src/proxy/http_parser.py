@@ -1,52 +1,402 @@
+import asyncio
 from urllib.parse import urlparse
+from .timer_wheel import get_timer_wheel
+
+# hard limits on the header block, so one client can't make us buffer forever
+MAX_REQUEST_LINE = 8 * 1024
+MAX_HEADER_COUNT = 100
+MAX_HEADER_BYTES = 64 * 1024
+# the whole header block has to arrive within this many seconds (slowloris guard)
+HEADER_TIMEOUT = 10
+READ_SIZE = 16 * 1024
+MAX_CHUNK_LINE = 4 * 1024
+
+HEADER_END = b"\r\n\r\n"
+
+
+class HTTPParseError(ValueError):
+    def __init__(self, message, status=400, reason="Bad Request"):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+class HeaderLimits:
+    def __init__(self, max_request_line=MAX_REQUEST_LINE, max_header_count=MAX_HEADER_COUNT,
+                 max_header_bytes=MAX_HEADER_BYTES, header_timeout=HEADER_TIMEOUT):
+        self.max_request_line = max_request_line
+        self.max_header_count = max_header_count
+        self.max_header_bytes = max_header_bytes
+        self.header_timeout = header_timeout
+
+
+DEFAULT_LIMITS = HeaderLimits()
+
 
 class HTTPRequest:
-    def __init__(self, method, target, path, version, headers, body, host, port):
+    def __init__(self, method, target, path, version, headers, body, host, port,
+                 body_length=0, chunked=False, stream=None):
         self.method = method
         self.target = target
         self.path = path
-        self.version = version 
+        self.version = version
         self.headers = headers
-        self.body = body 
+        self.body = body
         self.host = host
         self.port = port
+        # a body still sitting on the client socket, read lazily by iter_body()
+        self.body_length = body_length
+        self.chunked = chunked
+        self.stream = stream
+        self.body_complete = not (chunked or body_length)
+
+    def has_body(self):
+        return self.chunked or self.body_length > 0
 
-# for reading until headers end
-async def async_recv_until(reader, delimiter=b"\r\n\r\n"):
-    data = b""
-    while delimiter not in data:
-        chunk = await reader.read(4096)
+    async def iter_body(self, timeout=None):
+        if self.chunked:
+            async for piece in read_chunked(self.stream, timeout):
+                yield piece
+        else:
+            remaining = self.body_length
+            while remaining:
+                chunk = await self.stream.read(min(remaining, READ_SIZE), timeout)
+                if not chunk:
+                    raise HTTPParseError("Request body truncated")
+                remaining -= len(chunk)
+                yield chunk
+        self.body_complete = True
+
+
+class StreamBuffer:
+    # wraps a StreamReader with one growable buffer, so bytes read past the end of
+    # the headers (body, pipelined requests) stay available for the next reader
+    def __init__(self, reader, read_size=READ_SIZE):
+        self.reader = reader
+        self.read_size = read_size
+        self.buf = bytearray()
+        self.eof = False
+        # one timer wheel deadline for the stream, re-armed by every timed read
+        self._deadline = None
+
+    async def _recv(self, timeout=None):
+        if timeout is None:
+            chunk = await self.reader.read(self.read_size)
+        else:
+            if self._deadline is None:
+                self._deadline = get_timer_wheel().deadline(timeout)
+            chunk = await self._deadline.run(self.reader.read(self.read_size), timeout)
         if not chunk:
-            break
-        data += chunk
-    return data
-    
+            self.eof = True
+        return chunk
+
+    async def _fill(self, timeout=None):
+        chunk = await self._recv(timeout)
+        self.buf += chunk
+        return len(chunk)
+
+    async def read_headers(self, limits=DEFAULT_LIMITS):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + limits.header_timeout
+        scanned = 0
+        line_checked = False
+
+        while True:
+            # tolerate the empty lines some clients send between pipelined requests
+            if not line_checked:
+                while self.buf[:2] == b"\r\n":
+                    del self.buf[:2]
+                    scanned = 0
+
+            # only look at new bytes (plus 3 for a delimiter split across reads)
+            end = self.buf.find(HEADER_END, max(0, scanned - 3))
+            if end > limits.max_header_bytes or (end == -1 and len(self.buf) > limits.max_header_bytes):
+                raise HTTPParseError("Header block too large", 431, "Request Header Fields Too Large")
+            if end != -1:
+                head = bytes(self.buf[:end])
+                del self.buf[:end + len(HEADER_END)]
+                return head
+            scanned = len(self.buf)
+
+            if not line_checked:
+                if self.buf.find(b"\r\n") != -1:
+                    line_checked = True
+                elif scanned > limits.max_request_line:
+                    raise HTTPParseError("Request line too long", 414, "URI Too Long")
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            if not await self._fill(remaining):
+                if self.buf:
+                    raise HTTPParseError("Connection closed mid-headers")
+                return b""
+
+    async def wait_for_data(self, timeout):
+        # true once something is buffered, false on EOF or when the connection stays idle
+        if self.buf:
+            return True
+        if self.eof:
+            return False
+        try:
+            return bool(await self._fill(timeout))
+        except asyncio.TimeoutError:
+            return False
+
+    async def read(self, n, timeout=None):
+        if not self.buf:
+            # nothing buffered, hand the socket's chunk straight through without copying it
+            if self.eof:
+                return b""
+            chunk = await self._recv(timeout)
+            if len(chunk) <= n:
+                return chunk
+            self.buf += chunk[n:]
+            return chunk[:n]
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    async def readline(self, limit=MAX_CHUNK_LINE, timeout=None):
+        scanned = 0
+        while True:
+            end = self.buf.find(b"\r\n", max(0, scanned - 1))
+            if end != -1:
+                line = bytes(self.buf[:end])
+                del self.buf[:end + 2]
+                return line
+            scanned = len(self.buf)
+            if scanned > limit:
+                raise HTTPParseError("Line too long")
+            if not await self._fill(timeout):
+                raise HTTPParseError("Connection closed mid-line")
+
+    def take_buffered(self):
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+
+def _chunk_size(line):
+    try:
+        size = int(line.split(b";", 1)[0].strip(), 16)
+    except ValueError:
+        raise HTTPParseError("Invalid chunk size")
+    if size < 0:
+        raise HTTPParseError("Invalid chunk size")
+    return size
+
+
+async def read_chunked(stream, timeout=None):
+    # decodes a chunked body as it arrives, trailers are read and dropped
+    while True:
+        line = await stream.readline(MAX_CHUNK_LINE, timeout)
+        size = _chunk_size(line)
+        if size == 0:
+            for _ in range(MAX_HEADER_COUNT + 1):
+                if not await stream.readline(MAX_CHUNK_LINE, timeout):
+                    return
+            raise HTTPParseError("Too many trailer fields")
+
+        remaining = size
+        while remaining:
+            chunk = await stream.read(min(remaining, READ_SIZE), timeout)
+            if not chunk:
+                raise HTTPParseError("Chunked body truncated")
+            remaining -= len(chunk)
+            yield chunk
+        if await stream.readline(MAX_CHUNK_LINE, timeout):
+            raise HTTPParseError("Missing CRLF after chunk data")
+
+
+async def read_chunked_raw(stream, timeout=None):
+    # same walk as read_chunked but yields the wire bytes untouched, for relaying
+    # a chunked response as-is while still knowing exactly where it ends
+    while True:
+        line = await stream.readline(MAX_CHUNK_LINE, timeout)
+        size = _chunk_size(line)
+        yield line + b"\r\n"
+        if size == 0:
+            for _ in range(MAX_HEADER_COUNT + 1):
+                line = await stream.readline(MAX_CHUNK_LINE, timeout)
+                yield line + b"\r\n"
+                if not line:
+                    return
+            raise HTTPParseError("Too many trailer fields")
+
+        remaining = size
+        while remaining:
+            chunk = await stream.read(min(remaining, READ_SIZE), timeout)
+            if not chunk:
+                raise HTTPParseError("Chunked body truncated")
+            remaining -= len(chunk)
+            yield chunk
+        if await stream.readline(MAX_CHUNK_LINE, timeout):
+            raise HTTPParseError("Missing CRLF after chunk data")
+        yield b"\r\n"
+
+
+def decode_chunked(data):
+    # the body of a complete chunked message already in memory, trailers dropped
+    body = []
+    pos = 0
+    while True:
+        line_end = data.find(b"\r\n", pos)
+        if line_end == -1:
+            raise HTTPParseError("Chunked body truncated")
+        size = _chunk_size(data[pos:line_end])
+        if size == 0:
+            return b"".join(body)
+        start = line_end + 2
+        if start + size + 2 > len(data):
+            raise HTTPParseError("Chunked body truncated")
+        body.append(data[start:start + size])
+        pos = start + size + 2
+
+
+def encode_chunk(data):
+    return b"%x\r\n" % len(data) + data + b"\r\n"
+
+
+LAST_CHUNK = b"0\r\n\r\n"
+
+
+def header_value(headers, name, default=None):
+    # header names are case-insensitive, the dict keeps whatever case the peer sent
+    lowered = name.lower()
+    for key, value in headers.items():
+        if key.lower() == lowered:
+            return value
+    return default
+
+
+def remove_header(headers, name):
+    lowered = name.lower()
+    for key in [k for k in headers if k.lower() == lowered]:
+        del headers[key]
+
+
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-connection", "te", "trailer", "upgrade",
+    "proxy-authorization", "proxy-authenticate",
+}
+
+
+def connection_tokens(headers):
+    tokens = set()
+    for name in ("Connection", "Proxy-Connection"):
+        value = header_value(headers, name)
+        if value:
+            tokens.update(t.strip().lower() for t in value.split(","))
+    return tokens
+
+
+def wants_keep_alive(version, headers):
+    # HTTP/1.1 is persistent unless told otherwise, HTTP/1.0 only when it asks for it
+    tokens = connection_tokens(headers)
+    if "close" in tokens:
+        return False
+    if version.upper() == "HTTP/1.1":
+        return True
+    return "keep-alive" in tokens
+
+
+def strip_hop_by_hop(headers):
+    # copy without the per-connection headers, including the ones named in Connection
+    drop = HOP_BY_HOP_HEADERS | connection_tokens(headers)
+    return {k: v for k, v in headers.items() if k.lower() not in drop}
+
+
+def find_head_end(data):
+    # offset of the blank line ending the head, copying out only as much as the head
+    # needs so a large stored response (or an mmap view of one) isn't duplicated
+    view = memoryview(data)
+    probe = 4096
+    while True:
+        end = bytes(view[:probe]).find(HEADER_END)
+        if end != -1 or probe >= len(view):
+            return end
+        probe *= 4
+
+
+def parse_response_head(head):
+    # head is the status line + headers without the blank line, latin-1 keeps bytes intact
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+        raise HTTPParseError("Invalid status line", 502, "Bad Gateway")
+    reason = parts[2] if len(parts) > 2 else ""
+    return parts[0], int(parts[1]), reason, parse_header_lines(lines[1:])
+
+
+def response_has_body(method, status):
+    return not (method.upper() == "HEAD" or 100 <= status < 200 or status in (204, 304))
+
+
+def build_response_head(version, status, reason, headers, keep_alive):
+    lines = [f"{version} {status} {reason}"]
+    lines += [f"{key}: {value}" for key, value in strip_hop_by_hop(headers).items()]
+    lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def body_framing(headers, response=False):
+    # returns (content_length, chunked) for a message body, per RFC 7230 section 3.3.3.
+    # a response with no usable framing runs until the origin closes, that's length None
+    transfer_encoding = header_value(headers, "Transfer-Encoding")
+    if transfer_encoding is not None:
+        codings = [c.strip().lower() for c in transfer_encoding.split(",") if c.strip()]
+        if not codings or codings[-1] != "chunked":
+            if response:
+                return None, False
+            raise HTTPParseError("Unsupported Transfer-Encoding", 501, "Not Implemented")
+        return 0, True
+
+    content_length = header_value(headers, "Content-Length")
+    if content_length is None:
+        return (None if response else 0), False
+    values = {v.strip() for v in content_length.split(",")}
+    if len(values) != 1 or not next(iter(values)).isdigit():
+        raise HTTPParseError("Invalid Content-Length")
+    return int(values.pop()), False
+
+
+def parse_header_lines(header_lines, limits=DEFAULT_LIMITS):
+    if len(header_lines) > limits.max_header_count:
+        raise HTTPParseError("Too many headers", 431, "Request Header Fields Too Large")
+    headers = {}
+    for line in header_lines:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip()] = value.strip()
+    return headers
+
+
 # main parser fxn
 
-async def async_parse_http_request(reader):
+async def async_parse_http_request(reader, limits=DEFAULT_LIMITS):
+    if not isinstance(reader, StreamBuffer):
+        reader = StreamBuffer(reader)
 
-    raw = await async_recv_until(reader)
+    raw = await reader.read_headers(limits)
 
     if not raw:
         raise ValueError("Empty request")
 
-    header_bytes, _, remaining = raw.partition(b"\r\n\r\n")
-    header_lines = header_bytes.decode(errors="replace").split("\r\n")
+    header_lines = raw.decode(errors="replace").split("\r\n")
 
     # parsing req line
     request_line = header_lines[0]
+    if len(request_line) > limits.max_request_line:
+        raise HTTPParseError("Request line too long", 414, "URI Too Long")
     parts = request_line.split()
     if len(parts) != 3:
         raise ValueError("Invalid request line")
     method, target, version = parts
 
     # parsing headers
-    headers = {}
-    for line in header_lines[1:]:
-        if ":" in line:
-            key, value = line.split(":", 1)
-            headers[key.strip()] = value.strip()
-    
+    headers = parse_header_lines(header_lines[1:], limits)
+
     # normal default values
     host = None
     port = 80
@@ -76,12 +426,12 @@ async def async_parse_http_request(reader):
         path = parsed.path or "/"
         if parsed.query:
             path += "?" + parsed.query
-        
+
     else:
     #Relative uris use host header
         if "Host" not in headers:
             raise ValueError("400 Bad Request: Missing Host Header")
-        
+
         host_header = headers["Host"]
         if ":" in host_header:
             host, port = host_header.split(":")
@@ -89,16 +439,17 @@ async def async_parse_http_request(reader):
         else:
             host = host_header
         path = target
-    
-    # Reading body using Content-Length basically len(body) starts from 0 and ends when it is = to CL and CL is the total length of the body like POST data etc
-    content_length = int(headers.get("Content-Length", 0))
-    body = remaining
 
-    while len(body) < content_length:
-        chunk = await reader.read(content_length - len(body))
-        if not chunk:
-            break
-        body += chunk
+    # the body is not read here, handle_http streams it upstream with iter_body() so
+    # big uploads never sit in memory. chunked bodies get re-framed on the way out.
+    # only the chunked layer is undone and redone, codings under it (gzip, chunked)
+    # stay on the body and have to stay in the header too
+    content_length, chunked = body_framing(headers)
+    if chunked:
+        codings = [c.strip() for c in header_value(headers, "Transfer-Encoding").split(",") if c.strip()]
+        remove_header(headers, "Content-Length")
+        remove_header(headers, "Transfer-Encoding")
+        headers["Transfer-Encoding"] = ", ".join(codings[:-1] + ["chunked"])
 
     return HTTPRequest(
         method = method,
@@ -106,9 +457,12 @@ async def async_parse_http_request(reader):
         path = path,
         version = version,
         headers=headers,
-        body=body,
+        body=b"",
         host=host,
-        port=port
+        port=port,
+        body_length=content_length,
+        chunked=chunked,
+        stream=reader
     )
     # parse host and path from URI
 
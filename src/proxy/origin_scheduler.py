@@ -0,0 +1,119 @@
+# Upstream concurrency limits. Each (host, port) may have a bounded number of requests
+# in flight and the proxy as a whole another bound. Requests over either limit queue per
+# origin, and freed slots go to the waiting origins in round-robin order, so one slow or
+# very busy host can't starve the rest.
+
+import asyncio
+from collections import OrderedDict, deque
+from .timer_wheel import get_timer_wheel
+from .proxy_logger import get_metrics
+
+MAX_PER_ORIGIN = 32
+MAX_UPSTREAM = 512
+# a request still queued after this long gets a 504
+QUEUE_TIMEOUT = 45
+
+
+class OriginScheduler:
+
+    def __init__(self, max_per_origin=MAX_PER_ORIGIN, max_total=MAX_UPSTREAM, queue_timeout=QUEUE_TIMEOUT):
+        self.max_per_origin = max_per_origin
+        self.max_total = max_total
+        self.queue_timeout = queue_timeout
+        self.total_active = 0
+        self._active = {}             # origin -> requests in flight
+        self._waiting = OrderedDict()  # origin -> deque of futures, dict order is the round-robin turn
+
+    def _key(self, host, port):
+        return (host.lower(), port)
+
+    async def acquire(self, host, port):
+        key = self._key(host, port)
+        loop = asyncio.get_running_loop()
+        if key not in self._waiting and self._has_room(key):
+            self._grant(key)
+            get_metrics().record_origin_wait(host, 0.0)
+            return
+
+        queued_at = loop.time()
+        fut = loop.create_future()
+        self._waiting.setdefault(key, deque()).append(fut)
+        deadline = get_timer_wheel().deadline(self.queue_timeout)
+        try:
+            await deadline.run(fut)
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # granted just as we gave up, hand the slot on
+                self.release(host, port)
+            else:
+                fut.cancel()
+                self._drop_waiter(key, fut)
+            raise
+        get_metrics().record_origin_wait(host, loop.time() - queued_at)
+
+    def release(self, host, port):
+        key = self._key(host, port)
+        self.total_active -= 1
+        count = self._active[key] - 1
+        if count:
+            self._active[key] = count
+        else:
+            del self._active[key]
+        self._dispatch()
+
+    def _has_room(self, key):
+        return self.total_active < self.max_total and self._active.get(key, 0) < self.max_per_origin
+
+    def _grant(self, key):
+        self.total_active += 1
+        self._active[key] = self._active.get(key, 0) + 1
+
+    def _dispatch(self):
+        # one slot at a time to the next origin in turn that is under its own limit,
+        # which then goes to the back of the line
+        while self.total_active < self.max_total:
+            for key in self._waiting:
+                if self._active.get(key, 0) < self.max_per_origin:
+                    break
+            else:
+                return
+            waiters = self._waiting[key]
+            fut = waiters.popleft()
+            if waiters:
+                self._waiting.move_to_end(key)
+            else:
+                del self._waiting[key]
+            if fut.done():
+                # cancelled (queue deadline, client gone) before it could take itself out
+                continue
+            self._grant(key)
+            fut.set_result(None)
+
+    def _drop_waiter(self, key, fut):
+        waiters = self._waiting.get(key)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(fut)
+        except ValueError:
+            return
+        if not waiters:
+            del self._waiting[key]
+
+    def get_stats(self):
+        return {
+            "active": self.total_active,
+            "active_origins": len(self._active),
+            "queued": sum(len(waiters) for waiters in self._waiting.values()),
+            "queued_origins": len(self._waiting),
+        }
+
+
+_scheduler = None
+
+
+def get_origin_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = OriginScheduler()
+    return _scheduler
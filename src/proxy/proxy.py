@@ -1,33 +1,61 @@
 # Main entry point - Async Proxy Server
 
 import asyncio
+import os
 import signal
+import socket
 import sys
 from .forwarder import handle_client
 from .domain_filter import get_filter
 from .http_cache import get_cache
-from .proxy_logger import get_logger, get_metrics
+from .disk_cache import MAX_DISK_BYTES
+from .shared_cache import SharedCache, SHARED_CACHE_BYTES, SHARED_CACHE_AVAILABLE
+from .eviction import EVICTION_POLICIES
+from .connection_pool import get_pool
+from .collapsed_forwarding import get_collapser
+from .background_refresh import get_refresher
+from .dns_resolver import get_resolver
+from .admission import (AdmissionController, shed, MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP,
+                        ACCEPT_QUEUE, QUEUE_TIMEOUT)
+from .proxy_logger import get_logger, get_metrics, LOG_QUEUE_SIZE, OVERFLOW_POLICIES
 from termcolor import colored
 
 class ProxyServer:
 
-    def __init__(self, host='127.0.0.1', port=8080):
+    def __init__(self, host='127.0.0.1', port=8080, max_connections=MAX_CONNECTIONS,
+                 max_connections_per_ip=MAX_CONNECTIONS_PER_IP, accept_queue=ACCEPT_QUEUE,
+                 queue_timeout=QUEUE_TIMEOUT, cache_dir=None, cache_disk_bytes=MAX_DISK_BYTES,
+                 shared_cache=None, shared_cache_bytes=SHARED_CACHE_BYTES, cache_compress_level=0,
+                 cache_policy="tinylfu", reuse_port=False, log_console=True,
+                 log_queue=LOG_QUEUE_SIZE, log_overflow="drop", log_file="proxy.log"):
         self.host = host
         self.port = port
         self.server = None
-        self.logger = get_logger()
+        self.logger = get_logger(log_file=log_file, console=log_console, max_queue=log_queue,
+                                 overflow=log_overflow)
         self.metrics = get_metrics()
         self.active_tasks = set()
+        self.admission = AdmissionController(max_connections, max_connections_per_ip,
+                                             accept_queue, queue_timeout)
+        if shared_cache:
+            self.cache_options = {"shared_path": shared_cache, "size_bytes": shared_cache_bytes}
+        else:
+            self.cache_options = {"disk_dir": cache_dir, "disk_max_bytes": cache_disk_bytes}
+        self.cache_options["compress_level"] = cache_compress_level
+        self.cache_options["eviction"] = cache_policy
+        # several worker processes listen on the same port, the kernel spreads connections
+        self.reuse_port = reuse_port or None
 
     async def start(self):
-        get_filter()  
-        get_cache()  
+        get_filter().start_watching()
+        get_cache(**self.cache_options).start_sweeper()
 
         self.server = await asyncio.start_server(
             self._handle_client,
             self.host,
             self.port,
-            reuse_address=True
+            reuse_address=True,
+            reuse_port=self.reuse_port
         )
 
         addrs = ', '.join(str(sock.getsockname()) for sock in self.server.sockets)
@@ -43,7 +71,17 @@ class ProxyServer:
     async def _handle_client(self, reader, writer):
         task = asyncio.current_task()
         self.active_tasks.add(task)
+        peer = writer.get_extra_info('peername')
+        client_ip = peer[0] if peer else 'unknown'
+        admitted = False
         try:
+            shed_reason = await self.admission.admit(client_ip)
+            if shed_reason is not None:
+                # over the limits, a fast 503 now beats a slow answer for everyone
+                self.metrics.record_shed(shed_reason)
+                await shed(reader, writer)
+                return
+            admitted = True
             await handle_client(reader, writer)
         except asyncio.CancelledError:
             pass
@@ -51,6 +89,8 @@ class ProxyServer:
             client_addr = writer.get_extra_info('peername')
             print(f"Error handling {client_addr}: {e}")
         finally:
+            if admitted:
+                self.admission.release(client_ip)
             self.active_tasks.discard(task)
             try:
                 writer.close()
@@ -67,7 +107,13 @@ class ProxyServer:
                     task.cancel()
                 await asyncio.gather(*self.active_tasks, return_exceptions=True)
             
+            get_filter().stop_watching()
+            await get_refresher().close()
+            get_pool().close_all()
+            get_cache().close()
             await self.server.wait_closed()
+        # the last queued log records are written before the summary is printed
+        self.logger.close()
 
     def print_stats(self):
         print("\nShutting down proxy server now\n", flush=True)
@@ -77,6 +123,16 @@ class ProxyServer:
         except Exception as e:
             print(f"Error printing metrics: {e}", flush=True)
 
+        try:
+            blocklist = get_filter().get_stats()
+            print(colored(f"  Blocklist: generation {blocklist['generation']}, {blocklist['exact']} exact, {blocklist['suffixes']} suffix and {blocklist['rules']} url blocks, last built in {blocklist['last_reload_seconds']:.3f}s ({blocklist['reload_failures']} failed reloads)", "green", attrs=["bold"]), flush=True)
+            log = self.logger.get_stats()
+            print(colored(f"  Access Log: {log['written']} records in {log['batches']} writes, {log['dropped']} dropped", "green", attrs=["bold"]), flush=True)
+            dns = get_resolver().get_stats()
+            print(colored(f"  DNS: {dns['entries']} names cached, {dns['hits']} hits, {dns['misses']} lookups, {dns['coalesced']} joined a lookup in flight", "green", attrs=["bold"]), flush=True)
+        except Exception as e:
+            print(f"Error printing blocklist stats: {e}", flush=True)
+
         try:
             cache = get_cache()
             stats = cache.get_stats()
@@ -84,6 +140,15 @@ class ProxyServer:
             print(colored(f"  Entries: {stats['entries']}", "green", attrs=["bold"]), flush=True)
             print(colored(f"  Size: {stats['size_bytes'] / 1024:.1f} KB", "green", attrs=["bold"]), flush=True)
             print(colored(f"  Hit Rate: {stats['hit_rate']}", "green", attrs=["bold"]), flush=True)
+            print(colored(f"  Eviction: {stats['eviction']}", "green", attrs=["bold"]), flush=True)
+            print(colored(f"  Expired: {stats['expired']}", "green", attrs=["bold"]), flush=True)
+            if stats['disk'] is not None:
+                disk = stats['disk']
+                print(colored(f"  Disk Tier: {disk['entries']} entries, {disk['size_bytes'] / (1024 * 1024):.1f} MB in {disk['segments']} segments, {disk['hits']} hits", "green", attrs=["bold"]), flush=True)
+            collapsed = get_collapser().get_stats()
+            print(colored(f"  Collapsed Misses: {collapsed['collapsed']} ({collapsed['fallbacks']} fell back to their own fetch, {collapsed['cut_off']} cut off for falling behind)", "green", attrs=["bold"]), flush=True)
+            refreshes = get_refresher().get_stats()
+            print(colored(f"  Background Refreshes: {refreshes['started']} ({refreshes['skipped']} skipped at the limit, {refreshes['failed']} failed)", "green", attrs=["bold"]), flush=True)
         except Exception as e:
             print(colored(f"Error printing cache stats: {e}", "red"), flush=True)
 
@@ -96,16 +161,99 @@ def main():
     parser = argparse.ArgumentParser(description='Async HTTP/HTTPS Forward Proxy Server')
     parser.add_argument('--host', default='127.0.0.1', help='Host to bind to (default: 127.0.0.1)')
     parser.add_argument('--port', '-p', type=int, default=8080, help='Port to listen on (default: 8080)')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help=f'Client connections served at once (default: {MAX_CONNECTIONS})')
+    parser.add_argument('--max-connections-per-ip', type=int, default=MAX_CONNECTIONS_PER_IP,
+                        help=f'Client connections per IP, queued ones included (default: {MAX_CONNECTIONS_PER_IP})')
+    parser.add_argument('--accept-queue', type=int, default=ACCEPT_QUEUE,
+                        help=f'Connections that may wait for a free slot before getting a 503 (default: {ACCEPT_QUEUE})')
+    parser.add_argument('--queue-timeout', type=float, default=QUEUE_TIMEOUT,
+                        help=f'Seconds a queued connection waits before getting a 503 (default: {QUEUE_TIMEOUT})')
+
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory for the on-disk cache tier (default: RAM only)')
+    parser.add_argument('--cache-disk-size', type=int, default=MAX_DISK_BYTES // (1024 * 1024),
+                        help=f'Size of the on-disk cache tier in MB (default: {MAX_DISK_BYTES // (1024 * 1024)})')
+    parser.add_argument('--shared-cache', default=None, metavar='FILE',
+                        help='Keep the response cache in this mmap\'d file, shared by every worker process (default: per-process cache)')
+    parser.add_argument('--shared-cache-size', type=int, default=SHARED_CACHE_BYTES // (1024 * 1024),
+                        help=f'Size of the shared cache in MB, the same for every process using the file (default: {SHARED_CACHE_BYTES // (1024 * 1024)})')
+    parser.add_argument('--cache-policy', choices=sorted(EVICTION_POLICIES), default='tinylfu',
+                        help='How the RAM cache picks what to evict (default: tinylfu)')
+    parser.add_argument('--cache-compress', type=int, default=0, choices=range(10), metavar='LEVEL',
+                        help='Store text-like responses gzipped at this zlib level, 1-9 (default: 0, off)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes accepting on the same port (default: 1)')
+    parser.add_argument('--log-queue', type=int, default=LOG_QUEUE_SIZE,
+                        help=f'Log records buffered for the writer thread (default: {LOG_QUEUE_SIZE})')
+    parser.add_argument('--log-overflow', choices=OVERFLOW_POLICIES, default='drop',
+                        help='What to do with a log record when the buffer is full: drop it, or block until there is room (default: drop)')
+    parser.add_argument('--no-console-log', action='store_true',
+                        help='Only write request logs to proxy.log, not to the console')
 
     args = parser.parse_args()
+    if args.shared_cache and args.cache_dir:
+        parser.error("--shared-cache and --cache-dir can't be used together")
+    if args.shared_cache and not SHARED_CACHE_AVAILABLE:
+        parser.error("--shared-cache needs fcntl locks, which this platform doesn't have")
+    if args.shared_cache:
+        # set up (or checked) once here, before any worker maps it
+        try:
+            SharedCache(args.shared_cache, args.shared_cache_size * 1024 * 1024).close()
+        except (OSError, RuntimeError) as e:
+            parser.error(str(e))
+    if args.workers > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+        parser.error("--workers needs fork() and SO_REUSEPORT")
+
+    # the blocklist is compiled (or its snapshot mapped) once, the workers share the mapping.
+    # fork before anything opens the log file or the cache, each worker sets up its own
+    get_filter()
+    workers = []
+    worker = 0  # 0 in the first process, 1.. in the forked ones
+    for n in range(1, args.workers):
+        pid = os.fork()
+        if pid == 0:
+            workers = []
+            worker = n
+            break
+        workers.append(pid)
+
+    # a disk tier's index lives in its process, so every worker gets a directory of its own
+    # and a share of the budget. the same goes for the log, each rotates its own file
+    cache_dir = args.cache_dir
+    cache_disk_bytes = args.cache_disk_size * 1024 * 1024
+    log_file = "proxy.log"
+    if args.workers > 1:
+        if cache_dir:
+            cache_dir = os.path.join(cache_dir, f"worker-{worker}")
+            cache_disk_bytes //= args.workers
+        if worker:
+            log_file = f"proxy-worker{worker}.log"
     
-    server = ProxyServer(host=args.host, port=args.port)
+    server = ProxyServer(host=args.host, port=args.port, max_connections=args.max_connections,
+                         max_connections_per_ip=args.max_connections_per_ip,
+                         accept_queue=args.accept_queue, queue_timeout=args.queue_timeout,
+                         cache_dir=cache_dir, cache_disk_bytes=cache_disk_bytes,
+                         shared_cache=args.shared_cache,
+                         shared_cache_bytes=args.shared_cache_size * 1024 * 1024,
+                         cache_compress_level=args.cache_compress,
+                         cache_policy=args.cache_policy,
+                         reuse_port=args.workers > 1,
+                         log_console=not args.no_console_log,
+                         log_queue=args.log_queue, log_overflow=args.log_overflow,
+                         log_file=log_file)
 
     async def run():
         loop = asyncio.get_running_loop()
         stop_event = asyncio.Event()
         
         def shutdown():
+            # the first process takes the other workers down with it
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
             stop_event.set()
         
         if sys.platform != 'win32':
@@ -118,14 +266,15 @@ def main():
             signal.signal(signal.SIGINT, windows_signal_handler)
             signal.signal(signal.SIGTERM, windows_signal_handler)
         
-        get_filter()  
-        get_cache()  
+        get_filter().start_watching()
+        get_cache(**server.cache_options).start_sweeper()
 
         server.server = await asyncio.start_server(
             server._handle_client,
             server.host,
             server.port,
-            reuse_address=True
+            reuse_address=True,
+            reuse_port=server.reuse_port
         )
 
         addrs = ', '.join(str(sock.getsockname()) for sock in server.server.sockets)
@@ -141,6 +290,11 @@ def main():
         asyncio.run(run())
     except KeyboardInterrupt:
         server.print_stats()
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
 
 
 if __name__ == "__main__":
@@ -1,15 +1,108 @@
 import logging
 import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from logging.handlers import RotatingFileHandler
 from termcolor import colored
 
+# records waiting for the writer thread, beyond this the overflow policy kicks in
+LOG_QUEUE_SIZE = 10000
+# most records written out per flush
+LOG_BATCH = 256
+OVERFLOW_POLICIES = ("drop", "block")
+
+
+class AsyncLogHandler(logging.Handler):
+    # the event loop only appends records to a bounded queue. a writer thread formats
+    # them and writes them to the real handlers in batches with one flush per batch, so
+    # a slow disk or a log rotation never holds up a connection. when the queue is full
+    # the record is dropped (and counted) or, with "block", the caller waits for room
+
+    def __init__(self, handlers, max_queue=LOG_QUEUE_SIZE, overflow="drop"):
+        super().__init__()
+        self.handlers = handlers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self._queue = deque()
+        self._ready = threading.Condition(threading.Lock())
+        self._closed = False
+
+        # Stats
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+
+        self._thread = threading.Thread(target=self._run, name="proxy-log-writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        with self._ready:
+            if self._closed:
+                # raced with close(), written straight away
+                self._write([record])
+                return
+            while len(self._queue) >= self.max_queue:
+                if self.overflow != "block":
+                    self.dropped += 1
+                    return
+                self._ready.wait()
+            self._queue.append(record)
+            if len(self._queue) == 1:
+                self._ready.notify_all()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._queue and not self._closed:
+                    self._ready.wait()
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(LOG_BATCH, len(self._queue)))]
+                # wakes callers blocked on a full queue
+                self._ready.notify_all()
+            self._write(batch)
+
+    def _write(self, batch):
+        for handler in self.handlers:
+            try:
+                handler.acquire()
+                try:
+                    for record in batch:
+                        if record.levelno < handler.level:
+                            continue
+                        if isinstance(handler, RotatingFileHandler) and handler.shouldRollover(record):
+                            handler.doRollover()
+                        handler.stream.write(handler.format(record) + handler.terminator)
+                    handler.flush()
+                finally:
+                    handler.release()
+            except Exception:
+                self.handleError(batch[-1])
+        self.written += len(batch)
+        self.batches += 1
+
+    def close(self):
+        # writes out whatever is queued and stops the thread
+        with self._ready:
+            if self._closed:
+                return
+            self._closed = True
+            self._ready.notify_all()
+        self._thread.join()
+        for handler in self.handlers:
+            handler.close()
+        super().close()
+
+
 class ProxyLogger:
     # 5 mb liya
-    def __init__(self, log_file="proxy.log", max_bytes=5*1024*1024, backup_count=3):
+    def __init__(self, log_file="proxy.log", max_bytes=5*1024*1024, backup_count=3,
+                 console=True, max_queue=LOG_QUEUE_SIZE, overflow="drop"):
         self.logger = logging.getLogger("proxy")
         self.logger.setLevel(logging.INFO)
+        # the root logger's console handler would write on the event loop again
+        self.logger.propagate = False
+        self.handler = None
         
         if not self.logger.handlers:
             file_handler = RotatingFileHandler(
@@ -19,35 +112,46 @@ class ProxyLogger:
             )
             file_handler.setLevel(logging.INFO)
             
-            console_handler = logging.StreamHandler()
-            console_handler.setLevel(logging.INFO)
-            
             formatter = logging.Formatter(
                 '%(asctime)s | %(message)s',
                 datefmt='%d-%m-%Y %H:%M:%S'
             )
             file_handler.setFormatter(formatter)
-            console_handler.setFormatter(formatter)
+            handlers = [file_handler]
+
+            if console:
+                console_handler = logging.StreamHandler()
+                console_handler.setLevel(logging.INFO)
+                console_handler.setFormatter(formatter)
+                handlers.append(console_handler)
             
-            self.logger.addHandler(file_handler)
-            self.logger.addHandler(console_handler)
+            self.handler = AsyncLogHandler(handlers, max_queue, overflow)
+            self.logger.addHandler(self.handler)
     
     def log_request(self, client_addr, host, port, request_line, action, 
                     status_code, bytes_transferred=0):
         client_ip, client_port = client_addr
-        log_entry = (
-            f"{client_ip}:{client_port} | "
-            f"{host}:{port} | "
-            f"\"{request_line}\" | "
-            f"{action} | "
-            f"{status_code} | "
-            f"{bytes_transferred} bytes"
-        )
-        
-        if action == "BLOCKED":
-            self.logger.warning(log_entry)
-        else:
-            self.logger.info(log_entry)
+        # formatted on the writer thread, not here
+        level = logging.WARNING if action == "BLOCKED" else logging.INFO
+        self.logger.log(level, "%s:%s | %s:%s | \"%s\" | %s | %s | %s bytes",
+                        client_ip, client_port, host, port, request_line, action,
+                        status_code, bytes_transferred)
+
+    def close(self):
+        if self.handler is not None:
+            self.logger.removeHandler(self.handler)
+            self.handler.close()
+
+    def get_stats(self):
+        handler = self.handler
+        if handler is None:
+            return {"written": 0, "dropped": 0, "batches": 0, "queued": 0}
+        return {
+            "written": handler.written,
+            "dropped": handler.dropped,
+            "batches": handler.batches,
+            "queued": len(handler._queue),
+        }
 
 
 class ProxyMetrics:
@@ -59,6 +163,14 @@ class ProxyMetrics:
         self._host_counts = defaultdict(int)
         self._request_times = [] 
         self._start_time = time.time()
+        self._pool_hits = 0
+        self._pool_misses = 0
+        self._tunnels = 0
+        self._tunnels_spliced = 0
+        self._tunnel_bytes = 0
+        self._shed = defaultdict(int)  # reason -> connections turned away with a 503
+        # host -> [requests, requests that queued, total wait seconds, longest wait]
+        self._origin_waits = defaultdict(lambda: [0, 0, 0.0, 0.0])
     
     def record_request(self, host, blocked=False):
         with self._lock:
@@ -71,6 +183,45 @@ class ProxyMetrics:
             cutoff = time.time() - 300
             self._request_times = [t for t in self._request_times if t > cutoff]
     
+    def record_pool_checkout(self, hit):
+        with self._lock:
+            if hit:
+                self._pool_hits += 1
+            else:
+                self._pool_misses += 1
+
+    def record_tunnel(self, bytes_up, bytes_down, spliced):
+        with self._lock:
+            self._tunnels += 1
+            if spliced:
+                self._tunnels_spliced += 1
+            self._tunnel_bytes += bytes_up + bytes_down
+
+    def record_shed(self, reason):
+        with self._lock:
+            self._shed[reason] += 1
+
+    def record_origin_wait(self, host, seconds):
+        with self._lock:
+            stats = self._origin_waits[host]
+            stats[0] += 1
+            if seconds > 0:
+                stats[1] += 1
+                stats[2] += seconds
+                stats[3] = max(stats[3], seconds)
+
+    def get_origin_waits(self):
+        with self._lock:
+            return {
+                host: {
+                    "requests": requests,
+                    "queued": queued,
+                    "avg_wait_ms": round(total / requests * 1000, 1),
+                    "max_wait_ms": round(longest * 1000, 1),
+                }
+                for host, (requests, queued, total, longest) in self._origin_waits.items()
+            }
+
     def get_requests_per_minute(self):
         with self._lock:
             now = time.time()
@@ -99,7 +250,15 @@ class ProxyMetrics:
                 "blocked_requests": self._blocked_requests,
                 "allowed_requests": self._total_requests - self._blocked_requests,
                 "requests_per_minute": rpm,
-                "top_hosts": top_hosts
+                "top_hosts": top_hosts,
+                "pool_hits": self._pool_hits,
+                "pool_misses": self._pool_misses,
+                "tunnels": self._tunnels,
+                "tunnels_spliced": self._tunnels_spliced,
+                "tunnel_bytes": self._tunnel_bytes,
+                "shed_connections": sum(self._shed.values()),
+                "shed_by_reason": dict(self._shed),
+                "origin_queue_wait": self.get_origin_waits()
             }
     
     def print_summary(self):
@@ -111,6 +270,19 @@ class ProxyMetrics:
         print(colored(f"  - Allowed: {summary['allowed_requests']}", "green", attrs=["bold"]))
         print(colored(f"  - Blocked: {summary['blocked_requests']}", "red", attrs=["bold"]))
         print(colored(f"Requests/Minute: {summary['requests_per_minute']}", "green", attrs=["bold"]))
+        print(colored(f"Upstream Pool: {summary['pool_hits']} reused, {summary['pool_misses']} new connections", "green", attrs=["bold"]))
+        print(colored(f"Tunnels: {summary['tunnels']} ({summary['tunnels_spliced']} spliced), {summary['tunnel_bytes'] / 1024:.1f} KB", "green", attrs=["bold"]))
+        shed = ", ".join(f"{reason}: {count}" for reason, count in summary['shed_by_reason'].items())
+        print(colored(f"Shed Connections (503): {summary['shed_connections']}" + (f" ({shed})" if shed else ""), "green", attrs=["bold"]))
+        queued_hosts = sorted(
+            ((host, waits) for host, waits in summary['origin_queue_wait'].items() if waits['queued']),
+            key=lambda x: x[1]['avg_wait_ms'],
+            reverse=True
+        )
+        if queued_hosts:
+            print(colored("\nUpstream Queue Wait (per host):", "blue", attrs=["bold"]))
+            for host, waits in queued_hosts[:5]:
+                print(colored(f"  {host}: {waits['queued']}/{waits['requests']} queued, avg {waits['avg_wait_ms']} ms, max {waits['max_wait_ms']} ms", "green", attrs=["bold"]))
         print(colored("\nTop Requested Hosts:", "blue", attrs=["bold"]))
         for host, count in summary['top_hosts']:
             print(colored(f"  {host}: {count} requests", "green", attrs=["bold"]))
@@ -122,10 +294,11 @@ _logger = None
 _metrics = None
 
 
-def get_logger():
+def get_logger(**kwargs):
+    # the options only count on the first call, which creates the logger
     global _logger
     if _logger is None:
-        _logger = ProxyLogger()
+        _logger = ProxyLogger(**kwargs)
     return _logger
 
 
@@ -0,0 +1,315 @@
+# Response cache shared by every worker process on the box. It lives in one mmap'd
+# file: a fixed header with the shared counters, a set-associative hash index, and a
+# ring buffer the responses are appended to. Writing past the end of the ring
+# overwrites the oldest responses, so eviction is FIFO and the file size is the one
+# memory budget for all workers. Index buckets are guarded by striped fcntl byte-range
+# locks and appends by one more. Readers take no lock while copying a response out,
+# they check afterwards that the ring hasn't lapped it in the meantime.
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from .disk_cache import RECORD_HEADER, RECORD_MAGIC
+from .http_cache import LRUCache, CacheEntry
+from .http_parser import header_value
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SHARED_CACHE_BYTES = 256 * 1024 * 1024
+# average response size the index is sized for
+AVG_OBJECT_BYTES = 8 * 1024
+WAYS = 8
+LOCK_STRIPES = 64
+
+MAGIC = b"PXSHM001"
+# magic, buckets, ways, ring size, ring head, hits, misses, revalidated
+HEADER = struct.Struct("<8sIIQQQQQ")
+HEADER_SIZE = 64
+HEAD_OFFSET = 24
+HITS_OFFSET = 32
+MISSES_OFFSET = 40
+REVALIDATED_OFFSET = 48
+COUNTER = struct.Struct("<Q")
+# key hash, ring position, record length (0 means empty), flags
+SLOT = struct.Struct("<QQII")
+
+# the slot holds the header names a URL varies on instead of a response
+FLAG_VARY = 1
+
+# byte offsets locked with fcntl, past the end of the file so they never touch the data
+LOCK_BASE = 1 << 40
+LOCK_RING = LOCK_BASE
+LOCK_STATS = LOCK_BASE + 1
+LOCK_STRIPE = LOCK_BASE + 2
+# held shared by every process that has the file mapped. the file is only resized or
+# wiped by a process that gets it exclusively: shrinking a file someone else has mapped
+# kills them with SIGBUS
+LOCK_USERS = LOCK_BASE - 1
+
+SHARED_CACHE_AVAILABLE = fcntl is not None
+
+
+def _hash(key):
+    # has to agree across processes, so not hash()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class SharedCache(LRUCache):
+    # same surface as LRUCache, only the storage underneath is different
+
+    def __init__(self, path, size_bytes=SHARED_CACHE_BYTES, default_ttl=300,
+                 max_object_bytes=5*1024*1024, compress_level=0, eviction=None, **unused):
+        if fcntl is None:
+            raise RuntimeError("The shared cache needs fcntl locks, which this platform doesn't have")
+        self.path = path
+        self.default_ttl = default_ttl
+        # the ring buffer decides what goes first, there is no policy to pick
+        self.eviction = "fifo"
+        self.compress_level = compress_level
+        self._lock = threading.RLock()
+        self.disk = None
+
+        self.buckets = max(64, size_bytes // AVG_OBJECT_BYTES // WAYS)
+        self.ways = WAYS
+        self.index_offset = HEADER_SIZE
+        self.data_offset = HEADER_SIZE + self.buckets * self.ways * SLOT.size
+        self.capacity = max(size_bytes - self.data_offset, 1024 * 1024)
+        # one object may take at most a quarter of the ring
+        self.max_object_bytes = min(max_object_bytes, self.capacity // 4)
+
+        # fcntl locks don't keep out other threads of the same process, these do
+        self._thread_locks = [threading.Lock() for _ in range(LOCK_STRIPES + 2)]
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._map = None
+        try:
+            with self._locked(LOCK_RING):
+                self._open()
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _open(self):
+        # under the ring lock, so of several workers starting at once one sets the file up
+        # and the rest find it ready
+        total = self.data_offset + self.capacity
+        if not self._laid_out(total):
+            # new file, or one laid out for a different size: start empty, but only if
+            # nobody else is using it
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, LOCK_USERS)
+            except OSError:
+                raise RuntimeError(f"{self.path} is in use by other processes with a different "
+                                   f"size, they all need the same --shared-cache-size") from None
+            os.ftruncate(self._fd, total)
+            self._map = mmap.mmap(self._fd, total)
+            self._map[:self.data_offset] = bytes(self.data_offset)
+            HEADER.pack_into(self._map, 0, MAGIC, self.buckets, self.ways, self.capacity, 0, 0, 0, 0)
+        else:
+            self._map = mmap.mmap(self._fd, total)
+        fcntl.lockf(self._fd, fcntl.LOCK_SH, 1, LOCK_USERS)
+
+    def _laid_out(self, total):
+        if os.fstat(self._fd).st_size != total:
+            return False
+        magic, buckets, ways, capacity = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))[:4]
+        return (magic, buckets, ways, capacity) == (MAGIC, self.buckets, self.ways, self.capacity)
+
+    @contextmanager
+    def _locked(self, offset):
+        thread_lock = self._thread_locks[offset - LOCK_BASE]
+        with thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+
+    def _counter(self, offset):
+        return COUNTER.unpack_from(self._map, offset)[0]
+
+    def _bump(self, offset):
+        with self._locked(LOCK_STATS):
+            COUNTER.pack_into(self._map, offset, self._counter(offset) + 1)
+
+    def _head(self):
+        with self._locked(LOCK_RING):
+            return self._counter(HEAD_OFFSET)
+
+    def _slots(self, key_hash):
+        bucket = key_hash % self.buckets
+        first = self.index_offset + bucket * self.ways * SLOT.size
+        return LOCK_STRIPE + bucket % LOCK_STRIPES, range(first, first + self.ways * SLOT.size, SLOT.size)
+
+    def _append(self, record):
+        # ring positions only ever grow, the byte offset is position % capacity.
+        # a record never wraps around the end, the rest of the lap is skipped instead.
+        # the head moves before the bytes are written so a reader copying what gets
+        # overwritten notices, and the copy happens under the lock so a writer that
+        # stalls can't land on records the ring has come round to again meanwhile
+        with self._locked(LOCK_RING):
+            head = self._counter(HEAD_OFFSET)
+            if head % self.capacity + len(record) > self.capacity:
+                head += self.capacity - head % self.capacity
+            COUNTER.pack_into(self._map, HEAD_OFFSET, head + len(record))
+            start = self.data_offset + head % self.capacity
+            self._map[start:start + len(record)] = record
+            return head
+
+    def _read(self, key):
+        # (stored-at, data, flags) or None
+        key_bytes = key.encode("utf-8")
+        key_hash = _hash(key_bytes)
+        stripe, slots = self._slots(key_hash)
+        with self._locked(stripe):
+            for slot in slots:
+                slot_hash, pos, length, flags = SLOT.unpack_from(self._map, slot)
+                if length and slot_hash == key_hash:
+                    break
+            else:
+                return None
+
+        start = self.data_offset + pos % self.capacity
+        record = self._map[start:start + length]
+        if pos < self._head() - self.capacity:
+            # overwritten by newer responses, possibly while we were copying it
+            return None
+        magic, key_len, data_len, stored_at = RECORD_HEADER.unpack_from(record, 0)
+        key_end = RECORD_HEADER.size + key_len
+        if magic != RECORD_MAGIC or record[RECORD_HEADER.size:key_end] != key_bytes:
+            return None
+        return stored_at, record[key_end:key_end + data_len], flags
+
+    def _write(self, key, data, flags=0):
+        key_bytes = key.encode("utf-8")
+        record = RECORD_HEADER.pack(RECORD_MAGIC, len(key_bytes), len(data), time.time()) + key_bytes + data
+        pos = self._append(record)
+
+        # the index only points at the record once it is completely written
+        key_hash = _hash(key_bytes)
+        stripe, slots = self._slots(key_hash)
+        with self._locked(stripe):
+            victim, victim_pos = None, None
+            for slot in slots:
+                slot_hash, slot_pos, length, _ = SLOT.unpack_from(self._map, slot)
+                if length and slot_hash == key_hash:
+                    victim = slot
+                    break
+                if not length:
+                    victim_pos = -1
+                    victim = slot
+                elif victim_pos is None or slot_pos < victim_pos:
+                    # the way holding the oldest record is the first one the ring overwrites anyway
+                    victim, victim_pos = slot, slot_pos
+            SLOT.pack_into(self._map, victim, key_hash, pos, len(record), flags)
+
+    def _delete(self, key):
+        key_bytes = key.encode("utf-8")
+        key_hash = _hash(key_bytes)
+        stripe, slots = self._slots(key_hash)
+        with self._locked(stripe):
+            for slot in slots:
+                slot_hash, _, length, _ = SLOT.unpack_from(self._map, slot)
+                if length and slot_hash == key_hash:
+                    SLOT.pack_into(self._map, slot, 0, 0, 0, 0)
+
+    def collapse_key(self, method, host, path, request_headers):
+        if not self._is_cacheable_request(method, request_headers):
+            return None
+        key = self._normalize_key(method, host, path)
+        found = self._read(key)
+        vary = found[1].decode("latin-1").split(",") if found and found[2] & FLAG_VARY else []
+        return self._variant_key(key, request_headers, vary)
+
+    def get(self, method, host, path, request_headers, allow_stale=False):
+        if not self._is_cacheable_request(method, request_headers):
+            return None
+
+        key = self._normalize_key(method, host, path)
+        found = self._read(key)
+        if found is not None and found[2] & FLAG_VARY:
+            # the URL varies on some request headers, its responses are stored per value
+            key = self._variant_key(key, request_headers, found[1].decode("latin-1").split(","))
+            found = self._read(key)
+        if found is None:
+            self._bump(MISSES_OFFSET)
+            return None
+
+        stored_at, response_bytes, _ = found
+        status_code, response_headers, _ = self._parse_response_headers(response_bytes)
+        entry = CacheEntry(response_bytes, response_headers, status_code, self.default_ttl, stored_at)
+        if not entry.is_fresh():
+            self._bump(MISSES_OFFSET)
+            if entry.worth_keeping():
+                return entry if allow_stale else None
+            self._delete(key)
+            return None
+
+        self._bump(HITS_OFFSET)
+        return entry
+
+    def _store(self, key, request_headers, response_bytes, response_headers, status_code):
+        vary = [name.strip() for name in header_value(response_headers, "Vary", "").split(",") if name.strip()]
+        if vary:
+            self._write(key, ",".join(vary).encode("latin-1"), FLAG_VARY)
+            key = self._variant_key(key, request_headers, vary)
+        self._write(key, bytes(response_bytes))
+        return CacheEntry(response_bytes, response_headers, status_code, self.default_ttl)
+
+    def refresh(self, method, host, path, request_headers, entry, not_modified_headers):
+        response_bytes, headers, status = self._merge_not_modified(entry, not_modified_headers)
+        self._bump(REVALIDATED_OFFSET)
+        return self._store(self._normalize_key(method, host, path), request_headers,
+                           response_bytes, headers, status)
+
+    def start_sweeper(self):
+        # expired records hold nothing back here, the ring writes over them in turn
+        pass
+
+    def clear(self):
+        # skipping a whole lap of the ring leaves every stored record behind it
+        with self._locked(LOCK_RING):
+            COUNTER.pack_into(self._map, HEAD_OFFSET, self._counter(HEAD_OFFSET) + self.capacity)
+
+    def close(self):
+        if self._map is not None:
+            # the shutdown summary is printed after this
+            self._final_stats = self.get_stats()
+            self._map.close()
+            self._map = None
+            os.close(self._fd)
+
+    def get_stats(self):
+        if self._map is None:
+            return self._final_stats
+        oldest = self._head() - self.capacity
+        entries = 0
+        size = 0
+        for slot in range(self.index_offset, self.data_offset, SLOT.size):
+            _, pos, length, flags = SLOT.unpack_from(self._map, slot)
+            if length and not flags & FLAG_VARY and pos >= oldest:
+                entries += 1
+                size += length
+        with self._locked(LOCK_STATS):
+            hits = self._counter(HITS_OFFSET)
+            misses = self._counter(MISSES_OFFSET)
+            revalidated = self._counter(REVALIDATED_OFFSET)
+        total = hits + misses
+        hit_rate = (hits / total * 100) if total > 0 else 0
+        return {
+            "entries": entries,
+            "size_bytes": size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": f"{hit_rate:.1f}%",
+            "revalidated": revalidated,
+            "expired": 0,
+            "eviction": "fifo",
+            "disk": None
+        }
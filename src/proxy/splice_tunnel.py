@@ -0,0 +1,125 @@
+# Zero-copy CONNECT tunnel for Linux. Bytes move socket -> pipe -> socket with
+# splice(2) so they never enter Python, the event loop only waits for readiness.
+# Anything that doesn't fit (other platforms, other loops, bytes already buffered
+# by asyncio) makes can_splice() say no and the tunnel falls back to pipe().
+
+import asyncio
+import errno
+import os
+import socket
+import sys
+
+SPLICE_CHUNK = 64 * 1024
+SPLICE_AVAILABLE = sys.platform.startswith("linux") and hasattr(os, "splice")
+
+
+class TunnelStats:
+
+    def __init__(self):
+        self.bytes_up = 0    # client -> server
+        self.bytes_down = 0  # server -> client
+        self.spliced = False
+        # the tunnel's idle deadline on the timer wheel, set by whoever runs the tunnel
+        self.deadline = None
+
+    def add(self, n, upstream):
+        if upstream:
+            self.bytes_up += n
+        else:
+            self.bytes_down += n
+        if self.deadline is not None:
+            self.deadline.refresh()
+
+
+def can_splice(client_reader, client_writer, server_reader, server_writer):
+    if not SPLICE_AVAILABLE:
+        return False
+    if not isinstance(asyncio.get_running_loop(), asyncio.SelectorEventLoop):
+        return False
+    for reader, writer in ((client_reader, client_writer), (server_reader, server_writer)):
+        sock = writer.get_extra_info("socket")
+        if sock is None or sock.type != socket.SOCK_STREAM:
+            return False
+        if writer.transport.get_write_buffer_size():
+            return False
+        # StreamReader has no public way to peek at what it already pulled off the
+        # socket, and those bytes would be skipped by a kernel-side copy
+        if len(getattr(reader, "_buffer", b"?")):
+            return False
+    return True
+
+
+async def _wait_ready(loop, fd, writable):
+    fut = loop.create_future()
+    add, remove = (loop.add_writer, loop.remove_writer) if writable else (loop.add_reader, loop.remove_reader)
+    add(fd, lambda: fut.done() or fut.set_result(None))
+    try:
+        await fut
+    finally:
+        remove(fd)
+
+
+async def _splice_one_way(src, dst, stats, upstream):
+    loop = asyncio.get_running_loop()
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    pipe_r, pipe_w = os.pipe()
+    try:
+        while True:
+            try:
+                n = os.splice(src.fileno(), pipe_w, SPLICE_CHUNK, flags=flags)
+            except BlockingIOError:
+                await _wait_ready(loop, src.fileno(), False)
+                continue
+            if n == 0:
+                break
+
+            pending = n
+            while pending:
+                try:
+                    pending -= os.splice(pipe_r, dst.fileno(), pending, flags=flags)
+                except BlockingIOError:
+                    await _wait_ready(loop, dst.fileno(), True)
+            stats.add(n, upstream)
+
+        # pass the EOF along so the other side can finish its half
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+    except OSError as e:
+        if e.errno not in (errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN):
+            raise
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
+
+async def splice_tunnel(client_writer, server_writer, stats):
+    # the transports stop reading so asyncio and splice never race for the same bytes,
+    # and dup'd sockets keep the selector from mixing up our fds with the transports'
+    client_writer.transport.pause_reading()
+    server_writer.transport.pause_reading()
+    client_sock = _dup(client_writer)
+    server_sock = _dup(server_writer)
+    stats.spliced = True
+
+    up = asyncio.ensure_future(_splice_one_way(client_sock, server_sock, stats, True))
+    down = asyncio.ensure_future(_splice_one_way(server_sock, client_sock, stats, False))
+    try:
+        # each direction ends on its own EOF, an error on either side tears both down
+        # and an idle tunnel is cancelled from outside through stats.deadline
+        await asyncio.wait({up, down}, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in (up, down):
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(up, down, return_exceptions=True)
+        client_sock.close()
+        server_sock.close()
+
+
+def _dup(writer):
+    sock = writer.get_extra_info("socket")
+    dup = socket.fromfd(sock.fileno(), sock.family, sock.type)
+    dup.setblocking(False)
+    return dup
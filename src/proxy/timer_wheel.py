@@ -0,0 +1,165 @@
+# One hashed timer wheel for every idle/read timeout in the proxy. A connection
+# keeps a single Deadline and pushes it forward on activity, which is two attribute
+# writes instead of a wait_for() timer handle created and cancelled per read.
+# Due deadlines are found a slot at a time, once per tick.
+
+import asyncio
+
+TICK = 0.5    # seconds per slot, timeouts fire up to one tick late
+SLOTS = 512
+
+
+class Deadline:
+    __slots__ = ("wheel", "timeout", "expires_at", "expired", "callback", "_task", "_armed", "_slotted", "_tick")
+
+    def __init__(self, wheel, timeout, callback=None):
+        self.wheel = wheel
+        self.timeout = timeout
+        self.expires_at = 0.0
+        self.expired = False
+        # with no callback, expiry cancels whichever task last armed the deadline
+        self.callback = callback
+        self._task = None
+        self._armed = False
+        self._slotted = False
+        self._tick = 0  # absolute tick of the slot it sits in
+
+    def arm(self, timeout=None):
+        self.expires_at = self.wheel.now() + (self.timeout if timeout is None else timeout)
+        self.expired = False
+        self._armed = True
+        if self.callback is None:
+            self._task = asyncio.current_task()
+        if not self._slotted:
+            self.wheel._add(self)
+        elif self.wheel._tick_of(self) < self._tick:
+            # a later slot would fire it late, e.g. a short idle timeout after a long body one
+            self.wheel._move(self)
+
+    def disarm(self):
+        # stays in its slot until that comes up, re-arming before then costs nothing
+        self._armed = False
+
+    cancel = disarm
+
+    def refresh(self):
+        # activity pushes the deadline out, the wheel re-slots it lazily when its old slot comes up
+        self.expires_at = self.wheel.now() + self.timeout
+
+    async def run(self, awaitable, timeout=None):
+        # wait_for() without a timer handle per call, for reads in a loop
+        self.arm(timeout)
+        try:
+            return await awaitable
+        except asyncio.CancelledError:
+            if not self.expired:
+                raise
+            task = asyncio.current_task()
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+            raise asyncio.TimeoutError() from None
+        finally:
+            self._armed = False
+
+    def _fire(self):
+        self.expired = True
+        self._armed = False
+        if self.callback is not None:
+            self.callback()
+        elif self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+
+class TimerWheel:
+
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._count = 0
+        self._current = None  # absolute tick number last processed
+        self._handle = None
+        self._loop = None
+
+    def now(self):
+        return self._loop.time()
+
+    def deadline(self, timeout, callback=None):
+        # a disarmed deadline, arm() starts the countdown
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return Deadline(self, timeout, callback)
+
+    def register(self, timeout, callback=None):
+        deadline = self.deadline(timeout, callback)
+        deadline.arm()
+        return deadline
+
+    def _add(self, deadline):
+        if self._handle is None:
+            self._current = int(self.now() / self.tick)
+            self._schedule()
+        deadline._slotted = True
+        self._count += 1
+        self._insert(deadline)
+
+    def _tick_of(self, deadline):
+        return max(int(deadline.expires_at / self.tick), self._current + 1)
+
+    def _insert(self, deadline):
+        deadline._tick = self._tick_of(deadline)
+        self._slots[deadline._tick % len(self._slots)].append(deadline)
+
+    def _move(self, deadline):
+        try:
+            self._slots[deadline._tick % len(self._slots)].remove(deadline)
+        except ValueError:
+            # its slot is being expired right now, _expire_slot skips the copy it holds
+            pass
+        self._insert(deadline)
+
+    def _schedule(self):
+        self._handle = self._loop.call_at((self._current + 1) * self.tick, self._advance)
+
+    def _advance(self):
+        now_tick = int(self.now() / self.tick)
+        # catch up on every slot passed since the last tick, but never more than one lap
+        first = max(self._current + 1, now_tick - len(self._slots) + 1)
+        for tick_no in range(first, now_tick + 1):
+            self._current = tick_no
+            self._expire_slot(tick_no % len(self._slots))
+        self._current = now_tick
+
+        if self._count:
+            self._schedule()
+        else:
+            self._handle = None
+
+    def _expire_slot(self, index):
+        entries, self._slots[index] = self._slots[index], []
+        now = self.now()
+        for deadline in entries:
+            if deadline._tick % len(self._slots) != index:
+                # moved to an earlier slot while this one was being expired
+                continue
+            if deadline._armed and deadline.expires_at > now:
+                # refreshed since it was slotted, or due on a later lap
+                self._insert(deadline)
+                continue
+            self._count -= 1
+            deadline._slotted = False
+            if deadline._armed:
+                deadline._fire()
+
+    def __len__(self):
+        return self._count
+
+
+_wheel = None
+
+
+def get_timer_wheel():
+    global _wheel
+    if _wheel is None:
+        _wheel = TimerWheel()
+    return _wheel
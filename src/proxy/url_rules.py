@@ -0,0 +1,67 @@
+# Substring rules for the blocklist ("~/pixel.gif", "~tracking"), matched against the
+# request's host and path. All of them are compiled into one Aho-Corasick automaton, so
+# a request costs one pass over its URL however many rules there are.
+
+from collections import deque
+
+
+class KeywordMatcher:
+
+    def __init__(self, keywords):
+        # state 0 is the root. goto[state] maps a character to the next state, fail[state]
+        # is the longest proper suffix of that state's text that is also a prefix of some
+        # rule, out[state] a rule ending here (directly or through the fail chain) or None
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [None]
+        self.count = 0
+        for keyword in keywords:
+            if keyword:
+                self._add(keyword)
+                self.count += 1
+        self._link()
+
+    def _add(self, keyword):
+        state = 0
+        for ch in keyword:
+            following = self.goto[state].get(ch)
+            if following is None:
+                following = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(None)
+                self.goto[state][ch] = following
+            state = following
+        if self.out[state] is None:
+            self.out[state] = keyword
+
+    def _link(self):
+        # breadth first, so every fail target is done before the states that point at it
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, following in self.goto[state].items():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(ch, 0)
+                if self.out[following] is None:
+                    self.out[following] = self.out[self.fail[following]]
+
+    def search(self, text):
+        # the first rule found in text, or None
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state] is not None:
+                return out[state]
+        return None
+
+    def __len__(self):
+        return self.count
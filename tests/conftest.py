@@ -0,0 +1,23 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from proxy import (background_refresh, collapsed_forwarding, connection_pool, dns_resolver,  # noqa: E402
+                   http_cache, origin_scheduler, proxy_logger, timer_wheel)
+
+
+@pytest.fixture
+def fresh_proxy(tmp_path):
+    # the module singletons hold on to the event loop they were first used on, every
+    # test runs its own loop so they start over. request logs go to a temp file
+    proxy_logger._logger = proxy_logger.ProxyLogger(log_file=str(tmp_path / "proxy.log"), console=False)
+    for module, name in ((timer_wheel, "_wheel"), (connection_pool, "_pool"), (http_cache, "_cache"),
+                         (collapsed_forwarding, "_collapser"), (background_refresh, "_refresher"),
+                         (dns_resolver, "_resolver"), (origin_scheduler, "_scheduler")):
+        setattr(module, name, None)
+    yield
+    proxy_logger._logger.close()
+    proxy_logger._logger = None
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from proxy.admission import AdmissionController
+
+
+def test_queued_connection_gets_the_next_free_slot(fresh_proxy):
+    async def run():
+        admission = AdmissionController(max_connections=1)
+        assert await admission.admit("1.1.1.1") is None
+        waiter = asyncio.ensure_future(admission.admit("2.2.2.2"))
+        await asyncio.sleep(0)
+        assert admission.get_stats() == {"active": 1, "queued": 1, "client_ips": 2}
+        admission.release("1.1.1.1")
+        assert await waiter is None
+        return admission.get_stats()
+
+    assert asyncio.run(run()) == {"active": 1, "queued": 0, "client_ips": 1}
+
+
+def test_full_queue_and_queue_timeout_are_shed(fresh_proxy):
+    async def run():
+        admission = AdmissionController(max_connections=1, max_queue=1, queue_timeout=0.1)
+        assert await admission.admit("1.1.1.1") is None
+        waiter = asyncio.ensure_future(admission.admit("2.2.2.2"))
+        await asyncio.sleep(0)
+        assert await admission.admit("3.3.3.3") == "queue_full"
+        assert await waiter == "queue_timeout"
+        return admission
+
+    admission = asyncio.run(run())
+    assert admission.get_stats() == {"active": 1, "queued": 0, "client_ips": 1}
+    assert admission._per_ip == {"1.1.1.1": 1}
+
+
+def test_per_ip_cap(fresh_proxy):
+    async def run():
+        admission = AdmissionController(max_per_ip=2)
+        assert await admission.admit("1.1.1.1") is None
+        assert await admission.admit("1.1.1.1") is None
+        assert await admission.admit("1.1.1.1") == "per_ip_limit"
+        assert await admission.admit("2.2.2.2") is None
+        admission.release("1.1.1.1")
+        assert await admission.admit("1.1.1.1") is None
+        return admission.get_stats()
+
+    assert asyncio.run(run()) == {"active": 3, "queued": 0, "client_ips": 2}
+
+
+def test_waiter_cancelled_before_release_does_not_leak_its_ip(fresh_proxy):
+    async def run():
+        admission = AdmissionController(max_connections=1)
+        assert await admission.admit("1.1.1.1") is None
+        waiter = asyncio.ensure_future(admission.admit("2.2.2.2"))
+        await asyncio.sleep(0)
+        # the client goes away, and release() pops the cancelled future before the
+        # waiter gets to take itself out of the queue
+        waiter.cancel()
+        admission.release("1.1.1.1")
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return admission
+
+    admission = asyncio.run(run())
+    assert admission._per_ip == {}
+    assert admission.get_stats() == {"active": 0, "queued": 0, "client_ips": 0}
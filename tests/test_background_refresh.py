@@ -0,0 +1,26 @@
+import asyncio
+
+from proxy import forwarder
+from proxy.http_parser import HTTPRequest
+
+
+class _Entry:
+    def has_validators(self):
+        return False
+
+
+def test_refresh_drops_range_and_conditional_headers(monkeypatch):
+    sent = []
+
+    async def fetch_upstream(client_writer, req, client_addr, keep_alive, result, flight=None):
+        sent.append(req)
+    monkeypatch.setattr(forwarder, "fetch_upstream", fetch_upstream)
+
+    headers = {"Host": "example.com", "Range": "bytes=0-99", "If-Range": '"v1"',
+               "If-None-Match": '"v1"', "Accept": "*/*"}
+    req = HTTPRequest("GET", "http://example.com/a", "/a", "HTTP/1.1", headers, b"", "example.com", 80)
+    asyncio.run(forwarder.refresh_entry(req, ("127.0.0.1", 1), _Entry()))
+
+    assert sent[0].headers == {"Host": "example.com", "Accept": "*/*"}
+    # the triggering client's request is left alone
+    assert req.headers["Range"] == "bytes=0-99"
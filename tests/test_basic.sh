@@ -157,6 +157,18 @@ else
     test_fail "Large response failed (got $HTTP_CODE)"
 fi
 
+
+print_header "Test 10: Keep-Alive Connection Reuse"
+test_info "curl -x $PROXY http://httpbin.org/get http://httpbin.org/uuid (one curl, two requests)"
+
+CONNECTS=$(curl -s -x "$PROXY" -o /dev/null -o /dev/null -w "%{num_connects} " --max-time 15 http://httpbin.org/get http://httpbin.org/uuid 2>&1)
+
+if [ "$(echo $CONNECTS | awk '{print $2}')" = "0" ]; then
+    test_pass "Second request reused the proxy connection"
+else
+    test_fail "Second request opened a new connection (connects: $CONNECTS)"
+fi
+
 print_header "Test Results Summary"
 echo -e "${GREEN}Passed: $PASSED${NC}"
 echo -e "${RED}Failed: $FAILED${NC}"
@@ -157,7 +157,44 @@ else
 fi
 
 
-print_header "Test 10: Logging Verification"
+print_header "Test 10: URL Rule Into the Path (~facebook.com/tr?)"
+test_info "curl -x $PROXY \"http://www.facebook.com/tr?id=1&ev=PageView\""
+
+HTTP_CODE=$(curl -s -x "$PROXY" -o /dev/null -w "%{http_code}" --max-time 10 "http://www.facebook.com/tr?id=1&ev=PageView" 2>&1)
+
+if [ "$HTTP_CODE" = "403" ]; then
+    test_pass "Tracking pixel URL blocked by url rule"
+else
+    test_fail "Tracking pixel URL not blocked (got $HTTP_CODE)"
+fi
+
+
+print_header "Test 11: URL Rule Stays Specific"
+test_info "Paths that only start like the rule must not be blocked"
+
+for path in "/trending" "/translations"; do
+    HTTP_CODE=$(curl -s -x "$PROXY" -o /dev/null -w "%{http_code}" --max-time 15 "http://www.facebook.com${path}" 2>&1)
+    if [ "$HTTP_CODE" = "403" ]; then
+        test_fail "www.facebook.com${path} blocked by url rule"
+    else
+        test_pass "www.facebook.com${path} not blocked (got $HTTP_CODE)"
+    fi
+done
+
+
+print_header "Test 12: URL Rule on CONNECT (host only)"
+test_info "curl -x $PROXY https://www.facebook.com/tr?id=1 (path is inside the tunnel)"
+
+HTTP_CODE=$(curl -s -x "$PROXY" -o /dev/null -w "%{http_connect}" --max-time 15 "https://www.facebook.com/tr?id=1" 2>&1)
+
+if [ "$HTTP_CODE" = "403" ]; then
+    test_fail "CONNECT blocked by a url rule that needs the path"
+else
+    test_pass "CONNECT only sees the host, url rule not applied (got $HTTP_CODE)"
+fi
+
+
+print_header "Test 13: Logging Verification"
 test_info "Checking if blocked requests are logged"
 echo -e "${YELLOW}Note: Check proxy.log for 'BLOCKED' entries after running tests${NC}"
 
@@ -0,0 +1,93 @@
+import os
+
+from proxy.blocklist_snapshot import open_snapshot, snapshot_path, source_stamp, write_snapshot
+from proxy.domain_filter import DomainFilter
+
+
+def _config(tmp_path, text="example.org\n"):
+    config = tmp_path / "blocked.txt"
+    config.write_text(text)
+    return str(config)
+
+
+def test_snapshot_lookups(tmp_path):
+    config = _config(tmp_path)
+    exact = {f"host{i}.example.org" for i in range(100)}
+    write_snapshot(config, source_stamp(config), exact, {"ads.example", "example.com"}, {"/pixel.gif", "tracking"})
+    snapshot = open_snapshot(config)
+    try:
+        assert len(snapshot.exact) == 100 and len(snapshot.suffixes) == 2
+        assert all(name in snapshot.exact for name in exact)
+        assert "host100.example.org" not in snapshot.exact
+        assert "example.com" in snapshot.suffixes and "ads.example" in snapshot.suffixes
+        # the kinds are kept apart
+        assert "example.com" not in snapshot.exact
+        assert "host1.example.org" not in snapshot.suffixes
+        # a prefix of a stored entry isn't one
+        assert "example.co" not in snapshot.suffixes
+        assert "bücher.example" not in snapshot.exact
+        assert sorted(snapshot.keywords()) == ["/pixel.gif", "tracking"]
+    finally:
+        snapshot.close()
+
+
+def test_empty_snapshot(tmp_path):
+    config = _config(tmp_path)
+    write_snapshot(config, source_stamp(config), set(), set(), set())
+    snapshot = open_snapshot(config)
+    try:
+        assert "example.org" not in snapshot.exact
+        assert snapshot.keywords() == []
+    finally:
+        snapshot.close()
+
+
+def test_stale_or_broken_snapshots_are_not_opened(tmp_path):
+    config = _config(tmp_path)
+    assert open_snapshot(config) is None
+    write_snapshot(config, source_stamp(config), {"example.org"}, set(), set())
+    assert open_snapshot(config) is not None
+    with open(config, "a") as f:
+        f.write("example.net\n")
+    assert open_snapshot(config) is None
+    with open(snapshot_path(config), "wb") as f:
+        f.write(b"not a snapshot")
+    assert open_snapshot(config) is None
+
+
+def test_filter_writes_and_reopens_the_snapshot(tmp_path):
+    config = _config(tmp_path, "example.org\n*.ads.example\n~tracking\n")
+    first = DomainFilter(config)
+    assert os.path.exists(snapshot_path(config))
+    assert first.index.snapshot is not None
+    built = os.stat(snapshot_path(config)).st_mtime_ns
+
+    second = DomainFilter(config)
+    # mapped as it is, not written again
+    assert os.stat(snapshot_path(config)).st_mtime_ns == built
+    assert second.index.stamp == first.index.stamp
+    assert second.is_blocked("example.org")
+    assert second.is_blocked("x.ads.example")
+    assert second.is_blocked("tracking.example.net")
+    assert not second.is_blocked("example.net")
+
+
+def test_filter_rebuilds_the_snapshot_after_the_list_changes(tmp_path):
+    config = _config(tmp_path, "example.org\n")
+    DomainFilter(config)
+    with open(config, "w") as f:
+        f.write("example.net\n*.ads.example\n")
+    # a different mtime even on filesystems with coarse timestamps
+    st = os.stat(config)
+    os.utime(config, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    domain_filter = DomainFilter(config)
+    assert domain_filter.is_blocked("example.net")
+    assert domain_filter.is_blocked("a.ads.example")
+    assert not domain_filter.is_blocked("example.org")
+    snapshot = open_snapshot(config)
+    try:
+        assert (snapshot.source_mtime, snapshot.source_size) == source_stamp(config)
+        assert "example.net" in snapshot.exact
+    finally:
+        snapshot.close()
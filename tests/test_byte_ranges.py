@@ -0,0 +1,130 @@
+import asyncio
+
+from proxy.byte_ranges import parse_ranges, prepare_range_response
+from proxy.cache_compression import STORED_GZIP_HEADER
+from proxy.forwarder import send_cached
+from proxy.http_cache import get_cache
+from proxy.http_parser import HTTPRequest, find_head_end, parse_response_head
+
+BODY = bytes(range(100))
+RESPONSE = (b"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nETag: \"v1\"\r\n"
+            b"Last-Modified: Tue, 15 Nov 1994 12:45:26 GMT\r\nContent-Length: 100\r\n\r\n" + BODY)
+
+
+def _range(value, **headers):
+    headers["Range"] = value
+    return prepare_range_response(RESPONSE, headers, True)
+
+
+def _head(head):
+    return parse_response_head(head[:find_head_end(head)])
+
+
+def test_parse_ranges():
+    assert parse_ranges("bytes=0-9", 100) == [(0, 9)]
+    # open-ended, and an end past the last byte is clamped
+    assert parse_ranges("bytes=90-", 100) == [(90, 99)]
+    assert parse_ranges("bytes=95-200", 100) == [(95, 99)]
+    # suffix: the last n bytes, or all of them when n is bigger than the body
+    assert parse_ranges("bytes=-10", 100) == [(90, 99)]
+    assert parse_ranges("bytes=-500", 100) == [(0, 99)]
+    assert parse_ranges("bytes=0-0, 5-9, -1", 100) == [(0, 0), (5, 9), (99, 99)]
+    # nothing satisfiable
+    assert parse_ranges("bytes=100-", 100) == []
+    assert parse_ranges("bytes=-0", 100) == []
+    # unusable headers mean the full response
+    for value in ("items=0-9", "bytes=", "bytes=9-0", "bytes=a-b", "bytes=5", "bytes=" + ",".join(["0-1"] * 17)):
+        assert parse_ranges(value, 100) is None, value
+
+
+def test_single_range():
+    status, head, pieces = _range("bytes=10-19")
+    _, code, _, headers = _head(head)
+    assert status == code == 206
+    assert headers["Content-Range"] == "bytes 10-19/100"
+    assert headers["Content-Length"] == "10"
+    assert b"".join(pieces) == BODY[10:20]
+
+
+def test_suffix_and_open_ended_ranges():
+    assert b"".join(_range("bytes=-5")[2]) == BODY[95:]
+    assert b"".join(_range("bytes=97-")[2]) == BODY[97:]
+
+
+def test_multiple_ranges_are_multipart():
+    status, head, pieces = _range("bytes=0-1,50-52")
+    _, _, _, headers = _head(head)
+    assert status == 206
+    content_type = headers["Content-Type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("=", 1)[1].encode()
+    body = b"".join(pieces)
+    assert int(headers["Content-Length"]) == len(body)
+    assert body.count(b"--" + boundary + b"\r\n") == 2 and body.endswith(b"--" + boundary + b"--\r\n")
+    assert b"Content-Range: bytes 0-1/100\r\n\r\n" + BODY[0:2] in body
+    assert b"Content-Range: bytes 50-52/100\r\n\r\n" + BODY[50:53] in body
+    assert body.count(b"Content-Type: application/octet-stream") == 2
+
+
+def test_unsatisfiable_range_is_416():
+    status, head, pieces = _range("bytes=200-300")
+    _, code, _, headers = _head(head)
+    assert status == code == 416
+    assert headers["Content-Range"] == "bytes */100"
+    assert headers["Content-Length"] == "0"
+    assert pieces == []
+
+
+def test_if_range():
+    assert _range("bytes=0-9", **{"If-Range": '"v1"'})[0] == 206
+    assert _range("bytes=0-9", **{"If-Range": "Tue, 15 Nov 1994 12:45:26 GMT"})[0] == 206
+    # a different validator, a weak one, or another date: the whole response instead
+    assert _range("bytes=0-9", **{"If-Range": '"v2"'}) is None
+    assert _range("bytes=0-9", **{"If-Range": 'W/"v1"'}) is None
+    assert _range("bytes=0-9", **{"If-Range": "Wed, 16 Nov 1994 12:45:26 GMT"}) is None
+
+
+def test_no_range_or_not_a_200():
+    assert prepare_range_response(RESPONSE, {}, True) is None
+    not_found = RESPONSE.replace(b"200 OK", b"404 Not Found")
+    assert prepare_range_response(not_found, {"Range": "bytes=0-9"}, True) is None
+
+
+class _Writer:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+def test_gzip_stored_entry_is_kept_plain_once_ranges_come(fresh_proxy):
+    text = b"".join(b"row %d, the same words again and again\n" % i for i in range(3000))
+    response = (b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nCache-Control: max-age=60\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(text)) + text
+
+    async def run():
+        cache = get_cache()
+        cache.compress_level = 6
+        headers = {"Host": "example.com", "Range": "bytes=100-199"}
+        req = HTTPRequest("GET", "http://example.com/t", "/t", "HTTP/1.1", headers, b"", "example.com", 80)
+        cache.put("GET", "example.com", "/t", {}, response)
+        stored = cache.get("GET", "example.com", "/t", headers)
+        assert stored.headers.get(STORED_GZIP_HEADER) == str(len(text))
+        bodies = []
+        for _ in range(2):
+            writer = _Writer()
+            await send_cached(writer, req, ("127.0.0.1", 1), cache.get("GET", "example.com", "/t", headers), True)
+            bodies.append(bytes(writer.data[find_head_end(writer.data) + 4:]))
+        return stored, cache.get("GET", "example.com", "/t", headers), cache, bodies
+
+    stored, kept, cache, bodies = asyncio.run(run())
+    assert bodies == [text[100:200]] * 2
+    assert STORED_GZIP_HEADER not in kept.headers and "Content-Encoding" not in kept.headers
+    assert kept.content_length > stored.content_length
+    assert cache.get_stats()["size_bytes"] == kept.content_length
+    assert kept.timestamp == stored.timestamp
+    assert bytes(kept.response_bytes).endswith(text)
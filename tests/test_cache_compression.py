@@ -0,0 +1,128 @@
+import asyncio
+import gzip
+import os
+import threading
+
+from proxy import cache_compression, forwarder
+from proxy.cache_compression import (STORED_GZIP_HEADER, accepts_gzip, compress_response,
+                                     prepare_stored_body)
+from proxy.forwarder import handle_client
+from proxy.http_cache import LRUCache, get_cache
+from proxy.http_parser import find_head_end, parse_response_head
+
+TEXT = b"".join(b"line %d of some very repetitive text\n" % i for i in range(200))
+
+
+def _response(body, content_type="text/plain", extra=""):
+    return (f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nETag: \"v1\"\r\n{extra}"
+            f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+
+def _split(response):
+    head_end = find_head_end(response)
+    return parse_response_head(response[:head_end])[3], response[head_end + 4:]
+
+
+def test_text_is_stored_gzipped_and_inflated_for_plain_clients():
+    stored = compress_response(_response(TEXT), 6)
+    headers, body = _split(stored)
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers[STORED_GZIP_HEADER] == str(len(TEXT))
+    assert int(headers["Content-Length"]) == len(body) < len(TEXT) // 2
+    assert gzip.decompress(body) == TEXT
+
+    plain = dict(headers)
+    assert prepare_stored_body(plain, body, False) == TEXT
+    assert plain["Content-Length"] == str(len(TEXT))
+    assert "Content-Encoding" not in plain and STORED_GZIP_HEADER not in plain
+    assert plain["Vary"] == "Accept-Encoding"
+    assert plain["ETag"] == '"v1"'
+
+
+def test_gzip_clients_get_the_stored_bytes_with_a_weak_etag():
+    headers, body = _split(compress_response(_response(TEXT, extra="Vary: Cookie\r\n"), 6))
+    assert prepare_stored_body(headers, body, True) is body
+    assert headers["ETag"] == 'W/"v1"'
+    assert headers["Vary"] == "Cookie, Accept-Encoding"
+    assert STORED_GZIP_HEADER not in headers
+
+
+def test_chunked_text_is_dechunked_before_compressing():
+    chunked = (b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nTransfer-Encoding: chunked\r\n\r\n"
+               + b"%x\r\n" % len(TEXT) + TEXT + b"\r\n0\r\n\r\n")
+    headers, body = _split(compress_response(chunked, 6))
+    assert "Transfer-Encoding" not in headers
+    assert gzip.decompress(body) == TEXT
+
+
+def test_what_is_left_alone():
+    for response in (_response(b"short text"),
+                     _response(TEXT, "image/png"),
+                     _response(TEXT, extra="Content-Encoding: br\r\n"),
+                     _response(os.urandom(4096))):
+        assert compress_response(response, 6) is response
+    # stored as it came, nothing to undo
+    headers, body = _split(_response(TEXT))
+    assert prepare_stored_body(headers, body, False) is body
+
+
+def test_accepts_gzip():
+    assert accepts_gzip({"Accept-Encoding": "gzip, deflate, br"})
+    assert accepts_gzip({"accept-encoding": "br;q=1.0, GZIP;q=0.5"})
+    assert accepts_gzip({"Accept-Encoding": "*"})
+    assert not accepts_gzip({"Accept-Encoding": "gzip;q=0"})
+    assert not accepts_gzip({"Accept-Encoding": "br, deflate"})
+    assert not accepts_gzip({})
+
+
+def test_big_bodies_are_compressed_and_inflated_off_the_event_loop(fresh_proxy, monkeypatch):
+    body = TEXT * 40
+    assert len(body) > cache_compression.OFFLOAD_BYTES
+    threads = []
+
+    def spy(name, func):
+        def wrapped(*args):
+            threads.append((name, threading.current_thread() is threading.main_thread()))
+            return func(*args)
+        monkeypatch.setattr(forwarder, name, wrapped)
+    spy("compress_response", forwarder.compress_response)
+    spy("prepare_cached", forwarder.prepare_cached)
+
+    async def serve(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(_response(body, extra="Cache-Control: max-age=60\r\n"))
+        await writer.drain()
+        writer.close()
+
+    async def fetch(port, url):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {url} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".encode())
+        response = await asyncio.wait_for(reader.read(), 10)
+        writer.close()
+        return _split(response)
+
+    async def run():
+        get_cache().compress_level = 6
+        origin = await asyncio.start_server(serve, "127.0.0.1", 0)
+        proxy = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+        url = f"http://127.0.0.1:{origin.sockets[0].getsockname()[1]}/text"
+        port = proxy.sockets[0].getsockname()[1]
+        try:
+            return [await fetch(port, url) for _ in range(2)]
+        finally:
+            proxy.close()
+            origin.close()
+
+    (_, first), (headers, second) = asyncio.run(run())
+    assert first == second == body
+    assert headers["Vary"] == "Accept-Encoding"
+    assert get_cache().get_stats()["hits"] == 1
+    assert threads == [("compress_response", False), ("prepare_cached", False)]
+
+
+def test_entry_headers_describe_the_stored_gzip():
+    cache = LRUCache(compress_level=6)
+    cache.put("GET", "example.com", "/t", {}, _response(TEXT, extra="Cache-Control: max-age=60\r\n"))
+    entry = cache.get("GET", "example.com", "/t", {})
+    assert entry.headers[STORED_GZIP_HEADER] == str(len(TEXT))
+    assert entry.headers["Content-Encoding"] == "gzip"
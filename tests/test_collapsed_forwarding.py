@@ -0,0 +1,148 @@
+import asyncio
+
+from proxy.forwarder import handle_client
+from proxy.http_cache import get_cache
+from proxy.http_parser import decode_chunked
+from proxy import collapsed_forwarding
+from proxy.collapsed_forwarding import Flight, RequestCollapser
+
+CHUNK = 64 * 1024
+
+
+def _body(size):
+    return bytes(i % 251 for i in range(size))
+
+
+async def _origin(body, requests):
+    async def serve(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        requests.append(1)
+        # give every client time to attach to the same fetch before anything arrives
+        await asyncio.sleep(0.3)
+        writer.write(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nTransfer-Encoding: chunked\r\n"
+                     b"Connection: close\r\n\r\n")
+        for i in range(0, len(body), CHUNK):
+            piece = body[i:i + CHUNK]
+            writer.write(b"%x\r\n" % len(piece) + piece + b"\r\n")
+            await writer.drain()
+            await asyncio.sleep(0.001)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+    return await asyncio.start_server(serve, "127.0.0.1", 0)
+
+
+async def _fetch(proxy_port, url):
+    reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+    writer.write(f"GET {url} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    response = await asyncio.wait_for(reader.read(), 30)
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    if b"transfer-encoding: chunked" in head.lower():
+        body = decode_chunked(body)
+    return head.split(b"\r\n")[0], body
+
+
+def test_large_chunked_response_reaches_every_collapsed_client(fresh_proxy):
+    # bigger than the cache keeps, so the flight stops buffering halfway through
+    body = _body(int(7.5 * 1024 * 1024))
+    assert len(body) > get_cache().max_object_bytes
+
+    async def run():
+        requests = []
+        origin = await _origin(body, requests)
+        proxy = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+        url = f"http://127.0.0.1:{origin.sockets[0].getsockname()[1]}/big"
+        try:
+            results = await asyncio.gather(*(_fetch(proxy.sockets[0].getsockname()[1], url) for _ in range(4)))
+        finally:
+            proxy.close()
+            origin.close()
+        return requests, results
+
+    requests, results = asyncio.run(run())
+    assert len(requests) == 1
+    for status_line, received in results:
+        assert status_line == b"HTTP/1.1 200 OK"
+        assert len(received) == len(body)
+        assert received == body
+
+
+def test_unbuffered_flight_turns_away_late_followers_and_lets_go_of_written_chunks():
+    collapser = RequestCollapser()
+    flight = collapser.lead("k")
+    flight.start("HTTP/1.1", 200, "OK", {}, True, True)
+    flight.feed(b"a")
+    _, token = collapser.join("k")
+    flight.feed(b"b")
+    flight.stop_buffering()
+    assert collapser.join("k") is None
+    assert flight.chunks == [b"a", b"b"]
+    flight.advance(token, 2)
+    assert flight.chunks == [] and flight.base == 2
+    flight.detach(token)
+    flight.feed(b"c")
+    assert flight.chunks == [] and flight.base == 3
+
+
+def test_buffering_flight_keeps_every_chunk_for_late_followers():
+    flight = Flight("k")
+    token = flight.attach()
+    flight.feed(b"a")
+    flight.advance(token, 1)
+    assert flight.chunks == [b"a"]
+
+
+def test_follower_too_far_behind_an_unbuffered_flight_is_cut_off(monkeypatch):
+    monkeypatch.setattr(collapsed_forwarding, "MAX_FOLLOWER_LAG", 1000)
+    collapser = RequestCollapser()
+    flight = collapser.lead("k")
+    flight.start("HTTP/1.1", 200, "OK", {}, True, True)
+    _, fast = collapser.join("k")
+    _, slow = collapser.join("k")
+    flight.stop_buffering()
+    for i in range(30):
+        flight.feed(b"x" * 100)
+        flight.advance(fast, i + 1)
+    # what the fast follower has written is gone, and only the last 1000 bytes are held
+    assert flight.cut_off(slow) and not flight.cut_off(fast)
+    assert flight.followers == 1
+    assert flight.held <= 1000
+    assert flight.chunks == [] and flight.base == 30
+
+
+def test_slow_follower_gets_its_connection_cut(fresh_proxy, monkeypatch):
+    monkeypatch.setattr(collapsed_forwarding, "MAX_FOLLOWER_LAG", 1000)
+
+    class StuckWriter:
+        # a client that stops reading: drain never returns until the test lets it
+        def __init__(self):
+            self.release = asyncio.Event()
+
+        def write(self, data):
+            pass
+
+        async def drain(self):
+            await self.release.wait()
+
+    async def run():
+        collapser = RequestCollapser()
+        flight = collapser.lead("k")
+        writer = StuckWriter()
+        follower = asyncio.ensure_future(collapser.follow(collapser.join("k"), writer, True))
+        flight.start("HTTP/1.1", 200, "OK", {"Transfer-Encoding": "chunked"}, True, True)
+        flight.stop_buffering()
+        await asyncio.sleep(0)
+        for _ in range(30):
+            flight.feed(b"x" * 100)
+        writer.release.set()
+        try:
+            await follower
+        except ConnectionResetError:
+            return collapser.get_stats(), flight
+        raise AssertionError("slow follower wasn't cut off")
+
+    stats, flight = asyncio.run(run())
+    assert stats["cut_off"] == 1
+    assert flight.followers == 0 and flight.chunks == []
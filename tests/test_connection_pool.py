@@ -0,0 +1,118 @@
+import asyncio
+
+from proxy.connection_pool import ConnectionPool, get_pool
+from proxy.forwarder import handle_client
+
+OK = b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\nContent-Length: 2\r\n\r\nok"
+
+
+async def _origin(connections, per_connection=None, close_idle=False):
+    # keep-alive origin. per_connection caps how many requests a connection answers, the
+    # one after that is read and dropped without a reply, like an origin that timed it out
+    async def serve(reader, writer):
+        connections.append(writer)
+        answered = 0
+        while True:
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            if per_connection is not None and answered >= per_connection:
+                break
+            writer.write(OK)
+            await writer.drain()
+            answered += 1
+            if close_idle:
+                break
+        writer.close()
+    return await asyncio.start_server(serve, "127.0.0.1", 0)
+
+
+async def _get(proxy_port, origin_port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+    writer.write(f"GET http://127.0.0.1:{origin_port}/ HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                 "Connection: close\r\n\r\n".encode())
+    response = await asyncio.wait_for(reader.read(), 5)
+    writer.close()
+    return response
+
+
+async def _through_proxy(origin, times):
+    proxy = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+    try:
+        responses = []
+        for _ in range(times):
+            responses.append(await _get(proxy.sockets[0].getsockname()[1], origin.sockets[0].getsockname()[1]))
+            # lets the pooled connection's idle watcher see a close, if there is one
+            await asyncio.sleep(0.05)
+        return responses
+    finally:
+        proxy.close()
+        origin.close()
+
+
+def test_upstream_connection_is_reused(fresh_proxy):
+    connections = []
+
+    async def run():
+        return await _through_proxy(await _origin(connections), 3)
+
+    responses = asyncio.run(run())
+    assert all(response.startswith(b"HTTP/1.1 200 OK") for response in responses)
+    assert len(connections) == 1
+
+
+def test_connection_closed_while_idle_is_not_handed_out(fresh_proxy):
+    connections = []
+
+    async def run():
+        origin = await _origin(connections, close_idle=True)
+        port = origin.sockets[0].getsockname()[1]
+        pool = ConnectionPool()
+        conn = await pool.acquire("127.0.0.1", port, 5)
+        conn.writer.write(b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n")
+        assert (await conn.reader.readexactly(len(OK))) == OK
+        pool.release(conn, True)
+        assert pool.get_stats()["idle_connections"] == 1
+        # the origin hangs up, the idle watcher drops it from the pool
+        await asyncio.sleep(0.1)
+        stats = pool.get_stats()
+        fresh = await pool.acquire("127.0.0.1", port, 5)
+        reused = fresh.reused
+        fresh.close()
+        origin.close()
+        return stats, reused, conn.writer.is_closing()
+
+    stats, reused, closed = asyncio.run(run())
+    assert stats["idle_connections"] == 0
+    assert not reused and closed
+    assert len(connections) == 2
+
+
+def test_checkout_rejects_a_connection_that_went_bad(fresh_proxy):
+    async def run():
+        origin = await _origin([])
+        pool = ConnectionPool()
+        conn = await pool.acquire("127.0.0.1", origin.sockets[0].getsockname()[1], 5)
+        pool.release(conn, True)
+        # unsolicited bytes on an idle connection, it can't carry a request any more
+        conn.reader.feed_data(b"HTTP/1.1 408 Request Timeout\r\n\r\n")
+        await asyncio.sleep(0)
+        origin.close()
+        return pool.get_stats(), conn.writer.is_closing()
+
+    stats, closed = asyncio.run(run())
+    assert stats["idle_connections"] == 0 and closed
+
+
+def test_request_is_replayed_once_on_a_fresh_connection(fresh_proxy):
+    # the origin drops the pooled connection just as the second request goes out on it
+    connections = []
+
+    async def run():
+        return await _through_proxy(await _origin(connections, per_connection=1), 2)
+
+    responses = asyncio.run(run())
+    assert all(response.startswith(b"HTTP/1.1 200 OK") for response in responses)
+    assert len(connections) == 2
+    assert get_pool().get_stats()["idle_connections"] == 1
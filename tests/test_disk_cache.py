@@ -0,0 +1,54 @@
+import time
+
+from proxy.disk_cache import DiskCache
+
+
+def _wait_written(disk, timeout=5):
+    stop = time.time() + timeout
+    while disk.get_stats()["pending"] and time.time() < stop:
+        time.sleep(0.01)
+
+
+def test_queued_demotion_is_served_before_and_after_it_is_written(tmp_path):
+    disk = DiskCache(str(tmp_path))
+    disk.put_later("k", b"A" * 1000, 1.0)
+    entry, view = disk.get("k")
+    assert bytes(view) == b"A" * 1000 and entry.timestamp == 1.0
+    _wait_written(disk)
+    entry, view = disk.get("k")
+    assert bytes(view) == b"A" * 1000 and entry.segment is not None
+    assert entry.hits == 2
+    disk.close()
+
+
+def test_close_writes_out_queued_demotions(tmp_path):
+    disk = DiskCache(str(tmp_path))
+    for n in range(50):
+        disk.put_later(f"k{n}", bytes([n]) * 10000, float(n))
+    disk.close()
+
+    reopened = DiskCache(str(tmp_path))
+    for n in range(50):
+        _, view = reopened.get(f"k{n}")
+        assert bytes(view) == bytes([n]) * 10000
+    reopened.close()
+
+
+def test_newest_version_wins_when_replaced_while_queued(tmp_path):
+    disk = DiskCache(str(tmp_path))
+    for n in range(20):
+        disk.put_later("k", bytes([n]) * 100000, float(n))
+    _wait_written(disk)
+    _, view = disk.get("k")
+    assert bytes(view) == bytes([19]) * 100000
+    disk.close()
+
+
+def test_deleted_while_queued_stays_deleted(tmp_path):
+    disk = DiskCache(str(tmp_path))
+    disk.put_later("k", b"x" * 100, 1.0)
+    disk.delete("k")
+    _wait_written(disk)
+    assert disk.get("k") is None
+    assert disk.get_stats()["pending"] == 0
+    disk.close()
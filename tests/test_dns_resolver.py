@@ -0,0 +1,56 @@
+import asyncio
+import socket
+
+from proxy.dns_resolver import DNSCache
+
+INFO = (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", 0))
+
+
+def test_concurrent_callers_share_one_lookup(monkeypatch):
+    calls = []
+
+    async def run():
+        loop = asyncio.get_running_loop()
+
+        async def getaddrinfo(host, port, type=0):
+            calls.append(host)
+            await asyncio.sleep(0.05)
+            return [INFO]
+        monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+
+        cache = DNSCache()
+        results = await asyncio.gather(*(cache.resolve("Example.com") for _ in range(5)))
+        assert all(result == [(socket.AF_INET, "192.0.2.1", 0)] for result in results)
+        # answered from the cache now
+        await cache.resolve("example.com")
+        return cache.get_stats()
+
+    stats = asyncio.run(run())
+    assert calls == ["example.com"]
+    assert stats == {"entries": 1, "hits": 1, "misses": 1, "coalesced": 4}
+
+
+def test_failed_lookup_is_shared_and_cached(monkeypatch):
+    calls = []
+
+    async def run():
+        loop = asyncio.get_running_loop()
+
+        async def getaddrinfo(host, port, type=0):
+            calls.append(host)
+            await asyncio.sleep(0.05)
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+
+        cache = DNSCache()
+        results = await asyncio.gather(*(cache.resolve("nx.example") for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, socket.gaierror) for result in results)
+        try:
+            await cache.resolve("nx.example")
+        except socket.gaierror:
+            pass
+        return cache.get_stats()
+
+    stats = asyncio.run(run())
+    assert calls == ["nx.example"]
+    assert stats["misses"] == 1 and stats["coalesced"] == 2 and stats["hits"] == 1
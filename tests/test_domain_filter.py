@@ -0,0 +1,137 @@
+import asyncio
+import locale
+import os
+
+import pytest
+
+from proxy.domain_filter import DomainFilter
+
+
+def _filter(tmp_path, entries):
+    config = tmp_path / "blocked.txt"
+    config.write_text("\n".join(entries) + "\n")
+    return DomainFilter(str(config))
+
+
+def test_suffix_rules_match_whole_labels(tmp_path):
+    domain_filter = _filter(tmp_path, ["*.example.com"])
+    assert domain_filter.is_blocked("example.com")
+    assert domain_filter.is_blocked("a.example.com")
+    assert domain_filter.is_blocked("x.y.EXAMPLE.com:443")
+    assert not domain_filter.is_blocked("badexample.com")
+    assert not domain_filter.is_blocked("a.badexample.com")
+    assert not domain_filter.is_blocked("example.com.evil.net")
+    assert not domain_filter.is_blocked("com")
+
+
+def test_match_suffix_walks_up_the_labels(tmp_path):
+    domain_filter = _filter(tmp_path, [])
+    suffixes = {"example.com", "ads.example.net"}
+    assert domain_filter._match_suffix("example.com", suffixes) == "example.com"
+    assert domain_filter._match_suffix("a.b.example.com", suffixes) == "example.com"
+    assert domain_filter._match_suffix("x.ads.example.net", suffixes) == "ads.example.net"
+    assert domain_filter._match_suffix("example.net", suffixes) is None
+    assert domain_filter._match_suffix("badexample.com", suffixes) is None
+    assert domain_filter._match_suffix("xads.example.net", suffixes) is None
+
+
+def test_exact_rules_leave_subdomains_alone(tmp_path):
+    domain_filter = _filter(tmp_path, ["tracker.example.org"])
+    assert domain_filter.is_blocked("tracker.example.org")
+    assert not domain_filter.is_blocked("a.tracker.example.org")
+    assert not domain_filter.is_blocked("example.org")
+
+
+def _rewrite(config, text):
+    # each version gets its own mtime, even on filesystems with coarse timestamps
+    mtime = config.stat().st_mtime_ns
+    config.write_bytes(text if isinstance(text, bytes) else text.encode())
+    os.utime(config, ns=(mtime + 1_000_000_000, mtime + 1_000_000_000))
+
+
+async def _wait_for(condition, timeout=3):
+    for _ in range(int(timeout / 0.02)):
+        if condition():
+            return True
+        await asyncio.sleep(0.02)
+    return condition()
+
+
+def test_hot_reload_picks_up_an_edited_list(tmp_path):
+    domain_filter = _filter(tmp_path, ["example.org"])
+    config = tmp_path / "blocked.txt"
+
+    async def run():
+        domain_filter.start_watching(interval=0.05)
+        try:
+            _rewrite(config, "example.net\n*.ads.example\n")
+            assert await _wait_for(lambda: domain_filter.generation == 2)
+        finally:
+            domain_filter.stop_watching()
+
+    asyncio.run(run())
+    assert domain_filter.is_blocked("example.net")
+    assert domain_filter.is_blocked("a.ads.example")
+    assert not domain_filter.is_blocked("example.org")
+    assert domain_filter.reload_failures == 0
+
+
+def test_hot_reload_waits_for_the_file_to_stop_changing(tmp_path):
+    domain_filter = _filter(tmp_path, ["example.org"])
+    config = tmp_path / "blocked.txt"
+
+    async def run():
+        domain_filter.start_watching(interval=0.2)
+        try:
+            # being written out bit by bit, faster than the watcher polls
+            lines = []
+            for i in range(40):
+                lines.append(f"host{i}.example.net")
+                _rewrite(config, "\n".join(lines) + "\n")
+                await asyncio.sleep(0.02)
+            assert domain_filter.generation == 1
+            assert await _wait_for(lambda: domain_filter.generation == 2)
+        finally:
+            domain_filter.stop_watching()
+
+    asyncio.run(run())
+    assert len(domain_filter.blocked_exact) == 40
+    assert not domain_filter.is_blocked("example.org")
+
+
+@pytest.mark.skipif(locale.getpreferredencoding(False).lower().replace("-", "") != "utf8",
+                    reason="needs a utf-8 locale to fail decoding the list")
+def test_hot_reload_keeps_the_index_when_the_list_cant_be_read(tmp_path):
+    domain_filter = _filter(tmp_path, ["example.org"])
+    config = tmp_path / "blocked.txt"
+
+    async def run():
+        domain_filter.start_watching(interval=0.05)
+        try:
+            _rewrite(config, b"example.net\n\xff\xfe\xfd\n")
+            assert await _wait_for(lambda: domain_filter.reload_failures == 1)
+        finally:
+            domain_filter.stop_watching()
+
+    asyncio.run(run())
+    assert domain_filter.generation == 1
+    assert domain_filter.is_blocked("example.org")
+    assert not domain_filter.is_blocked("example.net")
+
+
+def test_hot_reload_keeps_the_index_while_the_list_is_missing(tmp_path):
+    domain_filter = _filter(tmp_path, ["example.org"])
+    config = tmp_path / "blocked.txt"
+
+    async def run():
+        domain_filter.start_watching(interval=0.05)
+        try:
+            config.unlink()
+            await asyncio.sleep(0.3)
+        finally:
+            domain_filter.stop_watching()
+
+    asyncio.run(run())
+    assert domain_filter.generation == 1
+    assert domain_filter.reload_failures == 0
+    assert domain_filter.is_blocked("example.org")
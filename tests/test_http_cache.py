@@ -0,0 +1,180 @@
+import asyncio
+import time
+from email.utils import formatdate
+
+from proxy import http_cache
+from proxy.http_cache import CacheEntry, LRUCache, freshness_lifetime
+
+
+def _response(body=b"hello", **headers):
+    lines = "".join(f"{name.replace('_', '-')}: {value}\r\n" for name, value in headers.items())
+    return f"HTTP/1.1 200 OK\r\n{lines}Content-Length: {len(body)}\r\n\r\n".encode() + body
+
+
+def _body(entry):
+    return bytes(entry.response_bytes).split(b"\r\n\r\n", 1)[1]
+
+
+def test_freshness_lifetime():
+    now = time.time()
+    assert freshness_lifetime({"Cache-Control": "max-age=60"}, 300) == 60
+    # a shared cache goes by s-maxage first
+    assert freshness_lifetime({"Cache-Control": "max-age=60, s-maxage=10"}, 300) == 10
+    assert freshness_lifetime({"Cache-Control": "max-age=60", "Expires": formatdate(now + 999, usegmt=True)}, 300) == 60
+    # Expires counts from the origin's Date, not our clock
+    headers = {"Date": formatdate(now - 1000, usegmt=True), "Expires": formatdate(now - 900, usegmt=True)}
+    assert abs(freshness_lifetime(headers, 300) - 100) <= 1
+    assert freshness_lifetime({"Expires": "0"}, 300) == 0
+    assert freshness_lifetime({"Cache-Control": "no-cache, max-age=60"}, 300) == 0
+    # nothing said: the configured heuristic TTL
+    assert freshness_lifetime({}, 300) == 300
+    assert freshness_lifetime({"Cache-Control": "public"}, 42) == 42
+
+
+def test_age_counts_against_freshness():
+    entry = CacheEntry(b"", {"Cache-Control": "max-age=60", "Age": "59"}, 200)
+    assert entry.is_fresh()
+    entry = CacheEntry(b"", {"Cache-Control": "max-age=60", "Age": "61"}, 200)
+    assert not entry.is_fresh()
+    # an old Date says it has been around that long already
+    entry = CacheEntry(b"", {"Cache-Control": "max-age=60", "Date": formatdate(time.time() - 120, usegmt=True)}, 200)
+    assert not entry.is_fresh()
+
+
+def test_put_get_and_expiry():
+    cache = LRUCache(default_ttl=300)
+    assert cache.put("GET", "Example.com", "/a", {}, _response(Cache_Control="max-age=60"))
+    assert _body(cache.get("GET", "example.com", "/a", {})) == b"hello"
+    assert not cache.put("GET", "example.com", "/b", {}, _response(Cache_Control="no-store"))
+    assert not cache.put("POST", "example.com", "/c", {}, _response(Cache_Control="max-age=60"))
+    cache.put("GET", "example.com", "/d", {}, _response(Cache_Control="max-age=0", ETag='"v1"'))
+    assert cache.get("GET", "example.com", "/d", {}) is None
+    # still there for a revalidation
+    assert not cache.get("GET", "example.com", "/d", {}, allow_stale=True).is_fresh()
+
+
+class _Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def test_sweep_drops_expired_entries(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(http_cache.time, "time", clock)
+    cache = LRUCache()
+    for i in range(3):
+        cache.put("GET", "example.com", f"/short/{i}", {}, _response(Cache_Control="max-age=10, must-revalidate"))
+    cache.put("GET", "example.com", "/long", {}, _response(Cache_Control="max-age=1000"))
+    # validators mean a 304 can still bring it back, never swept
+    cache.put("GET", "example.com", "/etag", {}, _response(Cache_Control="max-age=0", ETag='"v1"'))
+    assert cache.sweep() == 0
+    clock.now += 20
+    assert cache.sweep() == 3
+    assert cache.expired == 3
+    assert sorted(cache._cache) == ["GET:example.com/etag", "GET:example.com/long"]
+    assert cache.get_stats()["expired"] == 3
+
+
+def test_sweep_skips_heap_items_of_replaced_entries(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(http_cache.time, "time", clock)
+    cache = LRUCache()
+    cache.put("GET", "example.com", "/a", {}, _response(b"old", Cache_Control="max-age=10, must-revalidate"))
+    cache.put("GET", "example.com", "/a", {}, _response(b"new", Cache_Control="max-age=1000"))
+    clock.now += 20
+    # the first entry's heap item comes due, but the key holds the newer entry now
+    assert cache.sweep() == 1
+    assert cache.expired == 0
+    assert _body(cache.get("GET", "example.com", "/a", {})) == b"new"
+
+
+def test_sweep_rebuilds_a_heap_of_mostly_replaced_items(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(http_cache.time, "time", clock)
+    cache = LRUCache()
+    for _ in range(200):
+        cache.put("GET", "example.com", "/a", {}, _response(Cache_Control="max-age=1000"))
+    assert len(cache._expiry) == 200
+    cache.sweep()
+    assert len(cache._expiry) == 1
+    assert cache._expiry[0][3] is cache._cache["GET:example.com/a"]
+
+
+def test_sweeper_runs_on_the_timer_wheel(fresh_proxy, monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(http_cache.time, "time", clock)
+    monkeypatch.setattr(http_cache, "SWEEP_INTERVAL", 0.1)
+    cache = LRUCache()
+    for i in range(100):
+        cache.put("GET", "example.com", f"/{i}", {}, _response(Cache_Control="max-age=10, must-revalidate"))
+
+    async def run():
+        cache.start_sweeper()
+        clock.now += 20
+        # a full batch first, the rest on the following tick
+        for _ in range(40):
+            if not cache._cache:
+                break
+            await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert cache.expired == 100
+    assert not cache._cache
+
+
+def test_304_merges_headers_and_keeps_the_body():
+    cache = LRUCache()
+    cache.put("GET", "example.com", "/a", {}, _response(b"stored body", Cache_Control="max-age=0",
+                                                        ETag='"v1"', X_Old="1"))
+    stale = cache.get("GET", "example.com", "/a", {}, allow_stale=True)
+    assert not stale.is_fresh()
+    entry = cache.refresh("GET", "example.com", "/a", {}, stale,
+                          {"Cache-Control": "max-age=60", "ETag": '"v1"', "X-New": "2",
+                           "Content-Length": "0", "Connection": "close"})
+    assert entry.is_fresh()
+    assert _body(entry) == b"stored body"
+    assert entry.headers["X-New"] == "2" and entry.headers["X-Old"] == "1"
+    # the 304's framing and hop-by-hop headers don't describe the stored body
+    assert entry.headers["Content-Length"] == str(len(b"stored body"))
+    assert "Connection" not in entry.headers
+    assert cache.get("GET", "example.com", "/a", {}) is entry
+    assert cache.revalidated == 1
+
+
+def test_vary_picks_the_matching_variant():
+    cache = LRUCache()
+    for language in ("en", "de"):
+        cache.put("GET", "example.com", "/", {"Accept-Language": language},
+                  _response(language.encode(), Cache_Control="max-age=60", Vary="Accept-Language"))
+    assert _body(cache.get("GET", "example.com", "/", {"Accept-Language": "en"})) == b"en"
+    assert _body(cache.get("GET", "example.com", "/", {"accept-language": "de"})) == b"de"
+    assert cache.get("GET", "example.com", "/", {"Accept-Language": "fr"}) is None
+    assert cache.get("GET", "example.com", "/", {}) is None
+
+
+def test_vary_values_with_separators_stay_apart():
+    cache = LRUCache()
+    for cookie in ("a=1&b=2", "a=1"):
+        cache.put("GET", "example.com", "/", {"Cookie": cookie},
+                  _response(cookie.encode(), Cache_Control="max-age=60", Vary="Cookie, Accept-Encoding"))
+    assert _body(cache.get("GET", "example.com", "/", {"Cookie": "a=1&b=2"})) == b"a=1&b=2"
+    assert _body(cache.get("GET", "example.com", "/", {"Cookie": "a=1"})) == b"a=1"
+    assert cache.get("GET", "example.com", "/", {"Cookie": "a=1&b=2", "Accept-Encoding": "gzip"}) is None
+
+
+def test_vary_names_survive_a_restart_from_disk(tmp_path):
+    cache = LRUCache(disk_dir=str(tmp_path))
+    cache.put("GET", "example.com", "/", {"Cookie": "id=a&b=c=d"},
+              _response(b"yours", Cache_Control="max-age=60", Vary="Cookie"))
+    cache.close()
+
+    restarted = LRUCache(disk_dir=str(tmp_path))
+    try:
+        assert restarted._vary == {"GET:example.com/": ["Cookie"]}
+        assert _body(restarted.get("GET", "example.com", "/", {"Cookie": "id=a&b=c=d"})) == b"yours"
+        assert restarted.get("GET", "example.com", "/", {"Cookie": "id=b"}) is None
+    finally:
+        restarted.close()
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from proxy.forwarder import handle_client
+from proxy.http_parser import HTTPParseError, HeaderLimits, async_parse_http_request
+
+
+def _parse(data, limits=HeaderLimits(), eof=True):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        if eof:
+            reader.feed_eof()
+        return await async_parse_http_request(reader, limits)
+    return asyncio.run(run())
+
+
+def _status(data, limits=HeaderLimits()):
+    with pytest.raises(HTTPParseError) as info:
+        _parse(data, limits)
+    return info.value.status
+
+
+def test_request_within_limits(fresh_proxy):
+    req = _parse(b"GET http://example.com:8080/a?b=1 HTTP/1.1\r\nHost: example.com\r\nX-A: 1\r\n\r\n")
+    assert (req.method, req.host, req.port, req.path) == ("GET", "example.com", 8080, "/a?b=1")
+    assert req.headers == {"Host": "example.com", "X-A": "1"}
+
+
+def test_oversized_request_line_is_414(fresh_proxy):
+    limits = HeaderLimits(max_request_line=100)
+    line = b"GET http://example.com/" + b"a" * 200 + b" HTTP/1.1"
+    # complete, and still coming in without its line end yet
+    assert _status(line + b"\r\nHost: example.com\r\n\r\n", limits) == 414
+    assert _status(line, limits) == 414
+
+
+def test_oversized_header_block_is_431(fresh_proxy):
+    limits = HeaderLimits(max_header_bytes=1000)
+    head = b"GET http://example.com/ HTTP/1.1\r\nX-Big: " + b"a" * 2000
+    assert _status(head + b"\r\n\r\n", limits) == 431
+    assert _status(head, limits) == 431
+
+
+def test_too_many_headers_is_431(fresh_proxy):
+    limits = HeaderLimits(max_header_count=10)
+    fields = b"".join(b"X-%d: v\r\n" % i for i in range(11))
+    assert _status(b"GET http://example.com/ HTTP/1.1\r\n" + fields + b"\r\n", limits) == 431
+    fields = b"".join(b"X-%d: v\r\n" % i for i in range(10))
+    assert len(_parse(b"GET http://example.com/ HTTP/1.1\r\n" + fields + b"\r\n", limits).headers) == 10
+
+
+def test_slow_headers_time_out(fresh_proxy):
+    with pytest.raises(asyncio.TimeoutError):
+        _parse(b"GET http://example.com/ HTTP/1.1\r\nHost: exa", HeaderLimits(header_timeout=0.2), eof=False)
+
+
+def test_proxy_answers_with_the_limit_status(fresh_proxy):
+    async def send(data):
+        proxy = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", proxy.sockets[0].getsockname()[1])
+            writer.write(data)
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return response.split(b"\r\n", 1)[0]
+        finally:
+            proxy.close()
+
+    async def run():
+        return [await send(b"GET http://example.com/" + b"a" * 9000 + b" HTTP/1.1\r\n\r\n"),
+                await send(b"GET http://example.com/ HTTP/1.1\r\nX-Big: " + b"a" * 70000 + b"\r\n\r\n"),
+                await send(b"GET http://example.com/ HTTP/1.1\r\n" + b"X-A: 1\r\n" * 101 + b"\r\n")]
+
+    assert asyncio.run(run()) == [b"HTTP/1.1 414 URI Too Long",
+                                  b"HTTP/1.1 431 Request Header Fields Too Large",
+                                  b"HTTP/1.1 431 Request Header Fields Too Large"]
+
+
+def test_request_transfer_codings_under_chunked_are_kept(fresh_proxy):
+    req = _parse(b"POST http://example.com/ HTTP/1.1\r\nHost: example.com\r\n"
+                 b"Transfer-Encoding: gzip, chunked\r\nContent-Length: 5\r\n\r\n")
+    assert req.chunked
+    assert req.headers == {"Host": "example.com", "Transfer-Encoding": "gzip, chunked"}
+    req = _parse(b"POST http://example.com/ HTTP/1.1\r\nHost: example.com\r\nTransfer-Encoding: Chunked\r\n\r\n")
+    assert req.headers["Transfer-Encoding"] == "chunked"
+
+
+def test_request_not_ending_in_chunked_is_501(fresh_proxy):
+    assert _status(b"POST http://example.com/ HTTP/1.1\r\nHost: example.com\r\nTransfer-Encoding: chunked, gzip\r\n\r\n") == 501
+    assert _status(b"POST http://example.com/ HTTP/1.1\r\nHost: example.com\r\nTransfer-Encoding: gzip\r\n\r\n") == 501
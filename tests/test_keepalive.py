@@ -0,0 +1,75 @@
+import asyncio
+
+from proxy import forwarder
+from proxy.forwarder import handle_client
+
+
+async def _origin(seen):
+    # keep-alive origin, answers every request with its own path
+    async def serve(reader, writer):
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            path = head.split(b" ")[1]
+            seen.append(path)
+            body = b"body of " + path
+            writer.write(b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        writer.close()
+    return await asyncio.start_server(serve, "127.0.0.1", 0)
+
+
+async def _read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode().split("\r\n")
+    headers = {k.lower(): v.strip() for k, _, v in (line.partition(":") for line in lines[1:] if line)}
+    body = await reader.readexactly(int(headers["content-length"]))
+    return lines[0], headers, body
+
+
+async def _pipeline(paths, last_close=False):
+    seen = []
+    origin = await _origin(seen)
+    proxy = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+    base = f"http://127.0.0.1:{origin.sockets[0].getsockname()[1]}"
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy.sockets[0].getsockname()[1])
+        requests = b""
+        for i, path in enumerate(paths):
+            close = "Connection: close\r\n" if last_close and i == len(paths) - 1 else ""
+            requests += f"GET {base}{path} HTTP/1.1\r\nHost: 127.0.0.1\r\n{close}\r\n".encode()
+        # all of them in one write, before any answer
+        writer.write(requests)
+        await writer.drain()
+        responses = []
+        while True:
+            try:
+                responses.append(await asyncio.wait_for(_read_response(reader), 5))
+            except asyncio.IncompleteReadError as e:
+                assert e.partial == b""
+                break
+        writer.close()
+        return responses, seen
+    finally:
+        proxy.close()
+        origin.close()
+
+
+def test_pipelined_requests_are_answered_in_order(fresh_proxy):
+    paths = ["/one", "/two", "/three", "/four"]
+    responses, seen = asyncio.run(_pipeline(paths, last_close=True))
+    assert [body for _, _, body in responses] == [b"body of " + p.encode() for p in paths]
+    assert all(status == "HTTP/1.1 200 OK" for status, _, _ in responses)
+    assert [headers.get("connection") for _, headers, _ in responses] == ["keep-alive"] * 3 + ["close"]
+    assert seen == [p.encode() for p in paths]
+
+
+def test_connection_closes_after_max_keepalive_requests(fresh_proxy, monkeypatch):
+    monkeypatch.setattr(forwarder, "MAX_KEEPALIVE_REQUESTS", 2)
+    responses, seen = asyncio.run(_pipeline(["/a", "/b", "/c"]))
+    # the third request is never read, the second answer says so
+    assert [body for _, _, body in responses] == [b"body of /a", b"body of /b"]
+    assert responses[1][1]["connection"] == "close"
+    assert seen == [b"/a", b"/b"]
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from proxy.origin_scheduler import OriginScheduler
+
+
+def test_slots_are_handed_to_waiters_in_order(fresh_proxy):
+    async def run():
+        scheduler = OriginScheduler(max_per_origin=1)
+        await scheduler.acquire("a.example", 80)
+        order = []
+
+        async def wait(name):
+            await scheduler.acquire("a.example", 80)
+            order.append(name)
+        waiters = [asyncio.ensure_future(wait(name)) for name in ("first", "second")]
+        await asyncio.sleep(0)
+        assert scheduler.get_stats()["queued"] == 2
+        scheduler.release("a.example", 80)
+        await asyncio.sleep(0)
+        scheduler.release("a.example", 80)
+        await asyncio.gather(*waiters)
+        scheduler.release("a.example", 80)
+        return order, scheduler.get_stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ["first", "second"]
+    assert stats["active"] == 0 and stats["queued"] == 0
+
+
+def test_release_skips_a_waiter_cancelled_before_it_cleaned_up(fresh_proxy):
+    async def run():
+        scheduler = OriginScheduler(max_per_origin=1)
+        await scheduler.acquire("a.example", 80)
+        waiter = asyncio.ensure_future(scheduler.acquire("a.example", 80))
+        await asyncio.sleep(0)
+        # the waiter's future is cancelled now, its except block only runs on its next turn
+        waiter.cancel()
+        scheduler.release("a.example", 80)
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.get_stats() == {"active": 0, "active_origins": 0, "queued": 0, "queued_origins": 0}
+        # the origin isn't starved, the next request gets its slot right away
+        await asyncio.wait_for(scheduler.acquire("a.example", 80), 1)
+        return scheduler.get_stats()
+
+    assert asyncio.run(run())["active"] == 1
+
+
+def test_queue_timeout_gives_up_the_place(fresh_proxy):
+    async def run():
+        scheduler = OriginScheduler(max_per_origin=1, queue_timeout=0.1)
+        await scheduler.acquire("a.example", 80)
+        with pytest.raises(asyncio.TimeoutError):
+            await scheduler.acquire("a.example", 80)
+        scheduler.release("a.example", 80)
+        return scheduler.get_stats()
+
+    assert asyncio.run(run()) == {"active": 0, "active_origins": 0, "queued": 0, "queued_origins": 0}
@@ -0,0 +1,95 @@
+import io
+import logging
+import threading
+import time
+
+from proxy.proxy_logger import AsyncLogHandler, LOG_BATCH
+
+
+class GatedStream(io.StringIO):
+    # counts flushes, and holds the writer thread on its first write until opened
+    def __init__(self):
+        super().__init__()
+        self.flushes = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.writing = threading.Event()
+
+    def write(self, text):
+        self.writing.set()
+        self.gate.wait(5)
+        return super().write(text)
+
+    def flush(self):
+        self.flushes += 1
+
+
+def _handler(stream, **kwargs):
+    target = logging.StreamHandler(stream)
+    target.setFormatter(logging.Formatter("%(message)s"))
+    return AsyncLogHandler([target], **kwargs)
+
+
+def _record(n):
+    return logging.LogRecord("proxy", logging.INFO, __file__, 0, "request %s", (n,), None)
+
+
+def test_queued_records_are_written_in_batches_and_flushed_on_close():
+    stream = GatedStream()
+    stream.gate.clear()
+    handler = _handler(stream)
+    handler.emit(_record(0))
+    # the writer thread is stuck on the first record, the rest pile up
+    assert stream.writing.wait(5)
+    for n in range(1, 1000):
+        handler.emit(_record(n))
+    stream.gate.set()
+    handler.close()
+
+    assert stream.getvalue().splitlines() == [f"request {n}" for n in range(1000)]
+    assert handler.written == 1000
+    # one flush per batch, not per record
+    assert handler.batches == stream.flushes
+    assert handler.batches <= 2 + 999 // LOG_BATCH
+
+
+def test_full_queue_drops_and_counts():
+    stream = GatedStream()
+    stream.gate.clear()
+    handler = _handler(stream, max_queue=10, overflow="drop")
+    handler.emit(_record(0))
+    assert stream.writing.wait(5)
+    for n in range(1, 51):
+        handler.emit(_record(n))
+    assert handler.dropped == 40
+    stream.gate.set()
+    handler.close()
+    assert len(stream.getvalue().splitlines()) == 11
+    assert handler.written + handler.dropped == 51
+
+
+def test_full_queue_blocks_until_there_is_room():
+    stream = GatedStream()
+    stream.gate.clear()
+    handler = _handler(stream, max_queue=10, overflow="block")
+    handler.emit(_record(0))
+    assert stream.writing.wait(5)
+    for n in range(1, 11):
+        handler.emit(_record(n))
+
+    emitted = threading.Event()
+
+    def emit_one_more():
+        handler.emit(_record(11))
+        emitted.set()
+
+    thread = threading.Thread(target=emit_one_more)
+    thread.start()
+    time.sleep(0.1)
+    assert not emitted.is_set()
+    stream.gate.set()
+    assert emitted.wait(5)
+    thread.join()
+    handler.close()
+    assert handler.dropped == 0
+    assert stream.getvalue().splitlines() == [f"request {n}" for n in range(12)]
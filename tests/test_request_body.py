@@ -0,0 +1,90 @@
+import asyncio
+import gzip
+
+from proxy.forwarder import handle_client
+from proxy.http_parser import decode_chunked
+
+HEAD = "POST http://127.0.0.1:{port}/upload HTTP/1.1\r\nHost: 127.0.0.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+
+
+async def _origin(received, respond_early=False):
+    async def serve(reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        if respond_early:
+            writer.write(b"HTTP/1.1 413 Payload Too Large\r\nContent-Length: 4\r\nConnection: close\r\n\r\nbig!")
+            await writer.drain()
+        received.append(head + await reader.read())
+        writer.close()
+    return await asyncio.start_server(serve, "127.0.0.1", 0)
+
+
+async def _post(respond_early):
+    received = []
+    origin = await _origin(received, respond_early)
+    proxy = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy.sockets[0].getsockname()[1])
+        writer.write(HEAD.format(port=origin.sockets[0].getsockname()[1]).encode() + b"5\r\nhello\r\n")
+        await writer.drain()
+        if respond_early:
+            # the origin's answer is on its way before the client gets it wrong
+            first = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        else:
+            first = b""
+            await asyncio.sleep(0.1)
+        writer.write(b"zz\r\nnot a chunk\r\n0\r\n\r\n")
+        await writer.drain()
+        response = first + await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        await asyncio.sleep(0.1)
+    finally:
+        proxy.close()
+        origin.close()
+    return response, received
+
+
+def test_bad_client_chunk_gets_400_not_502(fresh_proxy):
+    response, received = asyncio.run(_post(respond_early=False))
+    assert response.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+    # the good chunk went on, the bad size line never did, and the body was left unfinished
+    assert received[0].endswith(b"\r\n\r\n5\r\nhello\r\n")
+
+
+def test_origin_answer_already_sent_is_kept(fresh_proxy):
+    response, _ = asyncio.run(_post(respond_early=True))
+    assert response.startswith(b"HTTP/1.1 413 Payload Too Large\r\n")
+    assert response.endswith(b"big!")
+
+
+def test_codings_under_chunked_reach_the_origin(fresh_proxy):
+    body = gzip.compress(b"hello " * 1000)
+
+    async def run():
+        received = []
+
+        async def serve(reader, writer):
+            head = await reader.readuntil(b"\r\n\r\n")
+            received.append(head + await reader.readuntil(b"\r\n0\r\n\r\n"))
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok")
+            await writer.drain()
+            writer.close()
+
+        origin = await asyncio.start_server(serve, "127.0.0.1", 0)
+        proxy = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", proxy.sockets[0].getsockname()[1])
+            head = HEAD.replace("chunked", "gzip, chunked").format(port=origin.sockets[0].getsockname()[1])
+            writer.write(head.encode() + b"%x\r\n" % len(body) + body + b"\r\n0\r\n\r\n")
+            await writer.drain()
+            response = await asyncio.wait_for(reader.readuntil(b"\r\n\r\nok"), 5)
+            writer.close()
+        finally:
+            proxy.close()
+            origin.close()
+        return response, received[0]
+
+    response, received = asyncio.run(run())
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    head, sent = received.split(b"\r\n\r\n", 1)
+    assert b"\r\nTransfer-Encoding: gzip, chunked" in head
+    assert decode_chunked(sent) == body
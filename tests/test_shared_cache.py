@@ -0,0 +1,109 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from proxy.shared_cache import SHARED_CACHE_AVAILABLE, SharedCache
+
+pytestmark = pytest.mark.skipif(not SHARED_CACHE_AVAILABLE, reason="needs fcntl locks")
+
+SRC = str(Path(__file__).parent.parent / "src")
+MB = 1024 * 1024
+
+
+def _response(body):
+    return (b"HTTP/1.1 200 OK\r\nCache-Control: max-age=600\r\nContent-Length: %d\r\n\r\n" % len(body)) + body
+
+
+def _put(cache, path, body):
+    cache.put("GET", "example.com", path, {}, _response(body))
+
+
+def _body(cache, path):
+    entry = cache.get("GET", "example.com", path, {})
+    return entry.response_bytes.split(b"\r\n\r\n", 1)[1] if entry else None
+
+
+def test_two_instances_share_entries(tmp_path):
+    one = SharedCache(str(tmp_path / "shared"), MB)
+    two = SharedCache(str(tmp_path / "shared"), MB)
+    try:
+        _put(one, "/a", b"from one")
+        assert _body(two, "/a") == b"from one"
+        _put(two, "/a", b"from two")
+        assert _body(one, "/a") == b"from two"
+        assert one.get_stats()["hits"] == two.get_stats()["hits"] == 2
+    finally:
+        one.close()
+        two.close()
+
+
+def test_lapped_records_are_gone(tmp_path):
+    one = SharedCache(str(tmp_path / "shared"), MB)
+    two = SharedCache(str(tmp_path / "shared"), MB)
+    try:
+        body = b"x" * (one.capacity // 5)
+        _put(one, "/first", body)
+        assert _body(two, "/first") == body
+        # the ring comes round to /first again, its index slot still points there
+        for i in range(6):
+            _put(two, f"/{i}", body)
+        assert _body(one, "/first") is None
+        assert _body(one, "/5") == body
+    finally:
+        one.close()
+        two.close()
+
+
+def test_reopening_with_the_same_size_keeps_entries(tmp_path):
+    cache = SharedCache(str(tmp_path / "shared"), MB)
+    _put(cache, "/a", b"kept")
+    cache.close()
+    cache = SharedCache(str(tmp_path / "shared"), MB)
+    try:
+        assert _body(cache, "/a") == b"kept"
+    finally:
+        cache.close()
+
+
+def test_a_different_size_starts_over_when_nobody_uses_the_file(tmp_path):
+    cache = SharedCache(str(tmp_path / "shared"), MB)
+    _put(cache, "/a", b"gone")
+    cache.close()
+    cache = SharedCache(str(tmp_path / "shared"), 2 * MB)
+    try:
+        assert _body(cache, "/a") is None
+        assert (tmp_path / "shared").stat().st_size == cache.data_offset + cache.capacity
+    finally:
+        cache.close()
+
+
+def test_a_different_size_is_refused_while_another_process_maps_the_file(tmp_path):
+    # fcntl locks of one process never conflict with each other, so the other user of
+    # the file has to be a separate process
+    path = str(tmp_path / "shared")
+    holder = subprocess.Popen(
+        [sys.executable, "-c",
+         f"import sys; sys.path.insert(0, {SRC!r})\n"
+         "from proxy.shared_cache import SharedCache\n"
+         f"cache = SharedCache({path!r}, {MB})\n"
+         "cache.put('GET', 'example.com', '/a', {}, "
+         "b'HTTP/1.1 200 OK\\r\\nCache-Control: max-age=600\\r\\nContent-Length: 4\\r\\n\\r\\nkept')\n"
+         "print('ready', flush=True)\n"
+         "sys.stdin.read()\n"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        assert holder.stdout.readline() == b"ready\n"
+        size = (tmp_path / "shared").stat().st_size
+        with pytest.raises(RuntimeError, match="--shared-cache-size"):
+            SharedCache(path, 2 * MB)
+        assert (tmp_path / "shared").stat().st_size == size
+        cache = SharedCache(path, MB)
+        try:
+            assert _body(cache, "/a") == b"kept"
+        finally:
+            cache.close()
+    finally:
+        holder.stdin.close()
+        holder.wait(10)
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from proxy.timer_wheel import TimerWheel
+
+TICK = 0.01
+SLOTS = 32  # one lap is 320 ms
+
+
+def _fire_times(schedule, wait):
+    # schedule(wheel, fired) arms deadlines whose callbacks append to fired,
+    # returns {name: seconds after start it fired}
+    async def run():
+        wheel = TimerWheel(tick=TICK, slots=SLOTS)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        fired = {}
+
+        def record(name):
+            return lambda: fired.setdefault(name, loop.time() - start)
+
+        await schedule(wheel, record)
+        await asyncio.sleep(wait)
+        return fired
+
+    return asyncio.run(run())
+
+
+def test_rearm_shorter_fires_at_the_new_time():
+    async def schedule(wheel, record):
+        deadline = wheel.register(0.25, record("d"))
+        await asyncio.sleep(0.02)
+        deadline.arm(0.05)
+
+    fired = _fire_times(schedule, 0.35)
+    assert fired["d"] == pytest.approx(0.07, abs=2 * TICK + 0.02)
+
+
+def test_rearm_longer_waits_for_the_new_time():
+    async def schedule(wheel, record):
+        deadline = wheel.register(0.05, record("d"))
+        await asyncio.sleep(0.02)
+        deadline.arm(0.2)
+
+    fired = _fire_times(schedule, 0.4)
+    assert fired["d"] == pytest.approx(0.22, abs=2 * TICK + 0.02)
+
+
+def test_deadline_past_one_lap_fires_on_the_right_lap():
+    async def schedule(wheel, record):
+        # lands in the same slot as "short", one lap later
+        wheel.register(0.35, record("long"))
+        wheel.register(0.03, record("short"))
+
+    fired = _fire_times(schedule, 0.5)
+    assert fired["short"] == pytest.approx(0.03, abs=2 * TICK + 0.02)
+    assert fired["long"] == pytest.approx(0.35, abs=2 * TICK + 0.02)
+
+
+def test_rearm_shorter_after_a_run_with_a_long_timeout():
+    # one deadline reused for a long body read and then a short idle read, like StreamBuffer
+    async def run():
+        wheel = TimerWheel(tick=TICK, slots=SLOTS)
+        loop = asyncio.get_running_loop()
+        deadline = wheel.deadline(0.25)
+        await deadline.run(asyncio.sleep(0.01), 0.25)
+        start = loop.time()
+        with pytest.raises(asyncio.TimeoutError):
+            await deadline.run(asyncio.sleep(1), 0.05)
+        return loop.time() - start
+
+    assert asyncio.run(run()) == pytest.approx(0.05, abs=2 * TICK + 0.02)
+
+
+def test_disarmed_deadline_does_not_fire():
+    async def schedule(wheel, record):
+        deadline = wheel.register(0.03, record("d"))
+        deadline.disarm()
+
+    assert _fire_times(schedule, 0.1) == {}
@@ -0,0 +1,62 @@
+from proxy.domain_filter import DomainFilter
+from proxy.url_rules import KeywordMatcher
+
+
+def test_overlapping_keywords():
+    matcher = KeywordMatcher(["he", "she", "hers", "his"])
+    assert len(matcher) == 4
+    # "she" ends before the longer "hers" could, and contains "he" through the fail link
+    assert matcher.search("ushers") == "she"
+    assert matcher.search("xhisx") == "his"
+    # a partial "her" falls back to the root and still finds the rule after it
+    assert matcher.search("herhis") == "he"
+    assert matcher.search("hi") is None
+    assert matcher.search("") is None
+
+
+def test_rule_found_only_through_fail_chain():
+    # "abcd" fails at "x" and has to pick up "bcx" from its suffix "bc"
+    matcher = KeywordMatcher(["abcd", "bcx"])
+    assert matcher.search("abcx") == "bcx"
+    assert matcher.search("abcd") == "abcd"
+    assert matcher.search("abc") is None
+
+
+def test_empty_keywords_are_ignored():
+    matcher = KeywordMatcher(["", "ad"])
+    assert len(matcher) == 1
+    assert matcher.search("x") is None
+
+
+def _filter(tmp_path, rules):
+    config = tmp_path / "blocked.txt"
+    config.write_text("\n".join(rules) + "\n")
+    return DomainFilter(str(config))
+
+
+def test_url_rules_reach_into_the_path(tmp_path):
+    domain_filter = _filter(tmp_path, ["~facebook.com/tr?", "~facebook.com/tr/", "~/pixel.gif"])
+    assert domain_filter.is_blocked("www.facebook.com", "/tr?id=1&ev=PageView")
+    assert domain_filter.is_blocked("www.facebook.com", "/tr/")
+    assert domain_filter.is_blocked("cdn.example.com", "/img/PIXEL.GIF?x=1")
+    assert not domain_filter.is_blocked("www.facebook.com", "/trending")
+    assert not domain_filter.is_blocked("www.facebook.com", "/translations")
+    assert not domain_filter.is_blocked("cdn.example.com", "/img/logo.gif")
+
+
+def test_url_rules_match_the_host_alone_for_connect(tmp_path):
+    domain_filter = _filter(tmp_path, ["~tracking", "~/pixel.gif"])
+    # CONNECT has no path, only rules found in the host itself apply
+    assert domain_filter.is_blocked("tracking.example.com:443")
+    assert domain_filter.is_blocked("eu-TRACKING.example.net")
+    assert not domain_filter.is_blocked("cdn.example.com:443")
+
+
+def test_url_rules_survive_the_snapshot(tmp_path):
+    first = _filter(tmp_path, ["~facebook.com/tr?", "example.org"])
+    # the second filter loads the binary snapshot the first one wrote
+    domain_filter = DomainFilter(first.config_file)
+    assert domain_filter.index.stamp == first.index.stamp
+    assert domain_filter.is_blocked("facebook.com", "/tr?id=1")
+    assert not domain_filter.is_blocked("facebook.com", "/trending")
+    assert domain_filter.is_blocked("example.org")